@@ -4,223 +4,5632 @@ Claude API Proxy with Usage Tracking
 Logs all API calls to CloudWatch for monitoring and cost tracking
 """
 
-from flask import Flask, request, Response
-import requests
+import abc
+import asyncio
+import base64
+import calendar
+import collections
+import contextlib
+import hashlib
+import hmac
 import json
+import math
+import mmap
+import multiprocessing
 import time
-from datetime import datetime
-import boto3
+from bisect import bisect_left
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import os
+import queue
+import random
+import re
+import select
+import signal
+import socket
+import sqlite3
+import ssl
+import struct
+import threading
+import traceback
+import urllib.request
+from urllib.parse import quote
+
+import aiohttp
+import boto3
+import uvicorn
+import yarl
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.eventstream import EventStreamBuffer
+from multidict import CIMultiDict
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# Proxy settings (override via environment)
+CONFIG = {
+    'host': os.environ.get('CLAUDE_PROXY_HOST', '0.0.0.0'),
+    'port': int(os.environ.get('CLAUDE_PROXY_PORT', '8000')),
+    # Debug endpoints that change state (POST) need this in x-claude-proxy-admin-token; without one
+    # they are only served to clients connecting from localhost
+    'admin_token': os.environ.get('CLAUDE_PROXY_ADMIN_TOKEN', ''),
+    # Pre-forked worker processes sharing the port via SO_REUSEPORT (1 = a single process), and
+    # how long a stopping worker may take to finish its in-flight responses
+    'workers': int(os.environ.get('CLAUDE_PROXY_WORKERS', '1')),
+    'worker_drain_timeout': float(os.environ.get('CLAUDE_PROXY_WORKER_DRAIN_TIMEOUT', '300')),
+    # Seconds a stopping worker keeps answering keep-alive connections (with Connection: close) first
+    'worker_close_grace': float(os.environ.get('CLAUDE_PROXY_WORKER_CLOSE_GRACE', '1')),
+    # Keys the workers' shared-memory counters can hold, seconds between metric publishes, and how
+    # often a request blocked on a shared in-flight cap re-checks it
+    'shared_slots': int(os.environ.get('CLAUDE_PROXY_SHARED_SLOTS', '65536')),
+    'shared_publish_interval': float(os.environ.get('CLAUDE_PROXY_SHARED_PUBLISH_INTERVAL', '1')),
+    'shared_poll_interval': float(os.environ.get('CLAUDE_PROXY_SHARED_POLL_INTERVAL', '0.05')),
+    'upstream_timeout': float(os.environ.get('CLAUDE_PROXY_UPSTREAM_TIMEOUT', '300')),
+    # Extra developer keys beyond DEV<n>_CLAUDE_KEY; reloaded on SIGHUP or file change
+    'keys_file': os.environ.get('CLAUDE_PROXY_KEYS_FILE', ''),
+    'keys_secret_id': os.environ.get('CLAUDE_PROXY_KEYS_SECRET', ''),
+    'keys_reload_interval': float(os.environ.get('CLAUDE_PROXY_KEYS_RELOAD_INTERVAL', '10')),
+    # Opt-in response cache for temperature-0 requests (or x-claude-proxy-cache: 1)
+    'cache_enabled': os.environ.get('CLAUDE_PROXY_CACHE', '0') == '1',
+    'cache_max_bytes': int(os.environ.get('CLAUDE_PROXY_CACHE_MAX_MB', '256')) * 1024 * 1024,
+    'cache_ttl': float(os.environ.get('CLAUDE_PROXY_CACHE_TTL', '3600')),
+    'cache_dir': os.environ.get('CLAUDE_PROXY_CACHE_DIR', ''),
+    # Opt-in: add cache_control breakpoints to prompt prefixes a developer resent within the TTL,
+    # once the prefix is at least min_tokens long (twice that for Haiku models)
+    'prompt_cache_enabled': os.environ.get('CLAUDE_PROXY_PROMPT_CACHE', '0') == '1',
+    'prompt_cache_ttl': float(os.environ.get('CLAUDE_PROXY_PROMPT_CACHE_TTL', '300')),
+    'prompt_cache_min_tokens': int(os.environ.get('CLAUDE_PROXY_PROMPT_CACHE_MIN_TOKENS', '1024')),
+    # Send small requests to a cheaper, faster model: 'off', 'shadow' (classify and count only) or 'on'.
+    # Small = estimated input tokens at most small_tokens, no thinking, images or documents, and no
+    # tool definitions unless tools=1. Requests with one of the pinned anthropic-beta flags, or
+    # x-claude-proxy-model-routing: off, keep their model. Routed max_tokens is capped at max_tokens.
+    'model_routing': os.environ.get('CLAUDE_PROXY_MODEL_ROUTING', 'off'),
+    'model_routing_target': os.environ.get('CLAUDE_PROXY_MODEL_ROUTING_TARGET', 'claude-haiku-4-5-20251001'),
+    'model_routing_small_tokens': int(os.environ.get('CLAUDE_PROXY_MODEL_ROUTING_SMALL_TOKENS', '2000')),
+    'model_routing_tools': os.environ.get('CLAUDE_PROXY_MODEL_ROUTING_TOOLS', '0') == '1',
+    'model_routing_max_tokens': int(os.environ.get('CLAUDE_PROXY_MODEL_ROUTING_MAX_TOKENS', '64000')),
+    'model_routing_pinned_betas': os.environ.get('CLAUDE_PROXY_MODEL_ROUTING_PINNED_BETAS', 'context-1m,computer-use'),
+    # Share one upstream call between identical concurrent requests
+    'coalesce_enabled': os.environ.get('CLAUDE_PROXY_COALESCE', '0') == '1',
+    # Admission control; 0 disables a limit. Adjustable at runtime via POST /debug/limits
+    'limit_dev_requests_per_sec': float(os.environ.get('CLAUDE_PROXY_LIMIT_DEV_RPS', '0')),
+    'limit_dev_tokens_per_min': float(os.environ.get('CLAUDE_PROXY_LIMIT_DEV_TPM', '0')),
+    'limit_dev_max_in_flight': int(os.environ.get('CLAUDE_PROXY_LIMIT_DEV_IN_FLIGHT', '0')),
+    'limit_global_requests_per_sec': float(os.environ.get('CLAUDE_PROXY_LIMIT_GLOBAL_RPS', '0')),
+    'limit_global_tokens_per_min': float(os.environ.get('CLAUDE_PROXY_LIMIT_GLOBAL_TPM', '0')),
+    'limit_global_max_in_flight': int(os.environ.get('CLAUDE_PROXY_LIMIT_GLOBAL_IN_FLIGHT', '0')),
+    'limit_queue_timeout': float(os.environ.get('CLAUDE_PROXY_LIMIT_QUEUE_TIMEOUT', '30')),
+    # Spending limits in USD (0 = none), same names as USAGE_TRACKING.md "Set Budget Limits"
+    'budget_dev_daily_usd': float(os.environ.get('MAX_DAILY_COST', '0')),
+    'budget_dev_monthly_usd': float(os.environ.get('MAX_MONTHLY_COST', '0')),
+    'budget_project_daily_usd': float(os.environ.get('MAX_PROJECT_DAILY', '0')),
+    'budget_project_monthly_usd': float(os.environ.get('MAX_PROJECT_MONTHLY', '0')),
+    'budget_soft_ratio': float(os.environ.get('CLAUDE_PROXY_BUDGET_SOFT_RATIO', '0.8')),
+    'budget_state_file': os.environ.get('CLAUDE_PROXY_BUDGET_STATE', '/mnt/ebs-data/claude-proxy/budget.json'),
+    'budget_checkpoint_interval': float(os.environ.get('CLAUDE_PROXY_BUDGET_CHECKPOINT_INTERVAL', '30')),
+    # Local binary usage journal ('' disables); replayable into budgets and CloudWatch
+    'journal_dir': os.environ.get('CLAUDE_PROXY_JOURNAL_DIR', '/mnt/ebs-data/claude-proxy/journal'),
+    'journal_segment_mb': int(os.environ.get('CLAUDE_PROXY_JOURNAL_SEGMENT_MB', '64')),
+    'journal_commit_interval': float(os.environ.get('CLAUDE_PROXY_JOURNAL_COMMIT_INTERVAL', '0.05')),
+    'journal_retention_days': float(os.environ.get('CLAUDE_PROXY_JOURNAL_RETENTION_DAYS', '90')),
+    # Hourly/daily/monthly usage rollups built from the journal ('' disables)
+    'rollup_db': os.environ.get('CLAUDE_PROXY_ROLLUP_DB', '/mnt/ebs-data/claude-proxy/usage-rollups.sqlite3'),
+    'rollup_interval': float(os.environ.get('CLAUDE_PROXY_ROLLUP_INTERVAL', '60')),
+    # Message Batches offload: /v1/messages with x-claude-proxy-batch: 1 is queued in this database
+    # ('' disables) and answered at GET /v1/messages/queued/<id>, billed at batch pricing. A developer's
+    # queue is submitted once it holds min_requests or its oldest request is max_age seconds old, split
+    # at max_requests / max_mb per batch ('' api_url = CLAUDE_API_URL)
+    'batch_db': os.environ.get('CLAUDE_PROXY_BATCH_DB', '/mnt/ebs-data/claude-proxy/batches.sqlite3'),
+    'batch_api_url': os.environ.get('CLAUDE_PROXY_BATCH_API_URL', ''),
+    'batch_min_requests': int(os.environ.get('CLAUDE_PROXY_BATCH_MIN_REQUESTS', '100')),
+    'batch_max_age': float(os.environ.get('CLAUDE_PROXY_BATCH_MAX_AGE', '300')),
+    'batch_max_requests': int(os.environ.get('CLAUDE_PROXY_BATCH_MAX_REQUESTS', '10000')),
+    'batch_max_mb': float(os.environ.get('CLAUDE_PROXY_BATCH_MAX_MB', '200')),
+    'batch_check_interval': float(os.environ.get('CLAUDE_PROXY_BATCH_CHECK_INTERVAL', '5')),
+    'batch_poll_interval': float(os.environ.get('CLAUDE_PROXY_BATCH_POLL_INTERVAL', '60')),
+    'batch_result_ttl': float(os.environ.get('CLAUDE_PROXY_BATCH_RESULT_TTL', str(7 * 86400))),
+    # Results are also POSTed to an x-claude-proxy-batch-webhook URL starting with one of these
+    # comma-separated prefixes ('' = no webhooks), signed with HMAC-SHA256 of the body if a secret is set
+    'batch_webhook_prefixes': os.environ.get('CLAUDE_PROXY_BATCH_WEBHOOK_PREFIXES', ''),
+    'batch_webhook_secret': os.environ.get('CLAUDE_PROXY_BATCH_WEBHOOK_SECRET', ''),
+    # Optional JSON pricing table replacing the built-in one (same shape as PRICING)
+    'pricing_file': os.environ.get('CLAUDE_PROXY_PRICING_FILE', ''),
+    # Upstream connection pool: 0 = unlimited; keep-alive 0 = new connection per call
+    'upstream_max_connections': int(os.environ.get('CLAUDE_PROXY_MAX_CONNECTIONS', '0')),
+    'upstream_max_per_host': int(os.environ.get('CLAUDE_PROXY_MAX_PER_HOST', '0')),
+    'upstream_keepalive_timeout': float(os.environ.get('CLAUDE_PROXY_KEEPALIVE_TIMEOUT', '60')),
+    'upstream_ca_bundle': os.environ.get('CLAUDE_PROXY_CA_BUNDLE', ''),
+    'cloudwatch_enabled': os.environ.get('CLAUDE_PROXY_CLOUDWATCH', '1') == '1',
+    # CloudWatch Logs batching: max seconds an event waits, max events buffered
+    'log_flush_interval': float(os.environ.get('CLAUDE_PROXY_LOG_FLUSH_INTERVAL', '5')),
+    'log_queue_size': int(os.environ.get('CLAUDE_PROXY_LOG_QUEUE_SIZE', '10000')),
+    # What to do when the log queue is full: drop_newest, drop_oldest or block (up to the timeout, then drop)
+    'log_queue_policy': os.environ.get('CLAUDE_PROXY_LOG_QUEUE_POLICY', 'block'),
+    'log_queue_block_timeout': float(os.environ.get('CLAUDE_PROXY_LOG_QUEUE_BLOCK_TIMEOUT', '1.0')),
+    # CloudWatch Metrics: seconds between aggregated put_metric_data flushes
+    'metrics_flush_interval': float(os.environ.get('CLAUDE_PROXY_METRICS_FLUSH_INTERVAL', '60')),
+    # Upstream retries: attempts after the first, full-jitter exponential backoff, and the
+    # share of traffic retries and hedges may add (plus a floor per second when traffic is low)
+    'retry_max_retries': int(os.environ.get('CLAUDE_PROXY_RETRY_MAX', '2')),
+    'retry_base_delay': float(os.environ.get('CLAUDE_PROXY_RETRY_BASE_DELAY', '0.5')),
+    'retry_max_delay': float(os.environ.get('CLAUDE_PROXY_RETRY_MAX_DELAY', '8')),
+    'retry_max_retry_after': float(os.environ.get('CLAUDE_PROXY_RETRY_MAX_RETRY_AFTER', '10')),
+    'retry_deadline': float(os.environ.get('CLAUDE_PROXY_RETRY_DEADLINE', '60')),
+    'retry_budget_ratio': float(os.environ.get('CLAUDE_PROXY_RETRY_BUDGET_RATIO', '0.2')),
+    'retry_budget_min_per_sec': float(os.environ.get('CLAUDE_PROXY_RETRY_BUDGET_MIN_PER_SEC', '1')),
+    # Hedge short non-streaming calls (max_tokens <= hedge_max_tokens) still unanswered after hedge_after s (0 = off)
+    'hedge_after': float(os.environ.get('CLAUDE_PROXY_HEDGE_AFTER', '0')),
+    'hedge_max_tokens': int(os.environ.get('CLAUDE_PROXY_HEDGE_MAX_TOKENS', '1024')),
+    # Circuit breaker: consecutive failures to open, seconds before a half-open probe
+    'breaker_failure_threshold': int(os.environ.get('CLAUDE_PROXY_BREAKER_FAILURES', '5')),
+    'breaker_reset_timeout': float(os.environ.get('CLAUDE_PROXY_BREAKER_RESET_TIMEOUT', '30')),
+    # Upstream backends, comma-separated: anthropic[=<url>] and bedrock:<region>[=<url>]
+    # ('' = the Anthropic API at CLAUDE_API_URL only)
+    'backends': os.environ.get('CLAUDE_PROXY_BACKENDS', ''),
+    # Routing weight is (1 - error rate) / latency^exponent, both EWMAs with this smoothing factor
+    'router_ewma_alpha': float(os.environ.get('CLAUDE_PROXY_ROUTER_EWMA_ALPHA', '0.2')),
+    'router_latency_exponent': float(os.environ.get('CLAUDE_PROXY_ROUTER_LATENCY_EXPONENT', '2')),
+    # Weight drops off once a backend reports less than this share of its rate limit left
+    'router_quota_low': float(os.environ.get('CLAUDE_PROXY_ROUTER_QUOTA_LOW', '0.2')),
+    # Cross-region inference profile for Anthropic model names sent to Bedrock ('' = base model ID),
+    # and an optional JSON file of {"<anthropic model>": "<bedrock model ID>"} exceptions
+    'bedrock_profile': os.environ.get('CLAUDE_PROXY_BEDROCK_PROFILE', 'global'),
+    'bedrock_models_file': os.environ.get('CLAUDE_PROXY_BEDROCK_MODELS', ''),
+    # Trace spans: '' = off, an http(s) OTLP/JSON endpoint, or a file to append to
+    'trace_export': os.environ.get('CLAUDE_PROXY_TRACE_EXPORT', ''),
+    'trace_sample_rate': float(os.environ.get('CLAUDE_PROXY_TRACE_SAMPLE_RATE', '1.0')),
+    'trace_flush_interval': float(os.environ.get('CLAUDE_PROXY_TRACE_FLUSH_INTERVAL', '5')),
+    # Print the phase breakdown of requests slower than this many seconds (0 = off)
+    'slow_request_seconds': float(os.environ.get('CLAUDE_PROXY_SLOW_REQUEST_SECONDS', '30')),
+    'slow_request_sample_rate': float(os.environ.get('CLAUDE_PROXY_SLOW_REQUEST_SAMPLE_RATE', '1.0')),
+    # Anonymised request shapes and timings (never content) appended as JSON lines for
+    # proxy-bench.py replay ('' = off); developers are hashed with the salt (random per launch if '')
+    'capture_file': os.environ.get('CLAUDE_PROXY_CAPTURE', ''),
+    'capture_sample_rate': float(os.environ.get('CLAUDE_PROXY_CAPTURE_SAMPLE_RATE', '1.0')),
+    'capture_salt': os.environ.get('CLAUDE_PROXY_CAPTURE_SALT', ''),
+}
+
+# CloudWatch client
+cloudwatch = boto3.client('cloudwatch', region_name='ap-southeast-7')
+logs_client = boto3.client('logs', region_name='ap-southeast-7')
+secrets_client = boto3.client('secretsmanager', region_name='ap-southeast-7')
+
+LOG_GROUP = '/aws/ec2/code-server-multi-dev/claude-api'
+PROJECT_NAME = 'code-server-multi-dev'
+
+# Claude API endpoint
+CLAUDE_API_URL = os.environ.get('CLAUDE_API_URL', "https://api.anthropic.com/v1")
+
+# Hop-by-hop headers (RFC 9110 7.6.1) describe one connection and are never relayed;
+# neither are content-length and content-encoding, since aiohttp has already decoded
+# gzip/deflate and the body we send is not the one upstream described
+HOP_BY_HOP_HEADERS = frozenset({
+    b'connection', b'keep-alive', b'proxy-connection', b'proxy-authenticate', b'proxy-authorization',
+    b'te', b'trailer', b'transfer-encoding', b'upgrade',
+})
+DROPPED_RESPONSE_HEADERS = HOP_BY_HOP_HEADERS | {b'content-length', b'content-encoding'}
+
+# Strong references to fire-and-forget tasks so they are not garbage collected
+background_tasks = set()
+
+
+def spawn(coro):
+    """Run a coroutine in the background without awaiting it"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+# Upstream connection pool counters, filled in by aiohttp trace hooks
+POOL_STATS = {
+    'connections_created': 0,
+    'connections_reused': 0,
+    'waits': 0,
+    'wait_seconds': 0.0,
+}
+
+# USD per million tokens. Model keys are ID prefixes; the longest matching one
+# wins, so claude-opus-4-1-20250805 prices as claude-opus-4-1, not claude-opus-4.
+# cache_write is the 5-minute cache tier. Message Batches bill at batch_discount.
+PRICING = {
+    'version': '2025-10-01',
+    'batch_discount': 0.5,
+    'models': {
+        'claude-3-haiku': {'input': 0.25, 'output': 1.25, 'cache_write': 0.30, 'cache_read': 0.03},
+        'claude-3-5-haiku': {'input': 0.80, 'output': 4.00, 'cache_write': 1.00, 'cache_read': 0.08},
+        'claude-haiku-4-5': {'input': 1.00, 'output': 5.00, 'cache_write': 1.25, 'cache_read': 0.10},
+        'claude-3-sonnet': {'input': 3.00, 'output': 15.00, 'cache_write': 3.75, 'cache_read': 0.30},
+        'claude-3-5-sonnet': {'input': 3.00, 'output': 15.00, 'cache_write': 3.75, 'cache_read': 0.30},
+        'claude-3-7-sonnet': {'input': 3.00, 'output': 15.00, 'cache_write': 3.75, 'cache_read': 0.30},
+        'claude-sonnet-4': {'input': 3.00, 'output': 15.00, 'cache_write': 3.75, 'cache_read': 0.30},
+        'claude-sonnet-4-5': {'input': 3.00, 'output': 15.00, 'cache_write': 3.75, 'cache_read': 0.30},
+        'claude-3-opus': {'input': 15.00, 'output': 75.00, 'cache_write': 18.75, 'cache_read': 1.50},
+        'claude-opus-4': {'input': 15.00, 'output': 75.00, 'cache_write': 18.75, 'cache_read': 1.50},
+        'claude-opus-4-1': {'input': 15.00, 'output': 75.00, 'cache_write': 18.75, 'cache_read': 1.50},
+        'claude-opus-4-5': {'input': 5.00, 'output': 25.00, 'cache_write': 6.25, 'cache_read': 0.50},
+    },
+}
+
+
+class DeveloperKeyIndex:
+    """API key -> developer lookup keyed on a SHA-256 digest of the key
+
+    Built from every DEV<n>_CLAUDE_KEY environment variable, an optional JSON
+    key file and an optional Secrets Manager secret, both shaped like
+    {"dev9": "key"} or {"dev9": ["old-key", "new-key"]}. reload() builds a new
+    index and swaps it in with a single assignment, so concurrent lookups see
+    either the old map or the new one, never a partial one.
+    """
+
+    ENV_KEY_PATTERN = re.compile(r'^DEV(\d+)_CLAUDE_KEY$')
+
+    def __init__(self, keys_file='', secret_id=''):
+        self.keys_file = keys_file
+        self.secret_id = secret_id
+        self._index = {}
+        self._file_mtime = None
+
+    @staticmethod
+    def digest(api_key):
+        return hashlib.sha256(api_key.encode('utf-8')).digest()
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, api_key):
+        return self._index.get(self.digest(api_key), 'unknown')
+
+    def reload(self):
+        index = {}
+        for name, value in os.environ.items():
+            match = self.ENV_KEY_PATTERN.match(name)
+            if match and value:
+                index[self.digest(value)] = f'dev{int(match.group(1))}'
+
+        if self.keys_file:
+            mtime = os.stat(self.keys_file).st_mtime
+            with open(self.keys_file) as f:
+                self._add_mapping(index, json.load(f))
+            self._file_mtime = mtime
+
+        if self.secret_id:
+            secret = secrets_client.get_secret_value(SecretId=self.secret_id)
+            self._add_mapping(index, json.loads(secret['SecretString']))
+
+        self._index = index
+        return len(index)
+
+    def file_changed(self):
+        if not self.keys_file:
+            return False
+        try:
+            return os.stat(self.keys_file).st_mtime != self._file_mtime
+        except FileNotFoundError:
+            return False
+
+    def _add_mapping(self, index, mapping):
+        for developer, keys in mapping.items():
+            for key in [keys] if isinstance(keys, str) else keys:
+                index[self.digest(key)] = developer
+
+
+developer_keys = DeveloperKeyIndex(keys_file=CONFIG['keys_file'], secret_id=CONFIG['keys_secret_id'])
+
+
+def get_developer_from_key(api_key):
+    """Extract developer ID from API key"""
+    return developer_keys.lookup(api_key)
+
+
+async def reload_developer_keys(reason):
+    """Rebuild the key index off the event loop; keep the old one on failure"""
+    try:
+        count = await run_in_threadpool(developer_keys.reload)
+        print(f"Loaded {count} developer keys ({reason})")
+    except Exception as e:
+        print(f"Error reloading developer keys, keeping previous set: {e}")
+
+
+async def watch_key_file():
+    """Reload developer keys whenever the key file's mtime changes"""
+    while True:
+        await asyncio.sleep(CONFIG['keys_reload_interval'])
+        if developer_keys.file_changed():
+            await reload_developer_keys('key file changed')
+
+
+ModelPrice = collections.namedtuple('ModelPrice', ['family', 'input', 'output', 'cache_write', 'cache_read'])
+
+
+class PricingTable:
+    """Resolve model IDs to per-token prices with one precompiled regex
+
+    Accepts Anthropic IDs (claude-sonnet-4-5-20250929), Bedrock IDs with a
+    vendor and cross-region prefix (global.anthropic.claude-sonnet-4-5-...-v1:0)
+    and inference profile ARNs. The alternation is ordered longest prefix first
+    and must end on a boundary, so claude-sonnet-4 never swallows
+    claude-sonnet-4-5. Each distinct model string is resolved once and
+    memoized. Models that match nothing price as None and are counted in
+    `unknown` rather than billed at a guessed rate.
+    """
+
+    MAX_MEMO = 4096
+
+    def __init__(self, table):
+        self.version = table.get('version', 'unversioned')
+        self.batch_discount = float(table.get('batch_discount', 1.0))
+        self._prices = {
+            family: ModelPrice(family, *(float(rates.get(k, 0)) / 1_000_000
+                                         for k in ('input', 'output', 'cache_write', 'cache_read')))
+            for family, rates in table['models'].items()
+        }
+        families = sorted(self._prices, key=len, reverse=True)
+        self._pattern = re.compile(
+            r'^(?:.*/)?(?:[a-z-]+\.){0,2}(' + '|'.join(map(re.escape, families)) + r')(?=$|[-@:.])'
+        )
+        self._memo = {}
+        self.unknown = collections.Counter()
+
+    @classmethod
+    def load(cls, path=''):
+        """The built-in table, or a JSON file of the same shape"""
+        if path:
+            try:
+                with open(path) as f:
+                    return cls(json.load(f))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error loading pricing file {path}, using built-in prices: {e}")
+        return cls(PRICING)
+
+    def resolve(self, model):
+        try:
+            return self._memo[model]
+        except KeyError:
+            pass
+        match = self._pattern.match((model or '').lower())
+        price = self._prices[match.group(1)] if match else None
+        if len(self._memo) >= self.MAX_MEMO:
+            self._memo.clear()
+        self._memo[model] = price
+        return price
+
+    def cost(self, model, input_tokens, output_tokens, cache_read_tokens=0, cache_write_tokens=0, batch=False):
+        price = self.resolve(model)
+        if price is None:
+            if not self.unknown[model]:
+                print(f"Error pricing model {model!r}: not in pricing table {self.version}")
+            self.unknown[model] += 1
+            return None
+        cost = (
+            input_tokens * price.input
+            + output_tokens * price.output
+            + cache_write_tokens * price.cache_write
+            + cache_read_tokens * price.cache_read
+        )
+        return cost * self.batch_discount if batch else cost
+
+    def snapshot(self):
+        return {
+            'version': self.version,
+            'batch_discount': self.batch_discount,
+            'models': {
+                family: {k: round(v * 1_000_000, 4) for k, v in price._asdict().items() if k != 'family'}
+                for family, price in self._prices.items()
+            },
+            'resolved': {model: price.family if price else None for model, price in self._memo.items()},
+            'unknown': dict(self.unknown),
+        }
+
+
+pricing = PricingTable.load(CONFIG['pricing_file'])
+
+
+def calculate_cost(model, input_tokens, output_tokens, cache_read_tokens=0, cache_write_tokens=0, batch=False):
+    """Calculate cost based on token usage; None when the model has no known price"""
+    return pricing.cost(model, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens, batch)
+
+
+class TelemetryQueue:
+    """Bounded hand-off from the event loop to a telemetry worker thread
+
+    put() is a deque append, which is atomic under the GIL, so the event
+    loop never takes a lock or waits on the worker. The worker is only
+    woken through an Event when it has gone to sleep on an empty queue.
+    When the queue is full, `policy` decides what happens:
+    'drop_newest' discards the new item, 'drop_oldest' evicts the oldest
+    queued item, and 'block' makes put_async() wait up to `block_timeout`
+    for room before discarding the new item. Only background tasks wait;
+    the response has already been sent by then.
+    """
+
+    POLICIES = ('drop_newest', 'drop_oldest', 'block')
+
+    def __init__(self, maxsize, policy='drop_newest', block_timeout=1.0):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown telemetry queue policy {policy!r}; expected one of {", ".join(self.POLICIES)}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.stats = {'queued': 0, 'dropped_newest': 0, 'dropped_oldest': 0, 'blocked': 0, 'block_timeouts': 0,
+                      'high_water': 0}
+        self._items = collections.deque()
+        self._ready = threading.Event()
+        self._closed = False
+        # Set up by the first put_async() that has to wait; the worker signals room through it
+        self._space = None
+        self._loop = None
+        self._waiting = 0
+
+    def qsize(self):
+        return len(self._items)
+
+    def put(self, item):
+        """Enqueue without waiting; returns False if something was dropped to make the call fit"""
+        items = self._items
+        if len(items) >= self.maxsize:
+            if self.policy != 'drop_oldest':
+                self.stats['dropped_newest'] += 1
+                return False
+            with contextlib.suppress(IndexError):
+                items.popleft()
+                self.stats['dropped_oldest'] += 1
+        items.append(item)
+        self.stats['queued'] += 1
+        if len(items) > self.stats['high_water']:
+            self.stats['high_water'] = len(items)
+        if not self._ready.is_set():
+            self._ready.set()
+        return True
+
+    async def put_async(self, item):
+        """put(), except that the block policy waits for room on the event loop"""
+        if self.policy != 'block' or len(self._items) < self.maxsize:
+            return self.put(item)
+        self.stats['blocked'] += 1
+        if self._space is None:
+            self._loop, self._space = asyncio.get_running_loop(), asyncio.Event()
+        deadline = time.monotonic() + self.block_timeout
+        self._waiting += 1
+        try:
+            while len(self._items) >= self.maxsize:
+                self._space.clear()
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError
+                    await asyncio.wait_for(self._space.wait(), remaining)
+                except asyncio.TimeoutError:
+                    self.stats['block_timeouts'] += 1
+                    break
+        finally:
+            self._waiting -= 1
+        return self.put(item)
+
+    def get(self, timeout=None):
+        """Worker side: next item, None once closed and drained; raises queue.Empty on timeout"""
+        while True:
+            try:
+                item = self._items.popleft()
+            except IndexError:
+                if self._closed:
+                    return None
+                self._ready.clear()
+                # An append between popleft() and clear() has already set the event once; look again
+                if self._items:
+                    continue
+                if not self._ready.wait(timeout):
+                    raise queue.Empty
+                continue
+            if self._waiting and not self._space.is_set():
+                with contextlib.suppress(RuntimeError):  # loop already closed
+                    self._loop.call_soon_threadsafe(self._space.set)
+            return item
+
+    def close(self):
+        self._closed = True
+        self._ready.set()
+
+
+class SharedCounters:
+    """Float counters in anonymous shared memory, so pre-forked workers see the same totals
+
+    run_workers() creates one before forking and every worker inherits the
+    mapping. A key gets a slot holding one float per column; each process
+    only writes its own column (aligned 8-byte stores, so no lock) and a
+    total is the sum of the columns. Keys are appended under `lock` and
+    never removed; each process indexes keys added elsewhere lazily. Cells
+    several workers update together (rate limit buckets) are read and
+    written with get()/put() while holding `lock`.
+    """
+
+    HEADER = struct.Struct('<Q')
+    KEY = struct.Struct('<H')
+    KEY_BYTES = 126
+    VALUE = struct.Struct('<d')
+
+    def __init__(self, slots, columns):
+        self.slots = slots
+        self.columns = columns
+        self.column = 0
+        self.slot_size = self.KEY.size + self.KEY_BYTES + self.VALUE.size * columns
+        self.row = struct.Struct(f'<{columns}d')
+        self.memory = mmap.mmap(-1, self.HEADER.size + slots * self.slot_size)
+        self.lock = multiprocessing.RLock()
+        self._offsets = {}
+        self._synced = 0
+
+    def _sync(self):
+        """Index keys other processes added since the last sync"""
+        memory, key_size = self.memory, self.KEY.size
+        count = self.HEADER.unpack_from(memory)[0]
+        for i in range(self._synced, count):
+            base = self.HEADER.size + i * self.slot_size
+            length = self.KEY.unpack_from(memory, base)[0]
+            key = memory[base + key_size:base + key_size + length].decode()
+            self._offsets[key] = base + key_size + self.KEY_BYTES
+        self._synced = count
+
+    def _find(self, key):
+        offset = self._offsets.get(key)
+        if offset is None:
+            self._sync()
+            offset = self._offsets.get(key)
+        return offset
+
+    def _offset(self, key):
+        """Offset of the values for `key`, adding a slot if no process has yet"""
+        offset = self._find(key)
+        if offset is not None:
+            return offset
+        with self.lock:
+            offset = self._find(key)
+            if offset is not None:
+                return offset
+            encoded = key.encode()
+            if len(encoded) > self.KEY_BYTES:
+                raise ValueError(f'shared counter key too long: {key!r}')
+            if self._synced >= self.slots:
+                raise ValueError(f'shared counters full ({self.slots} keys)')
+            base = self.HEADER.size + self._synced * self.slot_size
+            self.KEY.pack_into(self.memory, base, len(encoded))
+            self.memory[base + self.KEY.size:base + self.KEY.size + len(encoded)] = encoded
+            # Count the key only once it is written, so readers never see a partial one
+            self.HEADER.pack_into(self.memory, 0, self._synced + 1)
+            self._sync()
+            return self._offsets[key]
+
+    def add(self, key, value):
+        """Add to this process's column"""
+        offset = self._offset(key) + self.column * self.VALUE.size
+        self.VALUE.pack_into(self.memory, offset, self.VALUE.unpack_from(self.memory, offset)[0] + value)
+
+    def set(self, key, value):
+        """Set this process's column"""
+        self.VALUE.pack_into(self.memory, self._offset(key) + self.column * self.VALUE.size, value)
+
+    def total(self, key):
+        offset = self._find(key)
+        return sum(self.row.unpack_from(self.memory, offset)) if offset is not None else 0.0
+
+    def get(self, key):
+        """Every column of `key` (zeros if it has none yet); hold `lock` to update them as a unit"""
+        offset = self._find(key)
+        return self.row.unpack_from(self.memory, offset) if offset is not None else (0.0,) * self.columns
+
+    def put(self, key, values):
+        """Overwrite the first len(values) columns of `key`"""
+        struct.pack_into(f'<{len(values)}d', self.memory, self._offset(key), *values)
+
+    def items(self, prefix):
+        """[(key, columns)] for every key starting with `prefix`"""
+        self._sync()
+        unpack, memory = self.row.unpack_from, self.memory
+        return [(key, unpack(memory, offset)) for key, offset in self._offsets.items() if key.startswith(prefix)]
+
+    def clear_column(self, column, prefixes):
+        """Zero `column` of keys starting with any of `prefixes`: levels a dead worker left behind"""
+        self._sync()
+        for key, offset in self._offsets.items():
+            if key.startswith(prefixes):
+                self.VALUE.pack_into(self.memory, offset + column * self.VALUE.size, 0.0)
+
+    def snapshot(self):
+        self._sync()
+        return {'keys': self._synced, 'capacity': self.slots, 'columns': self.columns,
+                'column': self.column, 'bytes': len(self.memory)}
+
+
+# Set by run_workers() before it forks; None when running as a single process
+shared_counters = None
+worker_slot = None
+
+
+class Counter:
+    """Prometheus counter keyed by a tuple of label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, labels, value=1):
+        try:
+            self.values[labels] += value
+        except KeyError:
+            self.values[labels] = value
+
+    def samples(self, values=None):
+        for labels, value in (self.values if values is None else values).items():
+            yield self.name, labels, (), value
+
+
+class Histogram:
+    """Prometheus histogram with fixed bucket bounds
+
+    A series is one list: a count per bucket, one for +Inf, then the sum.
+    observe() is a C bisect and two list increments; counts are made
+    cumulative only when rendered.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels, buckets):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._bounds = tuple(('le', format_metric_value(b)) for b in self.buckets) + (('le', '+Inf'),)
+        self._width = len(self.buckets) + 2
+        self.values = {}
+
+    def observe(self, labels, value):
+        try:
+            cell = self.values[labels]
+        except KeyError:
+            cell = self.values[labels] = [0] * self._width
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def samples(self, values=None):
+        for labels, cell in (self.values if values is None else values).items():
+            running = 0
+            for bound, count in zip(self._bounds, cell):
+                running += count
+                yield f'{self.name}_bucket', labels, bound, running
+            yield f'{self.name}_sum', labels, (), cell[-1]
+            yield f'{self.name}_count', labels, (), running
+
+
+class Gauge:
+    """Prometheus gauge read from a callback at scrape time
+
+    `merge` says how workers' levels combine under run_workers: 'sum',
+    'max', or 'mean' of the workers reporting a non-zero level.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels, read, merge='sum'):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.read = read
+        self.merge = merge
+
+    def combine(self, levels):
+        if self.merge == 'max':
+            return max(levels)
+        if self.merge == 'mean':
+            levels = [level for level in levels if level]
+            return sum(levels) / len(levels) if levels else 0.0
+        return sum(levels)
+
+    def samples(self, values=None):
+        for labels, value in (self.read() if values is None else values).items():
+            yield self.name, labels, (), value
+
+
+def format_metric_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry:
+    """In-process Prometheus metrics served at /metrics
+
+    Counters and histograms are only updated from the event loop thread,
+    so they are plain dicts with no locking on the request path. Under
+    run_workers each worker also publishes its growth to SharedCounters
+    every `shared_publish_interval` and before rendering, and render()
+    reports the totals over all workers.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.metrics = []
+        self.shared = None
+        self._published = {}
+
+    def counter(self, name, help_text, labels):
+        return self._register(Counter(self.prefix + name, help_text, labels))
+
+    def histogram(self, name, help_text, labels, buckets):
+        return self._register(Histogram(self.prefix + name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, labels, read, merge='sum'):
+        return self._register(Gauge(self.prefix + name, help_text, labels, read, merge))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def share(self, shared):
+        self.shared = shared
+
+    @staticmethod
+    def _shared_key(kind, index, labels, cell=None):
+        key = f'{kind}|{index}|' + '\x1f'.join(map(str, labels))
+        return key if cell is None else f'{key}|{cell}'
+
+    def publish(self):
+        """Add this process's counter and histogram growth since the last publish; set its gauge levels"""
+        shared = self.shared
+        for index, metric in enumerate(self.metrics):
+            try:
+                if metric.kind == 'gauge':
+                    levels = metric.read()
+                    for labels in self._published.get(index, {}).keys() - levels.keys():
+                        shared.set(self._shared_key('gauge', index, labels), 0.0)
+                    for labels, value in levels.items():
+                        shared.set(self._shared_key('gauge', index, labels), value)
+                    self._published[index] = levels
+                    continue
+                published = self._published.setdefault(index, {})
+                for labels, value in list(metric.values.items()):
+                    before = published.get(labels)
+                    if metric.kind == 'histogram':
+                        for cell, (now, then) in enumerate(zip(value, before or [0] * len(value))):
+                            if now != then:
+                                shared.add(self._shared_key('metric', index, labels, cell), now - then)
+                        published[labels] = list(value)
+                    elif value != before:
+                        shared.add(self._shared_key('metric', index, labels), value - (before or 0))
+                        published[labels] = value
+            except Exception as e:
+                print(f"Error publishing metric {metric.name}: {e}")
+
+    def _merged(self):
+        """{metric index: values} combined over every worker"""
+        merged = {}
+        for kind in ('metric', 'gauge'):
+            for key, columns in self.shared.items(f'{kind}|'):
+                _, index, labels = key.split('|', 2)
+                metric = self.metrics[int(index)]
+                values = merged.setdefault(metric, {})
+                if metric.kind == 'histogram':
+                    labels, cell = labels.rsplit('|', 1)
+                labels = tuple(labels.split('\x1f')) if metric.labels else ()
+                if metric.kind == 'histogram':
+                    values.setdefault(labels, [0] * metric._width)[int(cell)] = sum(columns)
+                elif metric.kind == 'gauge':
+                    values[labels] = metric.combine(columns)
+                else:
+                    values[labels] = sum(columns)
+        return merged
+
+    def render(self):
+        """Prometheus text exposition format (0.0.4)"""
+        merged = None
+        if self.shared is not None:
+            self.publish()
+            merged = self._merged()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            try:
+                samples = list(metric.samples() if merged is None else metric.samples(merged.get(metric, {})))
+            except Exception as e:
+                print(f"Error collecting metric {metric.name}: {e}")
+                continue
+            for name, labels, extra, value in samples:
+                pairs = [f'{k}="{escape_label(v)}"' for k, v in zip(metric.labels, labels)]
+                if extra:
+                    pairs.append(f'{extra[0]}="{extra[1]}"')
+                label_text = '{' + ','.join(pairs) + '}' if pairs else ''
+                lines.append(f'{name}{label_text} {format_metric_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def metric_model(model):
+    """Model label for metrics: the pricing family, so arbitrary model strings can't explode cardinality"""
+    try:
+        return _metric_models[model]
+    except (KeyError, TypeError):
+        pass
+    price = pricing.resolve(model) if isinstance(model, str) else None
+    family = price.family if price else 'other'
+    if isinstance(model, str):
+        if len(_metric_models) >= PricingTable.MAX_MEMO:
+            _metric_models.clear()
+        _metric_models[model] = family
+    return family
+
+
+_metric_models = {}
+
+
+prometheus = MetricsRegistry('claude_proxy_')
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+TOKENS_BUCKETS = (10, 100, 500, 1000, 5000, 10000, 50000, 100000, 200000, 500000)
+
+REQUESTS = prometheus.counter(
+    'requests_total', 'Messages API requests by response status', ('developer', 'model', 'status'))
+REQUEST_BYTES = prometheus.histogram(
+    'request_bytes', 'Request body size', ('developer', 'model'), BYTES_BUCKETS)
+RESPONSE_BYTES = prometheus.histogram(
+    'response_bytes', 'Upstream response body size relayed to the client', ('developer', 'model'), BYTES_BUCKETS)
+ADMISSION_WAIT = prometheus.histogram(
+    'admission_wait_seconds', 'Time spent queued by admission control', ('developer',), SECONDS_BUCKETS)
+UPSTREAM_TTFB = prometheus.histogram(
+    'upstream_ttfb_seconds', 'Upstream time to first byte (first SSE chunk when streaming)',
+    ('developer', 'model'), SECONDS_BUCKETS)
+UPSTREAM_LATENCY = prometheus.histogram(
+    'upstream_latency_seconds', 'Upstream call duration to the last byte', ('developer', 'model'), SECONDS_BUCKETS)
+REQUEST_DURATION = prometheus.histogram(
+    'request_duration_seconds', 'Completed calls from arrival to last byte, by where they were served from',
+    ('developer', 'model', 'source'), SECONDS_BUCKETS)
+# The _sum series is the running token total, so there is no separate tokens counter
+TOKENS = prometheus.histogram(
+    'request_tokens', 'Billed tokens per upstream call', ('developer', 'model', 'type'), TOKENS_BUCKETS)
+COST = prometheus.counter(
+    'cost_usd_total', 'Billed cost in USD', ('developer', 'model'))
+RETRIES = prometheus.counter(
+    'upstream_retries_total', 'Upstream calls retried, by the status (or "network") that failed', ('reason',))
+HEDGES = prometheus.counter(
+    'upstream_hedges_total', 'Hedged upstream calls by which attempt answered first', ('outcome',))
+MODEL_ROUTING = prometheus.counter(
+    'model_routing_requests_total', 'Requests by model routing class, and the model family they were sent to',
+    ('model', 'class', 'routed_model'))
+PROMPT_CACHE_SAVED = prometheus.counter(
+    'prompt_cache_saved_usd_total', 'Net USD saved by prompt cache reads, less the write premium', ('developer',))
+TIME_TO_FIRST_TOKEN = prometheus.histogram(
+    'time_to_first_token_seconds', 'Streaming seconds from upstream call to first byte, by prompt cache outcome',
+    ('developer', 'prompt_cache'), SECONDS_BUCKETS)
+BACKEND_CALLS = prometheus.counter(
+    'upstream_calls_total', 'Upstream calls by backend and status (or "network")', ('backend', 'status'))
+
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+
+class RequestTrace:
+    """Phase timings for one proxied request
+
+    mark(name) closes a phase that started at the previous mark, so the
+    phases tile the request with one perf_counter read each. A W3C
+    traceparent from the client is continued; otherwise a new trace starts,
+    sampled at `sample_rate`. Phases become the Server-Timing header, the
+    slow-request log and, when exported, OpenTelemetry child spans.
+    """
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'sampled', 'start_ns', 'start', 'end',
+                 'phases', 'upstream_span_id', 'attributes', 'capture', '_mark')
+
+    def __init__(self, traceparent=None, sample_rate=1.0):
+        match = TRACEPARENT.match(traceparent.strip().lower()) if traceparent else None
+        if match and match.group(1) != '0' * 32 and match.group(2) != '0' * 16:
+            self.trace_id, self.parent_id = match.group(1), match.group(2)
+            self.sampled = bool(int(match.group(3), 16) & 1)
+        else:
+            self.trace_id, self.parent_id = f'{random.getrandbits(128):032x}', None
+            self.sampled = random.random() < sample_rate
+        self.span_id = new_span_id()
+        self.upstream_span_id = None
+        self.start_ns = time.time_ns()
+        self.start = self._mark = time.perf_counter()
+        self.end = None
+        self.phases = []
+        self.attributes = {}
+        # Shape and timing fields for TrafficCapture, when this request is captured
+        self.capture = None
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, self._mark - self.start, now - self._mark))
+        self._mark = now
+
+    def upstream_traceparent(self):
+        """traceparent for the upstream call, parented on the 'upstream' phase span"""
+        self.upstream_span_id = new_span_id()
+        return f'00-{self.trace_id}-{self.upstream_span_id}-{"01" if self.sampled else "00"}'
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    def elapsed(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def server_timing(self):
+        """Server-Timing header value for the phases so far, in milliseconds"""
+        timings = [f'{name};dur={duration * 1000:.1f}' for name, _, duration in self.phases]
+        timings.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(timings)
+
+    def breakdown(self):
+        return {name: round(duration, 4) for name, _, duration in self.phases}
+
+    def spans(self):
+        """OTLP/JSON spans: the request as a server span, each phase as a child"""
+        end_ns = self.start_ns + int(self.elapsed() * 1e9)
+        root = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': 'POST /v1/messages',
+            'kind': 2,  # SERVER
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(end_ns),
+            'attributes': otlp_attributes(self.attributes),
+        }
+        if self.parent_id:
+            root['parentSpanId'] = self.parent_id
+        status = self.attributes.get('http.response.status_code', 0)
+        if status >= 500:
+            root['status'] = {'code': 2}  # ERROR
+        spans = [root]
+        for name, offset, duration in self.phases:
+            start_ns = self.start_ns + int(offset * 1e9)
+            upstream = name == 'upstream' and self.upstream_span_id
+            spans.append({
+                'traceId': self.trace_id,
+                'spanId': self.upstream_span_id if upstream else new_span_id(),
+                'parentSpanId': self.span_id,
+                'name': name,
+                'kind': 3 if upstream else 1,  # CLIENT / INTERNAL
+                'startTimeUnixNano': str(start_ns),
+                'endTimeUnixNano': str(start_ns + int(duration * 1e9)),
+            })
+        return spans
+
+
+def new_span_id():
+    return f'{random.getrandbits(64) or 1:016x}'
+
+
+def otlp_attributes(attributes):
+    values = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            values.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            values.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            values.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            values.append({'key': key, 'value': {'stringValue': str(value)}})
+    return values
+
+
+class SpanExporter:
+    """Ship finished request traces as OTLP/JSON from a background thread
+
+    `target` is either an http(s) URL of an OTLP/HTTP receiver (for a local
+    collector, http://localhost:4318/v1/traces) or a file path that gets one
+    ExportTraceServiceRequest per line, the collector's file exporter format.
+    Traces are dropped rather than waited for when the queue is full.
+    """
+
+    MAX_BATCH_SPANS = 2048
+
+    def __init__(self, target, flush_interval=5.0, max_queue=10_000):
+        self.target = target
+        self.flush_interval = flush_interval
+        self.queue = TelemetryQueue(max_queue, 'drop_newest')
+        self.stats = {'batches': 0, 'spans_sent': 0, 'errors': 0}
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.target)
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+        self._thread.start()
+
+    def submit(self, trace):
+        self.queue.put(trace)
+
+    def close(self, timeout=10.0):
+        if self._thread is None:
+            return
+        self.queue.close()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        spans = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                trace = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                trace = ()
+            if trace is None:
+                break
+            if trace:
+                spans.extend(trace.spans())
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if spans and (len(spans) >= self.MAX_BATCH_SPANS or time.monotonic() >= deadline):
+                self._export(spans)
+                spans, deadline = [], None
+
+        if spans:
+            self._export(spans)
+
+    def _export(self, spans):
+        body = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': otlp_attributes({'service.name': 'claude-proxy', 'project': PROJECT_NAME})},
+            'scopeSpans': [{'scope': {'name': 'claude-proxy'}, 'spans': spans}],
+        }]}, separators=(',', ':'))
+        try:
+            if self.target.startswith(('http://', 'https://')):
+                request = urllib.request.Request(
+                    self.target, data=body.encode(), headers={'content-type': 'application/json'}, method='POST',
+                )
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    response.read()
+            else:
+                with open(self.target, 'a') as f:
+                    f.write(body + '\n')
+            self.stats['batches'] += 1
+            self.stats['spans_sent'] += len(spans)
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"Error exporting trace spans: {e}")
+
+
+span_exporter = SpanExporter(CONFIG['trace_export'], flush_interval=CONFIG['trace_flush_interval'])
+SLOW_REQUEST_STATS = {'logged': 0, 'skipped': 0}
+
+
+class TrafficCapture:
+    """Append anonymised request shapes and timings to a JSON lines file for replay
+
+    A record holds sizes, counts, flags, the model, token usage and
+    timings, never prompt or response content. Developers become a salted
+    hash that is stable for the life of the launch (across pre-forked
+    workers too), so per-developer patterns survive without names. Records
+    are written from a background thread, one O_APPEND write per batch so
+    workers can share the file, and dropped when the queue is full.
+    proxy-bench.py replay drives the proxy from such a file.
+    """
+
+    MAX_BATCH = 1000
+    MAX_DEVELOPERS = 10_000
+
+    def __init__(self, path, sample_rate=1.0, salt='', flush_interval=1.0, max_queue=10_000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.salt = salt.encode()[:64] or os.urandom(16)
+        self.flush_interval = flush_interval
+        self.queue = TelemetryQueue(max_queue, 'drop_newest')
+        self.stats = {'records': 0, 'writes': 0, 'errors': 0}
+        self._developers = {}
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self._thread is not None
+
+    def start(self):
+        if not self.path:
+            return
+        self._thread = threading.Thread(target=self._run, name='traffic-capture', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=10.0):
+        if self._thread is None:
+            return
+        self.queue.close()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def begin(self, trace):
+        if self._thread is not None and random.random() < self.sample_rate:
+            trace.capture = {}
+
+    def developer_id(self, developer):
+        try:
+            return self._developers[developer]
+        except KeyError:
+            pass
+        digest = hashlib.blake2b(str(developer).encode(), key=self.salt, digest_size=4).hexdigest()
+        if len(self._developers) < self.MAX_DEVELOPERS:
+            self._developers[developer] = digest
+        return digest
+
+    @staticmethod
+    def shape(payload, body):
+        """What replay needs to rebuild a request of the same size and kind"""
+        messages, tools, max_tokens = payload.get('messages'), payload.get('tools'), payload.get('max_tokens')
+        return {
+            'model': str(payload.get('model', ''))[:100],
+            'stream': bool(payload.get('stream')),
+            'request_bytes': len(body),
+            'max_tokens': max_tokens if isinstance(max_tokens, int) else None,
+            'messages': len(messages) if isinstance(messages, list) else 0,
+            'tools': len(tools) if isinstance(tools, list) else 0,
+            'system': bool(payload.get('system')),
+        }
+
+    def submit(self, trace):
+        capture = trace.capture
+        phases = {name for name, _, _ in trace.phases}
+        if 'coalesced' in phases:
+            source = 'coalesced'
+        elif 'upstream' in phases:
+            source = 'upstream'
+        else:
+            # A cache hit, or answered by the proxy itself (auth, budget, rate limit)
+            source = 'cache' if 'cache' in phases and trace.attributes.get('http.response.status_code') == 200 else 'proxy'
+        capture.update(
+            ts=round(trace.start_ns / 1e9, 3),
+            developer=self.developer_id(trace.attributes.get('developer', 'unknown')),
+            status=trace.attributes.get('http.response.status_code'),
+            source=source,
+            duration=round(trace.elapsed(), 4),
+        )
+        self.queue.put(capture)
+
+    def _run(self):
+        lines = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                record = ()
+            if record is None:
+                break
+            if record:
+                lines.append(json.dumps(record, separators=(',', ':')))
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if lines and (len(lines) >= self.MAX_BATCH or time.monotonic() >= deadline):
+                self._write(lines)
+                lines, deadline = [], None
+
+        if lines:
+            self._write(lines)
+
+    def _write(self, lines):
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, ('\n'.join(lines) + '\n').encode())
+            finally:
+                os.close(fd)
+            self.stats['writes'] += 1
+            self.stats['records'] += len(lines)
+        except OSError as e:
+            self.stats['errors'] += 1
+            print(f"Error writing traffic capture: {e}")
+
+
+traffic_capture = TrafficCapture(
+    CONFIG['capture_file'], sample_rate=CONFIG['capture_sample_rate'], salt=CONFIG['capture_salt'],
+)
+
+
+def finish_trace(trace):
+    """Export the trace and log it if it was slow; runs once the response has been sent"""
+    trace.finish()
+    if trace.sampled and span_exporter.enabled:
+        span_exporter.submit(trace)
+    if trace.capture is not None:
+        traffic_capture.submit(trace)
+    threshold = CONFIG['slow_request_seconds']
+    elapsed = trace.elapsed()
+    if threshold and elapsed >= threshold:
+        if random.random() >= CONFIG['slow_request_sample_rate']:
+            SLOW_REQUEST_STATS['skipped'] += 1
+            return
+        SLOW_REQUEST_STATS['logged'] += 1
+        print('Slow request: ' + json.dumps({
+            'trace_id': trace.trace_id,
+            'developer': trace.attributes.get('developer'),
+            'model': trace.attributes.get('model'),
+            'status': trace.attributes.get('http.response.status_code'),
+            'elapsed': round(elapsed, 4),
+            'phases': trace.breakdown(),
+        }))
+
+
+class LogShipper:
+    """Buffer log events in memory and ship them to CloudWatch Logs in batches
+
+    Events are grouped per log stream and flushed when a batch reaches the
+    PutLogEvents limits or has been waiting `flush_interval` seconds. Streams
+    already created are remembered, so create_log_stream runs once per stream.
+    """
+
+    # PutLogEvents limits: 1 MiB per batch (message bytes + 26 per event), 10k events
+    MAX_BATCH_BYTES = 1_048_576
+    MAX_BATCH_EVENTS = 10_000
+    EVENT_OVERHEAD_BYTES = 26
+
+    def __init__(self, client, log_group, flush_interval=5.0, max_queue=10_000, policy='block', block_timeout=1.0):
+        self.client = client
+        self.log_group = log_group
+        self.flush_interval = flush_interval
+        self.queue = TelemetryQueue(max_queue, policy, block_timeout)
+        self.known_streams = set()
+        self.stats = {
+            'batches': 0,
+            'events_sent': 0,
+            'streams_created': 0,
+            'errors': 0,
+        }
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-shipper', daemon=True)
+        self._thread.start()
+
+    async def submit(self, stream_name, timestamp_ms, log_data):
+        """Queue one event (a dict, serialized by the worker) under the queue's full policy"""
+        return await self.queue.put_async((stream_name, timestamp_ms, log_data))
+
+    def close(self, timeout=30.0):
+        """Stop the worker after it has shipped everything already queued"""
+        if self._thread is None:
+            return
+        self.queue.close()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def ship(self, events):
+        """Blocking: batch and send (stream_name, timestamp_ms, message) events directly, bypassing the queue"""
+        buffers = {}
+        for event in events:
+            self._add(buffers, *event)
+        for stream_name, buf in buffers.items():
+            self._flush(stream_name, buf['events'])
+
+    def _run(self):
+        buffers = {}
+        while True:
+            try:
+                item = self.queue.get(timeout=self._time_to_next_flush(buffers))
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                stream_name, timestamp_ms, log_data = item
+                self._add(buffers, stream_name, timestamp_ms, json.dumps(log_data))
+
+            now = time.monotonic()
+            for stream_name in [name for name, buf in buffers.items() if now - buf['started'] >= self.flush_interval]:
+                self._flush(stream_name, buffers.pop(stream_name)['events'])
+
+        # The queue is drained before get() returns None; ship what's buffered
+        for stream_name, buf in buffers.items():
+            self._flush(stream_name, buf['events'])
+
+    def _time_to_next_flush(self, buffers):
+        if not buffers:
+            return None
+        oldest = min(buf['started'] for buf in buffers.values())
+        return max(0.0, oldest + self.flush_interval - time.monotonic())
+
+    def _add(self, buffers, stream_name, timestamp_ms, message):
+        size = len(message.encode('utf-8')) + self.EVENT_OVERHEAD_BYTES
+        buf = buffers.get(stream_name)
+        if buf and (buf['bytes'] + size > self.MAX_BATCH_BYTES or len(buf['events']) >= self.MAX_BATCH_EVENTS):
+            self._flush(stream_name, buffers.pop(stream_name)['events'])
+            buf = None
+        if buf is None:
+            buf = buffers[stream_name] = {'events': [], 'bytes': 0, 'started': time.monotonic()}
+        buf['events'].append({'timestamp': timestamp_ms, 'message': message})
+        buf['bytes'] += size
+
+    def _ensure_stream(self, stream_name):
+        if stream_name in self.known_streams:
+            return
+        try:
+            self.client.create_log_stream(logGroupName=self.log_group, logStreamName=stream_name)
+            self.stats['streams_created'] += 1
+        except self.client.exceptions.ResourceAlreadyExistsException:
+            pass
+        self.known_streams.add(stream_name)
+
+    def _flush(self, stream_name, events):
+        # PutLogEvents requires chronological order within a batch
+        events.sort(key=lambda event: event['timestamp'])
+        try:
+            self._ensure_stream(stream_name)
+            try:
+                self.client.put_log_events(logGroupName=self.log_group, logStreamName=stream_name, logEvents=events)
+            except self.client.exceptions.ResourceNotFoundException:
+                # Stream was deleted behind our back; recreate it once
+                self.known_streams.discard(stream_name)
+                self._ensure_stream(stream_name)
+                self.client.put_log_events(logGroupName=self.log_group, logStreamName=stream_name, logEvents=events)
+            self.stats['batches'] += 1
+            self.stats['events_sent'] += len(events)
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"Error logging to CloudWatch: {e}")
+
+
+log_shipper = LogShipper(
+    logs_client,
+    LOG_GROUP,
+    flush_interval=CONFIG['log_flush_interval'],
+    max_queue=CONFIG['log_queue_size'],
+    policy=CONFIG['log_queue_policy'],
+    block_timeout=CONFIG['log_queue_block_timeout'],
+)
+
+
+async def log_to_cloudwatch(log_data):
+    """Queue a log event for the background CloudWatch Logs shipper"""
+    if not CONFIG['cloudwatch_enabled']:
+        return
+    stream_name = f"{log_data['developer']}/{datetime.now().strftime('%Y/%m/%d')}"
+    await log_shipper.submit(stream_name, int(time.time() * 1000), log_data)
+
+
+class MetricsAggregator:
+    """Roll up per-request usage into CloudWatch statistic sets
+
+    Each flush sends one SampleCount/Sum/Minimum/Maximum datum per metric and
+    (Developer, Model) pair instead of one datapoint per request, so Sum over
+    any window is unchanged while put_metric_data runs once per interval.
+    """
+
+    NAMESPACE = 'CodeServer/ClaudeAPI'
+    # put_metric_data accepts at most 1000 MetricDatum per call
+    MAX_DATUMS_PER_CALL = 1000
+
+    def __init__(self, client, project, flush_interval=60.0):
+        self.client = client
+        self.project = project
+        self.flush_interval = flush_interval
+        self.stats = {'recorded': 0, 'flushes': 0, 'api_calls': 0, 'errors': 0}
+        self._series = {}
+        self._dimensions = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics-aggregator', daemon=True)
+        self._thread.start()
+
+    def record(self, developer, model, input_tokens, output_tokens, cost):
+        with self._lock:
+            self._add(('InputTokens', developer, model), input_tokens, 1)
+            self._add(('OutputTokens', developer, model), output_tokens, 1)
+            self._add(('TotalCost', developer, model), cost, 1)
+            # APICall has always been published without the Model dimension
+            self._add(('APICall', developer, None), 1, 1)
+            self.stats['recorded'] += 1
+
+    def close(self, timeout=30.0):
+        """Stop the worker after a final flush"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _add(self, key, value, count, minimum=None, maximum=None):
+        # Series values are [SampleCount, Sum, Minimum, Maximum]
+        series = self._series.get(key)
+        minimum = value if minimum is None else minimum
+        maximum = value if maximum is None else maximum
+        if series is None:
+            self._series[key] = [count, value, minimum, maximum]
+        else:
+            series[0] += count
+            series[1] += value
+            series[2] = min(series[2], minimum)
+            series[3] = max(series[3], maximum)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def _dimensions_for(self, developer, model):
+        key = (developer, model)
+        dimensions = self._dimensions.get(key)
+        if dimensions is None:
+            dimensions = [{'Name': 'Developer', 'Value': developer}]
+            if model is not None:
+                dimensions.append({'Name': 'Model', 'Value': model})
+            dimensions.append({'Name': 'Project', 'Value': self.project})
+            self._dimensions[key] = dimensions
+        return dimensions
+
+    def flush(self, timestamp=None):
+        datums = self.drain(timestamp)
+        if datums:
+            self.stats['flushes'] += 1
+            self.send(datums)
+
+    def drain(self, timestamp=None):
+        """Take everything recorded so far as MetricDatum dicts stamped `timestamp` (default now)"""
+        with self._lock:
+            series, self._series = self._series, {}
+        timestamp = timestamp or datetime.utcnow()
+        return [
+            {
+                'MetricName': metric,
+                'Dimensions': self._dimensions_for(developer, model),
+                'StatisticValues': {'SampleCount': count, 'Sum': total, 'Minimum': minimum, 'Maximum': maximum},
+                'Unit': 'None' if metric == 'TotalCost' else 'Count',
+                'Timestamp': timestamp,
+            }
+            for (metric, developer, model), (count, total, minimum, maximum) in series.items()
+        ]
+
+    def send(self, datums):
+        for i in range(0, len(datums), self.MAX_DATUMS_PER_CALL):
+            batch = datums[i:i + self.MAX_DATUMS_PER_CALL]
+            try:
+                self.client.put_metric_data(Namespace=self.NAMESPACE, MetricData=batch)
+                self.stats['api_calls'] += 1
+            except Exception as e:
+                self.stats['errors'] += 1
+                print(f"Error sending metrics: {e}")
+                # Fold the unsent statistics back in so the next flush retries them
+                with self._lock:
+                    for datum in batch:
+                        dims = {d['Name']: d['Value'] for d in datum['Dimensions']}
+                        values = datum['StatisticValues']
+                        self._add(
+                            (datum['MetricName'], dims['Developer'], dims.get('Model')),
+                            values['Sum'], values['SampleCount'], values['Minimum'], values['Maximum'],
+                        )
+
+
+metrics_aggregator = MetricsAggregator(cloudwatch, PROJECT_NAME, flush_interval=CONFIG['metrics_flush_interval'])
+
+
+def send_metrics_to_cloudwatch(developer, model, input_tokens, output_tokens, cost):
+    """Add a request's usage to the next aggregated CloudWatch metrics flush"""
+    if not CONFIG['cloudwatch_enabled']:
+        return
+    metrics_aggregator.record(developer, model, input_tokens, output_tokens, cost)
+
+
+# One completed call, as logged to CloudWatch and written to the usage journal
+UsageRecord = collections.namedtuple('UsageRecord', [
+    'timestamp', 'developer', 'model', 'input_tokens', 'output_tokens', 'cache_read_tokens',
+    'cache_write_tokens', 'cost', 'saved_cost', 'elapsed', 'source', 'followers', 'cost_known', 'requested_model',
+    'batch',
+], defaults=(None, False))
+
+
+def usage_log_data(record):
+    """The CloudWatch Logs event for a usage record"""
+    log_data = {
+        'timestamp': datetime.utcfromtimestamp(record.timestamp).isoformat(),
+        'developer': record.developer,
+        'model': record.model,
+        'input_tokens': record.input_tokens,
+        'output_tokens': record.output_tokens,
+        'total_tokens': record.input_tokens + record.output_tokens,
+        'cost_usd': round(record.cost, 6),
+        'response_time_seconds': round(record.elapsed, 2),
+        'status': 'success'
+    }
+    if record.cache_read_tokens or record.cache_write_tokens:
+        log_data['cache_read_tokens'] = record.cache_read_tokens
+        log_data['cache_write_tokens'] = record.cache_write_tokens
+        log_data['prompt_cache_saved_usd'] = round(
+            prompt_cache_savings(record.model, record.cache_read_tokens, record.cache_write_tokens), 6)
+    if not record.cost_known:
+        log_data['cost_unknown'] = True
+    if record.requested_model:
+        log_data['requested_model'] = record.requested_model
+    if record.batch:
+        log_data['batch'] = True
+    if record.source == 'cache':
+        log_data['cache_hit'] = True
+        log_data['saved_cost_usd'] = round(record.saved_cost, 6)
+    elif record.source == 'coalesced':
+        log_data['coalesced'] = True
+    if record.followers:
+        log_data['coalesced_followers'] = record.followers
+    return log_data
+
+
+class UsageJournal:
+    """Append-only local journal of usage records in compact binary segments
+
+    append() only queues the record; a writer thread encodes everything queued
+    every `commit_interval` seconds, writes it in one call and fsyncs once (group
+    commit), so a crash loses at most one interval. Segments rotate at
+    `segment_bytes` and are named by creation time in ms.
+
+    A segment is a header (magic, version, created) followed by tagged entries:
+    b'D'/b'M' define a developer/model string for a u16 id, b'U' is a fixed
+    width usage record referring to those ids. Ids are interned per segment so
+    any segment decodes on its own, and a torn final entry is simply ignored.
+    usage-report.py decodes the same layout; bump VERSION if it changes.
+    """
+
+    MAGIC = b'CPUJ'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBd')
+    STRING = struct.Struct('<cHH')
+    # timestamp, dev id, model id, input, output, cache read, cache write, cost, saved cost, latency, flags, followers
+    RECORD = struct.Struct('<cdHHIIIIddfBH')
+    SOURCES = ('upstream', 'cache', 'coalesced')
+    FLAG_BATCH = 0x40
+    FLAG_COST_UNKNOWN = 0x80
+    MAX_IDS = 0xFFFF
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, commit_interval=0.05, retention_days=90):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.commit_interval = commit_interval
+        self.retention_days = retention_days
+        self.stats = {'appended': 0, 'committed': 0, 'commits': 0, 'bytes_written': 0, 'segments': 0, 'errors': 0, 'lost': 0}
+        self._pending = []
+        self._lock = threading.Lock()
+        # Held for a whole commit so an explicit commit() can't interleave with the writer's
+        self._commit_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+        self._size = 0
+        self._developers = {}
+        self._models = {}
+
+    @property
+    def enabled(self):
+        return self._thread is not None
+
+    def start(self):
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._rotate()
+        except OSError as e:
+            print(f"Error opening usage journal in {self.directory}, journaling disabled: {e}")
+            return
+        self._thread = threading.Thread(target=self._run, name='usage-journal', daemon=True)
+        self._thread.start()
+
+    def append(self, record):
+        if self._thread is None:
+            return
+        with self._lock:
+            self._pending.append(record)
+        self.stats['appended'] += 1
+
+    def close(self, timeout=30.0):
+        """Stop the writer after committing everything already appended"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        while not self._stop.wait(self.commit_interval):
+            self.commit()
+        self.commit()
+
+    def commit(self):
+        with self._commit_lock:
+            self._commit()
+
+    def _commit(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            chunks, size = [], self._size
+            for record in batch:
+                if size >= self.segment_bytes or len(self._developers) >= self.MAX_IDS or len(self._models) >= self.MAX_IDS:
+                    self._write(chunks)
+                    chunks = []
+                    self._rotate()
+                    size = self._size
+                data = self._encode(record)
+                chunks.append(data)
+                size += len(data)
+            self._write(chunks)
+            os.fsync(self._file.fileno())
+            self.stats['commits'] += 1
+            self.stats['committed'] += len(batch)
+        except (OSError, ValueError) as e:
+            self.stats['errors'] += 1
+            self.stats['lost'] += len(batch)
+            print(f"Error writing usage journal: {e}")
+            # Start a fresh segment rather than appending after a partial write
+            with contextlib.suppress(OSError):
+                self._rotate()
+
+    def _write(self, chunks):
+        data = b''.join(chunks)
+        self._file.write(data)
+        self._size += len(data)
+        self.stats['bytes_written'] += len(data)
+
+    def _intern(self, table, tag, value, out):
+        string_id = table.get(value)
+        if string_id is None:
+            string_id = table[value] = len(table)
+            encoded = value.encode('utf-8')[:0xFFFF]
+            out.append(self.STRING.pack(tag, string_id, len(encoded)) + encoded)
+        return string_id
+
+    def _encode(self, record):
+        out = []
+        developer_id = self._intern(self._developers, b'D', record.developer, out)
+        model_id = self._intern(self._models, b'M', record.model or 'unknown', out)
+        flags = self.SOURCES.index(record.source) | (0 if record.cost_known else self.FLAG_COST_UNKNOWN)
+        if record.batch:
+            flags |= self.FLAG_BATCH
+        out.append(self.RECORD.pack(
+            b'U', record.timestamp, developer_id, model_id,
+            record.input_tokens, record.output_tokens, record.cache_read_tokens, record.cache_write_tokens,
+            record.cost, record.saved_cost, record.elapsed, flags, min(record.followers, 0xFFFF),
+        ))
+        return b''.join(out) if len(out) > 1 else out[0]
+
+    def _rotate(self):
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+        now = time.time()
+        path = os.path.join(self.directory, f'usage-{int(now * 1000):013d}.journal')
+        while os.path.exists(path):
+            now += 0.001
+            path = os.path.join(self.directory, f'usage-{int(now * 1000):013d}.journal')
+        self._file = open(path, 'ab', buffering=0)
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, now)
+        self._file.write(header)
+        self._size = len(header)
+        self._developers = {}
+        self._models = {}
+        self.stats['segments'] += 1
+        self._prune()
+
+    def _prune(self):
+        if not self.retention_days:
+            return
+        cutoff_ms = (time.time() - self.retention_days * 86400) * 1000
+        for name in self.segment_names(self.directory):
+            if self.segment_start_ms(name) < cutoff_ms:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.directory, name))
+
+    @staticmethod
+    def segment_names(directory):
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        return sorted(name for name in names if name.startswith('usage-') and name.endswith('.journal'))
+
+    @staticmethod
+    def segment_start_ms(name):
+        return int(name[len('usage-'):-len('.journal')])
+
+    @classmethod
+    def read_segment(cls, path):
+        """Yield the UsageRecords in one segment file, stopping at a torn or corrupt tail"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not cls.valid_header(data, path):
+            return
+        for record, _ in cls.scan(data, cls.HEADER.size, {b'D': {}, b'M': {}}):
+            yield record
+
+    @classmethod
+    def valid_header(cls, data, path):
+        if len(data) < cls.HEADER.size:
+            return False
+        magic, version, _ = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            print(f"Error reading usage journal {path}: not a version {cls.VERSION} segment")
+            return False
+        return True
+
+    @classmethod
+    def scan(cls, data, pos, strings):
+        """Yield (record, offset just past it) for each complete record in data[pos:]
+
+        `strings` maps b'D'/b'M' to {id: name} for the segment and is filled in
+        place, so a later scan can resume from the last offset yielded.
+        """
+        record_size, string_size = cls.RECORD.size, cls.STRING.size
+        unpack_record, unpack_string = cls.RECORD.unpack_from, cls.STRING.unpack_from
+        end = len(data)
+        sources = cls.SOURCES
+        while pos < end:
+            tag = data[pos:pos + 1]
+            if tag == b'U':
+                if pos + record_size > end:
+                    return
+                (_, timestamp, developer_id, model_id, input_tokens, output_tokens, cache_read, cache_write,
+                 cost, saved_cost, elapsed, flags, followers) = unpack_record(data, pos)
+                pos += record_size
+                try:
+                    developer, model = strings[b'D'][developer_id], strings[b'M'][model_id]
+                except KeyError:
+                    return
+                yield UsageRecord(
+                    timestamp, developer, model, input_tokens, output_tokens, cache_read, cache_write,
+                    cost, saved_cost, elapsed, sources[flags & 0x03], followers,
+                    not flags & cls.FLAG_COST_UNKNOWN, None, bool(flags & cls.FLAG_BATCH),
+                ), pos
+            elif tag in strings:
+                if pos + string_size > end:
+                    return
+                _, string_id, length = unpack_string(data, pos)
+                pos += string_size
+                if pos + length > end:
+                    return
+                strings[tag][string_id] = data[pos:pos + length].decode('utf-8', 'replace')
+                pos += length
+            else:
+                return
+
+    def read(self, since=0.0, until=None):
+        """Yield journaled records with since <= timestamp < until, oldest segment first"""
+        names = self.segment_names(self.directory)
+        for i, name in enumerate(names):
+            # Skip segments that were rotated out before the window starts. There is no such
+            # cutoff at `until`: a record is stamped when it is queued and written by a later group
+            # commit, so a segment created after `until` can still hold records from before it
+            if i + 1 < len(names) and self.segment_start_ms(names[i + 1]) / 1000 < since:
+                continue
+            try:
+                for record in self.read_segment(os.path.join(self.directory, name)):
+                    if record.timestamp >= since and (until is None or record.timestamp < until):
+                        yield record
+            except OSError as e:
+                print(f"Error reading usage journal {name}: {e}")
+
+
+usage_journal = UsageJournal(
+    CONFIG['journal_dir'],
+    segment_bytes=CONFIG['journal_segment_mb'] * 1024 * 1024,
+    commit_interval=CONFIG['journal_commit_interval'],
+    retention_days=CONFIG['journal_retention_days'],
+)
+
+
+def journals():
+    """The usage journal plus the per-worker journals run_workers() keeps under the same directory"""
+    found = [usage_journal]
+    base = CONFIG['journal_dir']
+    try:
+        names = sorted(name for name in os.listdir(base) if name.startswith('worker-')) if base else []
+    except OSError:
+        names = []
+    for name in names:
+        directory = os.path.join(base, name)
+        if directory != usage_journal.directory and os.path.isdir(directory):
+            found.append(UsageJournal(directory))
+    return found
+
+
+def replay_journal_to_cloudwatch(since, until=None, logs=True, metrics=True):
+    """Blocking: re-send journaled usage in [since, until) to CloudWatch with the original timestamps
+
+    Meant for after an outage; records that already reached CloudWatch are
+    sent again, so pick the window to match the outage.
+    """
+    replayed = 0
+    log_events, datums = [], []
+    aggregator = MetricsAggregator(cloudwatch, PROJECT_NAME)
+    minute = None
+    for record in (record for journal in journals() for record in journal.read(since, until)):
+        replayed += 1
+        if logs:
+            stream_name = f"{record.developer}/{datetime.fromtimestamp(record.timestamp).strftime('%Y/%m/%d')}"
+            log_events.append((stream_name, int(record.timestamp * 1000), json.dumps(usage_log_data(record))))
+        if metrics:
+            # One statistic set per minute keeps the replayed series at their original resolution
+            record_minute = record.timestamp - record.timestamp % 60
+            if record_minute != minute:
+                if minute is not None:
+                    datums.extend(aggregator.drain(datetime.utcfromtimestamp(minute)))
+                minute = record_minute
+            aggregator.record(record.developer, record.model, record.input_tokens, record.output_tokens, record.cost)
+    if minute is not None:
+        datums.extend(aggregator.drain(datetime.utcfromtimestamp(minute)))
+    if datums:
+        aggregator.send(datums)
+    shipper = LogShipper(logs_client, LOG_GROUP)
+    if log_events:
+        shipper.ship(log_events)
+    return {
+        'records': replayed,
+        'log_events_sent': shipper.stats['events_sent'],
+        'log_errors': shipper.stats['errors'],
+        'metric_api_calls': aggregator.stats['api_calls'],
+        'metric_errors': aggregator.stats['errors'],
+    }
+
+
+def month_start(timestamp):
+    """Epoch seconds of the first instant of the UTC month containing `timestamp`"""
+    t = time.gmtime(timestamp)
+    return calendar.timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0))
+
+
+def next_month_start(timestamp):
+    t = time.gmtime(timestamp)
+    year, month = (t.tm_year + 1, 1) if t.tm_mon == 12 else (t.tm_year, t.tm_mon + 1)
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+class RollupStore:
+    """Hourly, daily and monthly usage totals per (developer, model) in SQLite
+
+    update() tails the usage journal from a cursor stored per journal
+    directory, so workers rolling up their own journals share one database.
+    Each batch is summed into all three grains and upserted in the same
+    transaction that advances the cursor, so a crash or re-run never counts
+    a record twice.
+    query() splits a window into the fewest whole months, days and hours
+    that cover it, so it reads at most a few hundred rows per developer and
+    model however much history is stored. Windows are UTC, rounded out to
+    whole hours.
+    """
+
+    GRAINS = ('hour', 'day', 'month')
+    MEASURES = ('calls', 'input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens', 'cost', 'saved_cost')
+    MAX_BATCH = 100_000
+
+    def __init__(self, path, journal):
+        self.path = path
+        self.journal = journal
+        self.stats = {'updates': 0, 'records': 0, 'errors': 0}
+        self._db = None
+        # (segment, offset, strings) of the journal position already rolled up
+        self._tail = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._db is not None or not self.path:
+            return self._db
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Workers under run_workers write to the same database; wait out each other's transactions
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(f"""
+            CREATE TABLE IF NOT EXISTS rollup (
+                grain TEXT NOT NULL, start INTEGER NOT NULL, developer TEXT NOT NULL, model TEXT NOT NULL,
+                {', '.join(f'{m} REAL NOT NULL DEFAULT 0' for m in self.MEASURES)},
+                PRIMARY KEY (grain, start, developer, model)
+            ) WITHOUT ROWID
+        """)
+        db.execute('CREATE TABLE IF NOT EXISTS journal_cursor (journal TEXT PRIMARY KEY, segment TEXT, offset INTEGER)')
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cursor'").fetchone():
+            # The single cursor from before per-worker journals belongs to this journal
+            db.execute('INSERT OR IGNORE INTO journal_cursor SELECT ?, segment, offset FROM cursor',
+                       (self.journal.directory,))
+            db.execute('DROP TABLE cursor')
+        db.commit()
+        self._db = db
+        return db
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def update(self):
+        """Blocking: roll up everything journaled since the last update; returns records added"""
+        with self._lock:
+            try:
+                db = self.open()
+                if db is None:
+                    return 0
+                added = 0
+                while True:
+                    batch = self._read_batch(db)
+                    if batch is None:
+                        break
+                    records, segment, offset = batch
+                    self._apply(db, records, segment, offset)
+                    added += len(records)
+                self.stats['updates'] += 1
+                self.stats['records'] += added
+                return added
+            except (OSError, sqlite3.Error) as e:
+                self.stats['errors'] += 1
+                self._tail = None
+                print(f"Error updating usage rollups: {e}")
+                return 0
+
+    def rebuild(self):
+        """Blocking: drop all rollups and rebuild them from the journal segments still on disk"""
+        with self._lock:
+            db = self.open()
+            if db is None:
+                return
+            with db:
+                db.execute('DELETE FROM rollup')
+                db.execute('DELETE FROM journal_cursor')
+            self._tail = None
+        return self.update()
+
+    def _read_batch(self, db):
+        """(records, segment, offset) for the next unread stretch of the journal, or None when caught up"""
+        names = self.journal.segment_names(self.journal.directory)
+        while True:
+            row = db.execute('SELECT segment, offset FROM journal_cursor WHERE journal = ?',
+                             (self.journal.directory,)).fetchone()
+            segment, offset = row if row else (None, 0)
+            if segment not in names:
+                # First run, or the cursor's segment was pruned: start at the next one on disk
+                later = [name for name in names if segment is None or name > segment]
+                if not later:
+                    return None
+                segment, offset = later[0], self.journal.HEADER.size
+                self._tail = None
+            path = os.path.join(self.journal.directory, segment)
+
+            if self._tail is None or self._tail[:2] != (segment, offset):
+                # Re-learn the segment's interned strings up to the cursor
+                strings = {b'D': {}, b'M': {}}
+                with open(path, 'rb') as f:
+                    prefix = f.read(offset)
+                if not self.journal.valid_header(prefix, path):
+                    if self._skip_segment(db, names, segment) is None:
+                        return None
+                    continue
+                for _ in self.journal.scan(prefix, self.journal.HEADER.size, strings):
+                    pass
+                self._tail = (segment, offset, strings)
+            strings = self._tail[2]
+
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            records, consumed = [], 0
+            for record, end in self.journal.scan(data, 0, strings):
+                records.append(record)
+                consumed = end
+                if len(records) >= self.MAX_BATCH:
+                    break
+            if records:
+                self._tail = (segment, offset + consumed, strings)
+                return records, segment, offset + consumed
+            # Nothing new here; a finished segment is never appended to again
+            if segment == names[-1]:
+                return None
+            skipped = self._skip_segment(db, names, segment)
+            if skipped is None:
+                return None
+
+    def _skip_segment(self, db, names, segment):
+        later = [name for name in names if name > segment]
+        if not later:
+            return None
+        with db:
+            db.execute('INSERT OR REPLACE INTO journal_cursor (journal, segment, offset) VALUES (?, ?, ?)',
+                       (self.journal.directory, later[0], self.journal.HEADER.size))
+        self._tail = None
+        return ()
+
+    def _apply(self, db, records, segment, offset):
+        # Sum records into hour cells, then merge hours into days and days into months
+        hours = {}
+        for record in records:
+            ts = record.timestamp
+            key = (int(ts - ts % 3600), record.developer, record.model)
+            cell = hours.get(key)
+            if cell is None:
+                hours[key] = [1, record.input_tokens, record.output_tokens, record.cache_read_tokens,
+                              record.cache_write_tokens, record.cost, record.saved_cost]
+            else:
+                cell[0] += 1
+                cell[1] += record.input_tokens
+                cell[2] += record.output_tokens
+                cell[3] += record.cache_read_tokens
+                cell[4] += record.cache_write_tokens
+                cell[5] += record.cost
+                cell[6] += record.saved_cost
+        days = self._merge(hours, lambda hour: hour - hour % 86400)
+        months = self._merge(days, month_start)
+
+        measures = ', '.join(self.MEASURES)
+        sql = (
+            f"INSERT INTO rollup (grain, start, developer, model, {measures}) "
+            f"VALUES (?, ?, ?, ?, {', '.join('?' * len(self.MEASURES))}) "
+            f"ON CONFLICT (grain, start, developer, model) DO UPDATE SET "
+            + ', '.join(f'{m} = {m} + excluded.{m}' for m in self.MEASURES)
+        )
+        with db:
+            for grain, cells in (('hour', hours), ('day', days), ('month', months)):
+                db.executemany(sql, ((grain,) + key + tuple(cell) for key, cell in cells.items()))
+            db.execute('INSERT OR REPLACE INTO journal_cursor (journal, segment, offset) VALUES (?, ?, ?)',
+                       (self.journal.directory, segment, offset))
+
+    @staticmethod
+    def _merge(cells, period_start):
+        merged = {}
+        starts = {}
+        for (start, developer, model), values in cells.items():
+            coarse = starts.get(start)
+            if coarse is None:
+                coarse = starts[start] = period_start(start)
+            key = (coarse, developer, model)
+            cell = merged.get(key)
+            if cell is None:
+                merged[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    cell[i] += value
+        return merged
+
+    @staticmethod
+    def cover(since, until):
+        """[(grain, start, end)] ranges of whole months, days and hours that exactly tile [since, until)"""
+        t = int(since - since % 3600)
+        until = int(math.ceil(until / 3600) * 3600)
+        ranges = []
+        while t < until:
+            if t == month_start(t) and next_month_start(t) <= until:
+                grain, step_end = 'month', next_month_start(t)
+            elif t % 86400 == 0 and t + 86400 <= until:
+                grain, step_end = 'day', t + 86400
+            else:
+                grain, step_end = 'hour', t + 3600
+            if ranges and ranges[-1][0] == grain and ranges[-1][2] == t:
+                ranges[-1] = (grain, ranges[-1][1], step_end)
+            else:
+                ranges.append((grain, t, step_end))
+            t = step_end
+        return ranges
+
+    def query(self, since, until, group_by=('developer', 'model')):
+        """Blocking: summed measures for [since, until) grouped by developer and/or model"""
+        with self._lock:
+            db = self.open()
+            if db is None:
+                return []
+            ranges = self.cover(since, until)
+            if not ranges:
+                return []
+            where = ' OR '.join('(grain = ? AND start >= ? AND start < ?)' for _ in ranges)
+            columns = ', '.join(group_by)
+            rows = db.execute(
+                f"SELECT {columns + ', ' if columns else ''}{', '.join(f'SUM({m})' for m in self.MEASURES)} "
+                f"FROM rollup WHERE {where}" + (f" GROUP BY {columns}" if columns else ''),
+                [value for r in ranges for value in r],
+            ).fetchall()
+        return [dict(zip(group_by + self.MEASURES, row)) for row in rows]
+
+
+rollups = RollupStore(CONFIG['rollup_db'], usage_journal)
+
+
+async def update_rollups():
+    """Periodically fold newly journaled usage into the rollup store"""
+    while True:
+        await asyncio.sleep(CONFIG['rollup_interval'])
+        await run_in_threadpool(rollups.update)
+
+
+def request_fingerprint(request, payload, per_key=False):
+    """Canonical hash of everything that determines the upstream response
+
+    With `per_key`, the caller's API key is part of it too, so an answer is
+    only reused for a key the upstream has already accepted.
+    """
+    anthropic_version = request.headers.get('anthropic-version', '2023-06-01')
+    # Beta flags change the response; their order and spacing don't
+    betas = sorted({beta.strip() for beta in request.headers.get('anthropic-beta', '').split(',')} - {''})
+    key_digest = DeveloperKeyIndex.digest(request.headers.get('x-api-key', '')).hex() if per_key else None
+    canonical = json.dumps([anthropic_version, betas, payload, key_digest], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+CachedResponse = collections.namedtuple(
+    'CachedResponse', ['status', 'headers', 'body', 'model', 'input_tokens', 'output_tokens', 'expires_at']
+)
+
+
+class ResponseCache:
+    """LRU + TTL cache of complete upstream responses
+
+    Memory is capped at `max_bytes` of response bodies; the least recently
+    used entries are evicted first. With `disk_dir` set, entries are also
+    written there so they survive eviction and restarts.
+    """
+
+    def __init__(self, max_bytes, ttl, disk_dir=''):
+        self.max_bytes = max_bytes
+        # One response may not take more than a quarter of the cache
+        self.max_entry_bytes = max_bytes // 4
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at < time.time():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if len(entry.body) > self.max_entry_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = entry
+        self.bytes += len(entry.body)
+        self.stats['stores'] += 1
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        self.bytes -= len(self.entries.pop(key).body)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def read_disk(self, key):
+        """Blocking: load an entry from the disk tier, deleting it if expired"""
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                meta_len = int.from_bytes(f.read(4), 'big')
+                meta = json.loads(f.read(meta_len))
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        entry = CachedResponse(body=body, **meta)
+        if entry.expires_at < time.time():
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            return None
+        return entry
+
+    def write_disk(self, key, entry):
+        """Blocking: persist an entry (length-prefixed JSON metadata + body)"""
+        path = self._disk_path(key)
+        meta = json.dumps({k: v for k, v in entry._asdict().items() if k != 'body'}).encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(len(meta).to_bytes(4, 'big') + meta + entry.body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing response cache entry: {e}")
+
+    def prune_disk(self):
+        """Blocking: delete disk entries whose TTL has passed"""
+        cutoff = time.time() - self.ttl
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                with contextlib.suppress(OSError):
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+
+
+response_cache = None
+if CONFIG['cache_enabled']:
+    response_cache = ResponseCache(CONFIG['cache_max_bytes'], CONFIG['cache_ttl'], CONFIG['cache_dir'])
+
+
+def cache_key_for(request, payload):
+    """Cache key for a request, or None if it must not be served from cache
+
+    Only deterministic requests are cached: temperature 0, or an explicit
+    `x-claude-proxy-cache: 1` header. `x-claude-proxy-cache: 0` always bypasses.
+    Entries are per API key; the key itself is only checked upstream.
+    """
+    if response_cache is None:
+        return None
+    flag = request.headers.get('x-claude-proxy-cache', '').lower()
+    if flag in ('0', 'false', 'no-store'):
+        return None
+    if flag not in ('1', 'true') and payload.get('temperature') != 0:
+        return None
+    return request_fingerprint(request, payload, per_key=True)
+
+
+async def lookup_cached_response(key):
+    """Memory first, then the disk tier (promoting disk hits into memory)"""
+    entry = response_cache.get(key)
+    if entry is None and response_cache.disk_dir:
+        entry = await run_in_threadpool(response_cache.read_disk, key)
+        if entry is not None:
+            response_cache.put(key, entry)
+            response_cache.stats['disk_hits'] += 1
+    response_cache.stats['hits' if entry else 'misses'] += 1
+    return entry
+
+
+def store_cached_response(key, status, headers, body, model, input_tokens, output_tokens):
+    entry = CachedResponse(status, headers, body, model, input_tokens, output_tokens, time.time() + response_cache.ttl)
+    response_cache.put(key, entry)
+    if response_cache.disk_dir and len(body) <= response_cache.max_entry_bytes:
+        spawn(run_in_threadpool(response_cache.write_disk, key, entry))
+
+
+async def prune_cache_dir():
+    """Periodically drop expired entries from the on-disk cache tier"""
+    while True:
+        await run_in_threadpool(response_cache.prune_disk)
+        await asyncio.sleep(300)
+
+
+class BudgetExceeded(Exception):
+    """Request rejected because a hard spending limit has been reached"""
+
+
+class BudgetTracker:
+    """Running daily and monthly spend per developer and for the whole project
+
+    Totals live in memory so checking a request is a few dict lookups; they
+    are checkpointed to `state_file` periodically and on shutdown, and only
+    the current UTC day and month are kept. Hard limits come from the
+    budget_* keys in CONFIG (0 disables a limit); at `budget_soft_ratio` of a
+    limit responses carry a warning header. After share() the totals live in
+    SharedCounters instead, so every worker adds to and checks the same ones.
+    """
+
+    PROJECT = '*'
+
+    def __init__(self, config, state_file):
+        self.config = config
+        self.state_file = state_file
+        self.spent = {}
+        self.shared = None
+        self.checkpointed_at = 0.0
+        self._dirty = False
+        self._current = (0.0, 0.0, None)
+
+    def share(self, shared):
+        """Move the running totals into `shared`"""
+        for period, totals in self.spent.items():
+            for scope, cost in totals.items():
+                shared.add(f'budget|{period}|{scope}', cost)
+        self.shared = shared
+        self.spent = {}
+
+    @staticmethod
+    def periods(now):
+        t = time.gmtime(now)
+        return time.strftime('%Y-%m-%d', t), time.strftime('%Y-%m', t)
+
+    def current_periods(self):
+        """periods(now), formatted once per UTC day rather than per request"""
+        now = time.time()
+        day_start, day_end, periods = self._current
+        if not day_start <= now < day_end:
+            day_start = now - now % 86400
+            periods = self.periods(now)
+            self._current = (day_start, day_start + 86400, periods)
+        return periods
+
+    def add(self, developer, cost, now=None):
+        if cost <= 0:
+            return
+        for period in self.current_periods() if now is None else self.periods(now):
+            if self.shared is not None:
+                for scope in (developer, self.PROJECT):
+                    self.shared.add(f'budget|{period}|{scope}', cost)
+                continue
+            totals = self.spent.setdefault(period, {})
+            for scope in (developer, self.PROJECT):
+                totals[scope] = totals.get(scope, 0.0) + cost
+        self._dirty = True
+
+    def _spent(self, period, scope):
+        if self.shared is not None:
+            return self.shared.total(f'budget|{period}|{scope}')
+        return self.spent.get(period, {}).get(scope, 0.0)
+
+    def totals(self):
+        """{period: {scope: spent}} for the current day and month"""
+        current = self.periods(time.time())
+        if self.shared is None:
+            return {period: totals for period, totals in self.spent.items() if period in current}
+        spent = {}
+        for key, columns in self.shared.items('budget|'):
+            _, period, scope = key.split('|', 2)
+            if period in current:
+                spent.setdefault(period, {})[scope] = sum(columns)
+        return spent
+
+    def check(self, developer):
+        """('ok' | 'warn' | 'exceeded', message) for a new request from `developer`"""
+        day, month = self.current_periods()
+        config = self.config
+        result = ('ok', '')
+        for period_name, period, scope, limit in (
+            ('daily', day, developer, config['budget_dev_daily_usd']),
+            ('monthly', month, developer, config['budget_dev_monthly_usd']),
+            ('daily', day, self.PROJECT, config['budget_project_daily_usd']),
+            ('monthly', month, self.PROJECT, config['budget_project_monthly_usd']),
+        ):
+            if not limit:
+                continue
+            spent = self._spent(period, scope)
+            if spent >= limit or (spent >= limit * config['budget_soft_ratio'] and result[0] == 'ok'):
+                who = 'project' if scope == self.PROJECT else developer
+                if spent >= limit:
+                    return 'exceeded', f'{who} {period_name} budget of ${limit:.2f} exhausted (${spent:.2f} spent)'
+                result = ('warn', f'{who} {period_name} spend ${spent:.2f} of ${limit:.2f}')
+        return result
+
+    def load(self):
+        """Blocking: restore totals for the current day/month from the checkpoint"""
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        current = self.periods(time.time())
+        self.spent = {period: totals for period, totals in state.get('spent', {}).items() if period in current}
+        self.checkpointed_at = state.get('checkpointed_at', 0.0)
+
+    def snapshot(self):
+        """The state to checkpoint if anything changed (always, when shared), else None
+
+        Call it where add() runs: the copy it returns can then be written in
+        a thread while add() goes on changing the totals.
+        """
+        if not self._dirty and self.shared is None:
+            return None
+        self._dirty = False
+        spent = self.totals()
+        if self.shared is None:
+            # Drops past periods
+            self.spent = spent
+            spent = {period: dict(totals) for period, totals in spent.items()}
+        return {'checkpointed_at': time.time(), 'spent': spent}
+
+    def checkpoint(self, state=None):
+        """Blocking: atomically write `state` from snapshot(), or take one here if nothing else calls add()"""
+        if state is None:
+            state = self.snapshot()
+            if state is None:
+                return
+        try:
+            os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+            # Per process, since a draining worker and the launcher may checkpoint at once
+            tmp_path = f'{self.state_file}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.state_file)
+            self.checkpointed_at = state['checkpointed_at']
+        except OSError as e:
+            self._dirty = True
+            print(f"Error writing budget checkpoint: {e}")
+
+
+budget = BudgetTracker(CONFIG, CONFIG['budget_state_file'])
+
+
+def restore_budget():
+    """Blocking: load the budget checkpoint, then add journaled usage recorded after it"""
+    budget.load()
+    period_start_ts = calendar.timegm(time.strptime(budget.periods(time.time())[1], '%Y-%m'))
+    replayed = 0
+    since = max(budget.checkpointed_at, period_start_ts)
+    for record in (record for journal in journals() for record in journal.read(since=since)):
+        budget.add(record.developer, record.cost, now=record.timestamp)
+        replayed += 1
+    if replayed:
+        print(f"Replayed {replayed} journaled usage records into budgets")
+
+
+async def checkpoint_budget():
+    """Periodically persist running budget totals"""
+    while True:
+        await asyncio.sleep(CONFIG['budget_checkpoint_interval'])
+        state = budget.snapshot()
+        if state is not None:
+            await run_in_threadpool(budget.checkpoint, state)
+
+
+class RateLimited(Exception):
+    """Request rejected by admission control"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` per second, holding up to `burst`"""
+
+    def __init__(self):
+        self.rate = 0.0
+        self.burst = 0.0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def configure(self, rate, burst):
+        if self.burst == 0:
+            self.tokens = burst  # A new bucket starts full
+        self.rate, self.burst = rate, burst
+        self.tokens = min(self.tokens, burst)
+
+    def delay(self, amount, now):
+        """Seconds until `amount` tokens are available; 0 if they are now"""
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # A request larger than the burst waits for a full bucket rather than forever
+        amount = min(amount, self.burst)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        if self.rate > 0:
+            self.tokens -= min(amount, self.burst)
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket whose level lives in SharedCounters as (tokens, updated, burst)
+
+    Every worker draws from the same bucket; callers hold the shared lock.
+    """
+
+    def __init__(self, shared, key):
+        super().__init__()
+        self.shared = shared
+        self.key = key
+
+    def configure(self, rate, burst):
+        tokens, updated, known_burst = self.shared.get(self.key)[:3]
+        if known_burst == 0:
+            tokens, updated = burst, time.monotonic()  # A new bucket starts full
+        self.rate, self.burst = rate, burst
+        self.shared.put(self.key, (min(tokens, burst), updated, burst))
+
+    def delay(self, amount, now):
+        if self.rate <= 0:
+            return 0.0
+        tokens, updated, _ = self.shared.get(self.key)[:3]
+        # Another worker may already have refilled it as of a later `now`
+        tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+        self.shared.put(self.key, (tokens, max(now, updated), self.burst))
+        amount = min(amount, self.burst)
+        return 0.0 if tokens >= amount else (amount - tokens) / self.rate
+
+    def take(self, amount):
+        if self.rate > 0:
+            tokens, updated, burst = self.shared.get(self.key)[:3]
+            self.shared.put(self.key, (tokens - min(amount, self.burst), updated, burst))
+
+
+class Permit:
+    """An admitted request's in-flight slot; release() is idempotent"""
+
+    def __init__(self, controller, developer):
+        self._controller = controller
+        self.developer = developer
+
+    def release(self):
+        controller, self._controller = self._controller, None
+        if controller:
+            controller.release(self.developer)
+
+
+class AdmissionController:
+    """Per-developer and global admission control with fair queueing
+
+    Each scope has a requests/sec bucket, an estimated-tokens/min bucket and
+    a max-in-flight cap, read from CONFIG on every check so limits can be
+    changed at runtime (0 disables a limit). Requests that can't start
+    immediately wait up to `limit_queue_timeout` seconds in a per-developer
+    queue. Queues are served round-robin, so one developer's backlog can't
+    starve the others. Anything still waiting at the deadline gets a 429.
+    """
+
+    GLOBAL = '*'
+    # Seconds between re-checks of requests blocked on an in-flight cap; None when release() wakes them
+    poll_interval = None
+
+    def __init__(self, config):
+        self.config = config
+        self.buckets = {}
+        self.in_flight = collections.Counter()
+        self.waiters = collections.OrderedDict()
+        self.stats = collections.defaultdict(collections.Counter)
+        self._timer = None
+
+    def _limits(self, key):
+        scope = 'global' if key == self.GLOBAL else 'dev'
+        return (
+            self.config[f'limit_{scope}_requests_per_sec'],
+            self.config[f'limit_{scope}_tokens_per_min'],
+            self.config[f'limit_{scope}_max_in_flight'],
+        )
+
+    def _bucket(self, key, kind, rate, burst):
+        bucket = self.buckets.get((key, kind))
+        if bucket is None:
+            bucket = self.buckets[(key, kind)] = self._new_bucket(key, kind)
+        if (bucket.rate, bucket.burst) != (rate, burst):
+            bucket.configure(rate, burst)
+        return bucket
+
+    def _new_bucket(self, key, kind):
+        return TokenBucket()
+
+    def _in_flight(self, key):
+        return self.in_flight[key]
+
+    def _delay(self, developer, tokens, now):
+        """Seconds until this request could start, or None if blocked on an in-flight cap"""
+        delay = 0.0
+        for key in (developer, self.GLOBAL):
+            requests_per_sec, tokens_per_min, max_in_flight = self._limits(key)
+            if max_in_flight and self._in_flight(key) >= max_in_flight:
+                return None
+            delay = max(
+                delay,
+                self._bucket(key, 'requests', requests_per_sec, max(1.0, requests_per_sec)).delay(1, now),
+                self._bucket(key, 'tokens', tokens_per_min / 60, tokens_per_min).delay(tokens, now),
+            )
+        return delay
+
+    def _try_admit(self, developer, tokens, now):
+        """(Permit, 0) if the request can start now, else (None, _delay())"""
+        delay = self._delay(developer, tokens, now)
+        if delay == 0:
+            return self._admit(developer, tokens), 0
+        return None, delay
+
+    def _admit(self, developer, tokens):
+        for key in (developer, self.GLOBAL):
+            requests_per_sec, tokens_per_min, _ = self._limits(key)
+            self._bucket(key, 'requests', requests_per_sec, max(1.0, requests_per_sec)).take(1)
+            self._bucket(key, 'tokens', tokens_per_min / 60, tokens_per_min).take(tokens)
+            self.in_flight[key] += 1
+        self.stats[developer]['admitted'] += 1
+        return Permit(self, developer)
+
+    def release(self, developer):
+        self.in_flight[developer] -= 1
+        self.in_flight[self.GLOBAL] -= 1
+        if self.waiters:
+            self._dispatch()
+
+    async def acquire(self, developer, tokens):
+        """Wait for admission; returns a Permit or raises RateLimited"""
+        # Fast path only when nobody is queued, so new arrivals can't jump the queue
+        if not self.waiters:
+            permit, _ = self._try_admit(developer, tokens, time.monotonic())
+            if permit:
+                return permit
+
+        timeout = self.config['limit_queue_timeout']
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(developer, collections.deque()).append((waiter, tokens))
+        self.stats[developer]['queued'] += 1
+        self._dispatch()
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                return waiter.result()
+            self.stats[developer]['rejected'] += 1
+            delay = self._delay(developer, tokens, time.monotonic())
+            raise RateLimited(
+                f'{developer} is over its rate limit',
+                retry_after=max(1, math.ceil(delay if delay else timeout)),
+            ) from None
+        except asyncio.CancelledError:
+            # Client went away; hand back a slot we may have been given meanwhile
+            if waiter.done() and not waiter.cancelled():
+                waiter.result().release()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+                self._discard_waiter(developer, waiter)
+
+    def _discard_waiter(self, developer, waiter):
+        queue_ = self.waiters.get(developer)
+        if queue_ is None:
+            return
+        for entry in queue_:
+            if entry[0] is waiter:
+                queue_.remove(entry)
+                break
+        if not queue_:
+            del self.waiters[developer]
+
+    def _dispatch(self):
+        """Admit queued requests round-robin across developers"""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        next_wake = None
+        progress = True
+        while progress and self.waiters:
+            progress = False
+            for developer in list(self.waiters):
+                queue_ = self.waiters[developer]
+                waiter, tokens = queue_[0]
+                permit, delay = self._try_admit(developer, tokens, now)
+                if permit:
+                    queue_.popleft()
+                    waiter.set_result(permit)
+                    progress = True
+                    # Back of the ring: everyone else gets a turn first
+                    self.waiters.move_to_end(developer)
+                    if not queue_:
+                        del self.waiters[developer]
+                elif delay is not None:
+                    next_wake = delay if next_wake is None else min(next_wake, delay)
+                elif self.poll_interval:
+                    next_wake = self.poll_interval if next_wake is None else min(next_wake, self.poll_interval)
+        if next_wake is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_wake, self._dispatch)
+
+    def snapshot(self):
+        return {
+            'limits': {k: v for k, v in self.config.items() if k.startswith('limit_')},
+            'in_flight': {k: v for k, v in self.in_flight.items() if v},
+            'queued': {developer: len(queue_) for developer, queue_ in self.waiters.items()},
+            'developers': {developer: dict(counts) for developer, counts in self.stats.items()},
+        }
+
+
+class SharedAdmissionController(AdmissionController):
+    """AdmissionController whose buckets and in-flight counts are shared by every worker
+
+    Each admission decision holds the shared lock, so two workers can't both
+    take the last slot. Queues stay per worker, and a worker isn't told when
+    another releases a slot, so requests blocked on an in-flight cap re-check
+    every `shared_poll_interval` seconds.
+    """
+
+    def __init__(self, config, shared):
+        super().__init__(config)
+        self.shared = shared
+        self.poll_interval = config['shared_poll_interval']
+
+    def _new_bucket(self, key, kind):
+        return SharedTokenBucket(self.shared, f'bucket|{kind}|{key}')
+
+    def _in_flight(self, key):
+        return self.shared.total(f'inflight|{key}')
+
+    def _try_admit(self, developer, tokens, now):
+        with self.shared.lock:
+            return super()._try_admit(developer, tokens, now)
+
+    def _admit(self, developer, tokens):
+        permit = super()._admit(developer, tokens)
+        self.shared.add(f'inflight|{developer}', 1)
+        self.shared.add(f'inflight|{self.GLOBAL}', 1)
+        return permit
+
+    def release(self, developer):
+        self.shared.add(f'inflight|{developer}', -1)
+        self.shared.add(f'inflight|{self.GLOBAL}', -1)
+        super().release(developer)
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['in_flight'] = {
+            key[len('inflight|'):]: int(total)
+            for key, total in ((key, sum(columns)) for key, columns in self.shared.items('inflight|')) if total
+        }
+        return snapshot
+
+
+admission = AdmissionController(CONFIG)
+
+
+def estimate_input_tokens(body):
+    """Rough input token count for rate limiting (~4 bytes of JSON per token)"""
+    return len(body) // 4
+
+
+# Flat estimate for an image block; the API charges by pixel count, which the proxy doesn't decode
+IMAGE_TOKENS = 1600
+
+
+def content_size(content):
+    """(characters of text, image and document blocks) in a message content or system value"""
+    if isinstance(content, str):
+        return len(content), 0
+    chars = media = 0
+    if isinstance(content, list):
+        for block in content:
+            if not isinstance(block, dict):
+                continue
+            kind = block.get('type')
+            if kind == 'text':
+                chars += len(block.get('text') or '')
+            elif kind in ('image', 'document'):
+                media += 1
+            elif kind == 'tool_result':
+                inner_chars, inner_media = content_size(block.get('content'))
+                chars += inner_chars
+                media += inner_media
+            elif kind == 'tool_use':
+                chars += len(block.get('name') or '') + len(json.dumps(block.get('input')))
+            elif kind == 'thinking':
+                chars += len(block.get('thinking') or '')
+    return chars, media
+
+
+def count_input_tokens(payload):
+    """(estimated input tokens, image and document blocks) from what a request says, not its JSON framing
+
+    About four characters of text, tool input or tool definition per token,
+    a few tokens per message, and IMAGE_TOKENS per image or document.
+    Closer than estimate_input_tokens for requests full of escaping or
+    short messages, and cheap enough for every request that could be routed.
+    """
+    chars, media = content_size(payload.get('system'))
+    tokens = 0
+    messages = payload.get('messages')
+    if isinstance(messages, list):
+        for message in messages:
+            if isinstance(message, dict):
+                message_chars, message_media = content_size(message.get('content'))
+                chars += message_chars
+                media += message_media
+                tokens += 4
+    tools = payload.get('tools')
+    if isinstance(tools, list) and tools:
+        chars += len(json.dumps(tools))
+    return tokens + chars // 4 + media * IMAGE_TOKENS, media
+
+
+def routed_model_id(requested, target):
+    """`target` in the form the client used: a Bedrock ID keeps its cross-region prefix"""
+    if 'anthropic.' in requested and 'anthropic.' not in target:
+        return f"{requested.split('anthropic.', 1)[0]}anthropic.{target}-v1:0"
+    return target
+
+
+class ModelRoutingPolicy:
+    """Send small requests to a cheaper, faster model than the one they name
+
+    Each request is put in the first class that fits:
+
+    - 'opted_out': x-claude-proxy-model-routing: off, or a pinned anthropic-beta
+    - 'unpriced': the requested or target model is not in the pricing table
+    - 'not_cheaper': the target costs as much per input token as the model asked for
+    - 'thinking': extended thinking is on
+    - 'media': images or documents
+    - 'tools': defines tools, and tool routing is off
+    - 'large': estimated input over `small_tokens`
+    - 'small': sent to the target model when the mode is 'on'
+
+    In 'shadow' mode every request is classified and counted but keeps its
+    model, so /debug/model-routing shows what 'on' would route.
+    """
+
+    HEADER = 'x-claude-proxy-model-routing'
+    MODES = ('off', 'shadow', 'on')
+
+    def __init__(self, config):
+        self.mode = config['model_routing'] if config['model_routing'] in self.MODES else 'off'
+        self.target = config['model_routing_target']
+        self.small_tokens = config['model_routing_small_tokens']
+        self.route_tools = config['model_routing_tools']
+        self.max_tokens = config['model_routing_max_tokens']
+        self.pinned_betas = [beta.strip() for beta in config['model_routing_pinned_betas'].split(',') if beta.strip()]
+        self.stats = collections.Counter()
+        self.estimated_tokens = collections.Counter()
+
+    def classify(self, headers, payload):
+        """(class, estimated input tokens or None when classified before estimating)"""
+        if headers.get(self.HEADER, '').lower() == 'off':
+            return 'opted_out', None
+        beta = headers.get('anthropic-beta', '')
+        if beta and any(pinned in beta for pinned in self.pinned_betas):
+            return 'opted_out', None
+        model = payload.get('model')
+        requested = pricing.resolve(model) if isinstance(model, str) else None
+        target = pricing.resolve(self.target)
+        if requested is None or target is None:
+            return 'unpriced', None
+        if target.input >= requested.input:
+            return 'not_cheaper', None
+        thinking = payload.get('thinking')
+        if isinstance(thinking, dict) and thinking.get('type') == 'enabled':
+            return 'thinking', None
+        tokens, media = count_input_tokens(payload)
+        if media:
+            return 'media', tokens
+        if payload.get('tools') and not self.route_tools:
+            return 'tools', tokens
+        if tokens > self.small_tokens:
+            return 'large', tokens
+        return 'small', tokens
+
+    def route(self, developer, headers, payload):
+        """Rewrite payload's model in place if it may be routed; returns the model asked for, or None"""
+        kind, tokens = self.classify(headers, payload)
+        requested = payload.get('model')
+        self.stats[kind] += 1
+        if tokens is not None:
+            self.estimated_tokens[kind] += tokens
+        routed = kind == 'small' and self.mode == 'on'
+        routed_model = routed_model_id(requested, self.target) if routed else requested
+        MODEL_ROUTING.inc((metric_model(requested), kind, metric_model(routed_model)))
+        if not routed:
+            return None
+        payload['model'] = routed_model
+        if isinstance(payload.get('max_tokens'), int) and payload['max_tokens'] > self.max_tokens:
+            payload['max_tokens'] = self.max_tokens
+        self.stats['routed'] += 1
+        return requested
+
+    def snapshot(self):
+        return {
+            'mode': self.mode,
+            'target': self.target,
+            'small_tokens': self.small_tokens,
+            'route_tools': self.route_tools,
+            'pinned_betas': self.pinned_betas,
+            'classes': dict(self.stats),
+            'mean_estimated_tokens': {
+                kind: round(total / self.stats[kind]) for kind, total in self.estimated_tokens.items()
+            },
+        }
+
+
+model_routing = ModelRoutingPolicy(CONFIG)
+
+
+EPHEMERAL = {'type': 'ephemeral'}
+# Content blocks the API accepts cache_control on
+CACHEABLE_BLOCKS = frozenset({'text', 'image', 'document', 'tool_use', 'tool_result'})
+
+
+def mark_cache_breakpoint(container, key):
+    """Put cache_control on container[key] (a string or list of blocks); False if it can't take one"""
+    value = container[key]
+    if isinstance(value, str):
+        if not value:
+            return False
+        container[key] = [{'type': 'text', 'text': value, 'cache_control': EPHEMERAL}]
+        return True
+    if isinstance(value, list) and value and isinstance(value[-1], dict):
+        block = value[-1]
+        if block.get('type') in CACHEABLE_BLOCKS and (block.get('type') != 'text' or block.get('text')):
+            value[-1] = dict(block, cache_control=EPHEMERAL)
+            return True
+    return False
+
+
+def prompt_cache_savings(model, cache_read_tokens, cache_write_tokens):
+    """USD saved by prompt caching vs sending the same tokens uncached (negative while writes go unread)"""
+    price = pricing.resolve(model)
+    if price is None:
+        return 0.0
+    return (cache_read_tokens * (price.input - price.cache_read)
+            - cache_write_tokens * (price.cache_write - price.input))
+
+
+class PromptCacheInjector:
+    """Add cache_control breakpoints to prompt prefixes a developer keeps resending
+
+    Each request is hashed cumulatively in the order the API caches a
+    prompt: tools, then system, then each message. A boundary whose hash
+    the same developer sent within `ttl` is a stable prefix. The latest
+    stable boundary in tools/system and the latest in the messages each get
+    a breakpoint if the prefix up to it is long enough to be cached. Once
+    the conversation is stable the last message gets one too, so the next
+    turn reads what this one writes. Requests that already set
+    cache_control are left as they are.
+    """
+
+    MAX_PREFIXES = 4096
+
+    def __init__(self, ttl, min_tokens):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.seen = {}
+        self.stats = collections.Counter()
+
+    def boundaries(self, payload):
+        """[(kind, index, prefix_tokens, digest)] for each place a breakpoint could go"""
+        boundaries = []
+        digest, size = b'', 0
+        parts = []
+        if isinstance(payload.get('tools'), list) and payload['tools']:
+            parts.append(('tools', None, payload['tools']))
+        if payload.get('system'):
+            parts.append(('system', None, payload['system']))
+        messages = payload.get('messages')
+        if isinstance(messages, list):
+            parts.extend(('message', i, message) for i, message in enumerate(messages))
+        for kind, index, part in parts:
+            encoded = json.dumps(part, sort_keys=True, separators=(',', ':')).encode()
+            size += len(encoded)
+            digest = hashlib.blake2b(digest + encoded, digest_size=16).digest()
+            boundaries.append((kind, index, size // 4, digest))
+        return boundaries
+
+    def inject(self, developer, payload, body):
+        """Add breakpoints to `payload` in place; True if any were added"""
+        if b'"cache_control"' in body:
+            self.stats['client_managed'] += 1
+            return False
+        boundaries = self.boundaries(payload)
+        if not boundaries:
+            return False
+
+        now = time.monotonic()
+        seen = self.seen.setdefault(developer, collections.OrderedDict())
+        stable = [b for b in boundaries if seen.get(b[3], 0) > now]
+        for boundary in boundaries:
+            seen[boundary[3]] = now + self.ttl
+            seen.move_to_end(boundary[3])
+        while len(seen) > self.MAX_PREFIXES:
+            seen.popitem(last=False)
+
+        model = str(payload.get('model', ''))
+        min_tokens = self.min_tokens * 2 if 'haiku' in model else self.min_tokens
+        static = [b for b in stable if b[0] != 'message']
+        conversation = [b for b in stable if b[0] == 'message']
+        chosen = []
+        if static:
+            chosen.append(static[-1])
+        if conversation:
+            chosen.append(conversation[-1])
+            if boundaries[-1] is not conversation[-1]:
+                chosen.append(boundaries[-1])
+
+        added = 0
+        for kind, index, tokens, _ in chosen:
+            if tokens < min_tokens:
+                continue
+            if kind == 'tools':
+                tools = payload['tools']
+                if isinstance(tools[-1], dict):
+                    tools[-1] = dict(tools[-1], cache_control=EPHEMERAL)
+                    added += 1
+            elif kind == 'system':
+                added += mark_cache_breakpoint(payload, 'system')
+            elif isinstance(payload['messages'][index], dict) and 'content' in payload['messages'][index]:
+                message = payload['messages'][index] = dict(payload['messages'][index])
+                added += mark_cache_breakpoint(message, 'content')
+        self.stats['requests'] += 1
+        if added:
+            self.stats['injected'] += 1
+            self.stats['breakpoints'] += added
+        return bool(added)
+
+
+class PromptCacheReport:
+    """Per-developer prompt cache tokens, net savings and time to first token by cache outcome"""
+
+    def __init__(self):
+        self.developers = collections.defaultdict(lambda: {
+            'calls': 0, 'cache_read_tokens': 0, 'cache_write_tokens': 0, 'saved_usd': 0.0,
+            'ttft': {outcome: [0, 0.0] for outcome in ('read', 'write', 'none')},
+        })
+
+    def observe(self, developer, model, cache_read_tokens, cache_write_tokens, ttft=None):
+        entry = self.developers[developer]
+        entry['calls'] += 1
+        entry['cache_read_tokens'] += cache_read_tokens
+        entry['cache_write_tokens'] += cache_write_tokens
+        saved = prompt_cache_savings(model, cache_read_tokens, cache_write_tokens)
+        entry['saved_usd'] += saved
+        PROMPT_CACHE_SAVED.inc((developer,), saved)
+        if ttft is not None:
+            outcome = 'read' if cache_read_tokens else 'write' if cache_write_tokens else 'none'
+            cell = entry['ttft'][outcome]
+            cell[0] += 1
+            cell[1] += ttft
+            TIME_TO_FIRST_TOKEN.observe((developer, outcome), ttft)
+
+    def snapshot(self):
+        return {
+            developer: {
+                'calls': entry['calls'],
+                'cache_read_tokens': entry['cache_read_tokens'],
+                'cache_write_tokens': entry['cache_write_tokens'],
+                'saved_usd': round(entry['saved_usd'], 6),
+                'ttft_ms': {
+                    outcome: {'calls': count, 'mean': round(total / count * 1000, 1)}
+                    for outcome, (count, total) in entry['ttft'].items() if count
+                },
+            }
+            for developer, entry in self.developers.items()
+        }
+
+
+prompt_cache = PromptCacheInjector(CONFIG['prompt_cache_ttl'], CONFIG['prompt_cache_min_tokens'])
+prompt_cache_report = PromptCacheReport()
+
+
+class StreamTee:
+    """Fan one upstream SSE stream out to any number of readers
+
+    Chunks are kept until the stream ends so a reader that attaches late
+    still gets the stream from the first byte.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        self._wake()
+
+    def close(self, error=None):
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self):
+        position = 0
+        while True:
+            changed = self._changed
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class Flight:
+    """One upstream call shared by identical concurrent requests
+
+    `result` resolves to (status, headers, body) where body is bytes, or a
+    StreamTee for a streamed completion.
+    """
+
+    def __init__(self):
+        self.result = asyncio.get_running_loop().create_future()
+        self.followers = 0
+
+    def publish(self, status, headers, body):
+        if not self.result.done():
+            self.result.set_result((status, headers, body))
+
+    def fail(self, error):
+        if not self.result.done():
+            self.result.set_exception(error)
+            # Mark retrieved so a flight nobody joined doesn't log "never retrieved"
+            self.result.exception()
+
+
+class FlightAbandoned(Exception):
+    """The leader was turned away (budget, rate limit) before calling upstream"""
+
+
+# fingerprint -> Flight for upstream calls currently in progress
+in_flight = {}
+COALESCE_STATS = {'leaders': 0, 'followers': 0}
+
+
+def end_flight(flight_key, flight):
+    """Stop new requests joining `flight`, unless a later leader has already taken its key"""
+    if in_flight.get(flight_key) is flight:
+        del in_flight[flight_key]
+
+
+def coalesce_key_for(request, payload):
+    """Key under which identical in-flight requests with the same API key share one upstream call"""
+    if not CONFIG['coalesce_enabled'] or request.headers.get('x-claude-proxy-coalesce', '') == '0':
+        return None
+    return request_fingerprint(request, payload, per_key=True)
+
+
+async def follow_flight(flight, developer, model, start_time):
+    """Answer a duplicate request from the leader's upstream call; None if the leader never made one"""
+    flight.followers += 1
+    COALESCE_STATS['followers'] += 1
+    try:
+        status, headers, body = await asyncio.shield(flight.result)
+    except FlightAbandoned:
+        # The leader's budget or rate limit is not this request's; it goes on by itself
+        flight.followers -= 1
+        COALESCE_STATS['followers'] -= 1
+        return None
+    headers = dict(headers, **{'x-claude-proxy-coalesced': 'follower'})
+
+    # The leader's log line carries the tokens; followers are counted, not billed
+    spawn(record_usage(developer, model, 0, 0, time.time() - start_time, source='coalesced'))
+
+    if isinstance(body, StreamTee):
+        return StreamingResponse(body.follow(), status_code=status, headers=headers)
+    return Response(body, status_code=status, headers=headers)
+
+
+async def pump_stream(stream, tee, flight_key, flight):
+    """Drain a relayed stream into a tee, independent of any one client"""
+    try:
+        async for chunk in stream:
+            tee.append(chunk)
+        tee.close()
+    except Exception as e:
+        tee.close(e)
+    finally:
+        end_flight(flight_key, flight)
+
+
+class SSEUsageParser:
+    """Pick usage out of an Anthropic SSE stream as chunks pass through
+
+    Only the message_start, message_delta and message_stop lines matter, so
+    a chunk of token deltas costs one substring search and is never split.
+    """
+
+    # The lines worth looking at; everything else in the stream is token deltas
+    EVENT_LINE = re.compile(rb'^(?:event: message_stop|data:[^\n]*"message_(?:start|delta)"[^\n]*)', re.M)
+
+    def __init__(self):
+        self.model = 'unknown'
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+        self.completed = False
+        self._partial = b''
+
+    def feed(self, chunk):
+        if self._partial:
+            chunk = self._partial + chunk
+        end = chunk.rfind(b'\n') + 1
+        # Keep the unterminated last line for the next chunk
+        self._partial = chunk[end:]
+        if chunk.find(b'message_', 0, end) < 0:
+            return
+        for match in self.EVENT_LINE.finditer(chunk, 0, end):
+            line = match.group()
+            if line.startswith(b'event: message_stop'):
+                self.completed = True
+                continue
+            try:
+                event = json.loads(line[5:])
+            except ValueError:
+                continue
+            if event.get('type') == 'message_start':
+                message = event.get('message', {})
+                usage = message.get('usage', {})
+                self.model = message.get('model', self.model)
+                self.input_tokens = usage.get('input_tokens', 0)
+                self.output_tokens = usage.get('output_tokens', 0)
+                self.cache_read_tokens = usage.get('cache_read_input_tokens') or 0
+                self.cache_write_tokens = usage.get('cache_creation_input_tokens') or 0
+            elif event.get('type') == 'message_delta':
+                # message_delta usage is cumulative for the whole message
+                self.output_tokens = event.get('usage', {}).get('output_tokens', self.output_tokens)
+
+
+def relayed_headers(response):
+    """Upstream headers that are safe to pass back, as the raw lowercase byte pairs ASGI sends"""
+    dropped = DROPPED_RESPONSE_HEADERS
+    connection = response.headers.get('connection')
+    if connection:
+        # Anything named in Connection is hop-by-hop for this response too
+        dropped = dropped | {token.strip().lower().encode('latin-1') for token in connection.split(',')}
+    relayed = []
+    for name, value in response.raw_headers:
+        name = name.lower()
+        if name not in dropped:
+            relayed.append((name, value))
+    return relayed
+
+
+def forwarded_headers(response):
+    """relayed_headers() as a str dict, for the cache and coalesced followers"""
+    return {name.decode('latin-1'): value.decode('latin-1') for name, value in relayed_headers(response)}
+
+
+def relay_response(response, content, extra_headers, background=None):
+    """Client response that reuses upstream's raw header bytes instead of rebuilding a dict"""
+    if isinstance(content, (bytes, memoryview)):
+        relayed = Response(content, status_code=response.status, background=background)
+    else:
+        relayed = StreamingResponse(content, status_code=response.status, background=background)
+    relayed.raw_headers.extend(relayed_headers(response))
+    if extra_headers:
+        relayed.headers.update(extra_headers)
+    return relayed
+
+
+def release_stream(response, permit):
+    """Free a streamed call's upstream connection and in-flight slot; both are idempotent
+
+    relay_stream releases them itself once it runs, but a generator that is
+    never iterated never reaches its finally.
+    """
+    response.release()
+    permit.release()
+
+
+async def read_body(response):
+    """The whole upstream body in one growing buffer
+
+    response.read() keeps every chunk until it joins them, briefly holding
+    the body twice; this appends each chunk as it arrives and lets it go.
+    """
+    body = bytearray()
+    async for chunk in response.content.iter_any():
+        body += chunk
+    return body
+
+
+async def read_lines(response):
+    """Yield each line of the upstream body, without its newline
+
+    Iterating response.content does the same but raises LineTooLong past
+    aiohttp's line limit; a batch result holding a long message goes past it.
+    """
+    pending = bytearray()
+    async for chunk in response.content.iter_any():
+        pending += chunk
+        if b'\n' not in chunk:
+            continue
+        *lines, rest = pending.split(b'\n')
+        pending = bytearray(rest)
+        for line in lines:
+            yield bytes(line)
+    if pending:
+        yield bytes(pending)
+
+
+USAGE_FIELD = re.compile(r'"usage"\s*:\s*')
+MODEL_FIELD = re.compile(rb'"model"\s*:\s*"([^"\\]*)"')
+json_decoder = json.JSONDecoder()
+
+
+def scan_usage(body, window=8192):
+    """(model, usage) from a Messages API body, reading only its head and tail
+
+    The API writes model among the first top-level fields and usage as the
+    last one, so the content (often most of a large tool-use response) is
+    never decoded or parsed. Returns None for any other layout; the caller
+    then parses the whole body.
+    """
+    match = MODEL_FIELD.search(body, 0, window)
+    # Top level only: nothing may have opened before it but the outer object
+    if not match or body.count(b'{', 0, match.start()) != 1 or body.find(b'[', 0, match.start()) >= 0:
+        return None
+    model = match.group(1).decode('utf-8')
+
+    start = body.rfind(b'"usage"', max(0, len(body) - window))
+    if start < 0:
+        return None
+    tail = body[start:].decode('utf-8', 'replace')
+    field = USAGE_FIELD.match(tail)
+    if not field:
+        return None
+    try:
+        usage, end = json_decoder.raw_decode(tail, field.end())
+    except ValueError:
+        return None
+    # usage must close the outer object, or it was a key inside something else
+    if not isinstance(usage, dict) or tail[end:].strip() != '}':
+        return None
+    return model, usage
+
+
+# Upstream statuses worth another attempt: rate limited, overloaded, transient server errors
+RETRYABLE_STATUSES = frozenset({408, 429, 500, 502, 503, 504, 529})
+# Failures that say nothing about upstream health once the request has been sent
+UPSTREAM_NETWORK_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+RETRY_STATS = collections.Counter()
+
+
+class CircuitOpen(Exception):
+    """Upstream call refused without trying because its circuit breaker is open"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Fail fast while an upstream is unhealthy
+
+    Opens after `breaker_failure_threshold` consecutive failures (5xx, 529
+    and network errors; a 429 is upstream pacing us, not failing) and
+    refuses calls for `breaker_reset_timeout` seconds. Then one probe is let
+    through: success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.stats = collections.Counter()
+        self._probing = False
+
+    def remaining(self):
+        """Seconds until the breaker lets a probe through (0 once it would)"""
+        if self.state == 'closed':
+            return 0.0
+        return max(0.0, self.opened_at + self.config['breaker_reset_timeout'] - time.monotonic())
+
+    def ready(self):
+        """Whether check() would let a call through right now"""
+        return self.state == 'closed' or (not self._probing and self.remaining() <= 0)
+
+    def check(self):
+        """Raise CircuitOpen unless a call may go upstream now"""
+        if self.state == 'closed':
+            return
+        if not self.ready():
+            self.stats['rejected'] += 1
+            raise CircuitOpen(
+                f'Upstream {self.name} is unavailable; failing fast until it recovers',
+                retry_after=max(1, math.ceil(self.remaining())),
+            )
+        self.state = 'half_open'
+        self._probing = True
+
+    def record(self, healthy):
+        if healthy:
+            if self.state != 'closed':
+                print(f"Circuit breaker for {self.name} closed")
+            self.state, self.failures, self._probing = 'closed', 0, False
+            return
+        self.failures += 1
+        threshold = self.config['breaker_failure_threshold']
+        if self.state == 'half_open' or (self.state == 'closed' and threshold and self.failures >= threshold):
+            if self.state == 'closed':
+                print(f"Circuit breaker for {self.name} opened after {self.failures} failures")
+            self.state, self.opened_at, self._probing = 'open', time.monotonic(), False
+            self.stats['opened'] += 1
+
+    def release_probe(self):
+        """The probe ended without a verdict (cancelled); let the next call probe instead"""
+        self._probing = False
+
+    def snapshot(self):
+        return dict(self.stats, name=self.name, state=self.state, consecutive_failures=self.failures)
+
+
+class RetryBudget:
+    """Caps retries and hedges at a share of recent traffic
+
+    Every first attempt deposits `retry_budget_ratio` of a token and every
+    retry or hedge spends a whole one, so in an incident the proxy adds at
+    most that fraction of extra load instead of multiplying it. The
+    per-second floor keeps a few retries available when traffic is light.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        # Start with the per-second floor's reserve so a fresh process can retry
+        self.balance = self._cap()
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        floor = self.config['retry_budget_min_per_sec']
+        self.balance = min(self._cap(), self.balance + (now - self.updated) * floor)
+        self.updated = now
+
+    def _cap(self):
+        return max(10.0, self.config['retry_budget_min_per_sec'] * 10)
+
+    def deposit(self):
+        self._refill()
+        self.balance = min(self._cap(), self.balance + self.config['retry_budget_ratio'])
+
+    def withdraw(self):
+        self._refill()
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+def parse_retry_after(headers):
+    """Seconds the upstream asked us to wait, or None"""
+    value = headers.get('retry-after-ms')
+    if value:
+        with contextlib.suppress(ValueError):
+            return max(0.0, float(value) / 1000)
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, retry_after):
+    """Backoff before retry number `attempt` (0-based), or None if the wait is too long to be worth it"""
+    if retry_after is not None:
+        if retry_after > CONFIG['retry_max_retry_after']:
+            return None
+        # A little jitter on top so a crowd told the same retry-after doesn't return in step
+        return retry_after + random.uniform(0, CONFIG['retry_base_delay'])
+    ceiling = min(CONFIG['retry_max_delay'], CONFIG['retry_base_delay'] * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+BEDROCK_ANTHROPIC_VERSION = 'bedrock-2023-05-31'
+# Bedrock model IDs, inference profiles and ARNs wrap the Anthropic model name
+BEDROCK_MODEL = re.compile(r'^(?:arn:[^/]*/)?(?:[a-z]+\.)?anthropic\.(claude-[a-z0-9.-]*?)(?:-v\d+(?::\d+)?)?$')
+# Bedrock IDs that don't follow anthropic.<model>-v1:0
+BEDROCK_MODEL_IDS = {
+    'claude-3-5-sonnet-20241022': 'anthropic.claude-3-5-sonnet-20241022-v2:0',
+}
+# Messages API error types for the statuses Bedrock answers with
+ERROR_TYPES = {
+    400: 'invalid_request_error', 401: 'authentication_error', 403: 'permission_error',
+    404: 'not_found_error', 413: 'request_too_large', 429: 'rate_limit_error',
+    503: 'overloaded_error', 529: 'overloaded_error',
+}
+BEDROCK_STREAM_ERRORS = {
+    'throttlingException': 'rate_limit_error',
+    'serviceUnavailableException': 'overloaded_error',
+    'validationException': 'invalid_request_error',
+}
+
+# Signs Bedrock calls with the proxy's own credentials (instance role), not the developer's key
+aws_session = boto3.Session()
+
+
+def load_bedrock_models(path):
+    """Extra Anthropic-to-Bedrock model ID mappings from a JSON file"""
+    if path:
+        try:
+            with open(path) as f:
+                BEDROCK_MODEL_IDS.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Error loading Bedrock model file {path}: {e}")
+
+
+def anthropic_model_id(model):
+    """The Anthropic API name inside a Bedrock model ID; other names pass through"""
+    match = BEDROCK_MODEL.match(model)
+    return match.group(1) if match else model
+
+
+def bedrock_model_id(model):
+    """The Bedrock model ID (or inference profile) for an Anthropic model name"""
+    if 'anthropic.' in model:
+        # Already a Bedrock ID, as sent by clients configured for Bedrock
+        return model
+    if model in BEDROCK_MODEL_IDS:
+        return BEDROCK_MODEL_IDS[model]
+    profile = CONFIG['bedrock_profile']
+    return f"{profile + '.' if profile else ''}anthropic.{model}-v1:0"
+
+
+def sign_aws_request(url, headers, body, region):
+    """SigV4 headers for a Bedrock runtime call, or the headers unchanged without credentials"""
+    credentials = aws_session.get_credentials()
+    if credentials is None:
+        return headers
+    request = AWSRequest(method='POST', url=url, data=body, headers=headers)
+    SigV4Auth(credentials.get_frozen_credentials(), 'bedrock', region).add_auth(request)
+    return dict(request.headers.items())
+
+
+def error_body(error_type, message):
+    return json.dumps({'type': 'error', 'error': {'type': error_type, 'message': message}}).encode()
+
+
+def bedrock_error_body(status, headers, body):
+    """A Bedrock error ({"message": ...} plus x-amzn-errortype) as a Messages API error"""
+    try:
+        message = json.loads(body).get('message') or ''
+    except (ValueError, AttributeError):
+        message = body.decode('utf-8', 'replace')
+    # e.g. ThrottlingException:http://internal.amazon.com/coral/com.amazon.bedrock/
+    name = headers.get('x-amzn-errortype', '').split(':')[0]
+    return error_body(ERROR_TYPES.get(status, 'api_error'), f'{name}: {message}' if name else message)
+
+
+async def bedrock_sse(response):
+    """Re-encode a Bedrock event stream as the Messages API's SSE
+
+    Each Bedrock event carries one Anthropic stream event, base64-encoded
+    in {"bytes": ...}; exceptions mid-stream become an SSE error event.
+    """
+    buffer = EventStreamBuffer()
+    async for chunk in response.content.iter_any():
+        buffer.add_data(chunk)
+        events = []
+        for message in buffer:
+            if message.headers.get(':message-type') == 'event':
+                data = base64.b64decode(json.loads(message.payload)['bytes'])
+                event_type = json.loads(data).get('type', 'message')
+                events.append(b'event: %s\ndata: %s\n\n' % (event_type.encode(), data))
+            else:
+                name = message.headers.get(':exception-type', 'unknown')
+                try:
+                    detail = json.loads(message.payload).get('message', '')
+                except ValueError:
+                    detail = message.payload.decode('utf-8', 'replace')
+                error = error_body(BEDROCK_STREAM_ERRORS.get(name, 'api_error'), f'{name}: {detail}')
+                events.append(b'event: error\ndata: %s\n\n' % error)
+        if events:
+            yield b''.join(events)
+
+
+async def single_chunk(data):
+    yield data
+
+
+class TranslatedResponse:
+    """A backend's aiohttp response rewritten into the Messages API's shape
+
+    Has the parts of ClientResponse the handler uses (status, headers,
+    raw_headers, content.iter_any(), release()) so the relay code doesn't
+    care which backend answered.
+    """
+
+    def __init__(self, response, status, chunks, content_type):
+        self._response = response
+        self._chunks = chunks
+        self.status = status
+        self.headers = CIMultiDict(response.headers)
+        self.headers['content-type'] = content_type
+        self.raw_headers = tuple(
+            (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in self.headers.items()
+        )
+        self.content = self
+
+    def iter_any(self):
+        return self._chunks
+
+    def release(self):
+        self._response.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class Backend(abc.ABC):
+    """One upstream that serves Messages API calls, with its own pool, breaker and health
+
+    `latency` is an EWMA of seconds to response headers on successful calls
+    and `error_rate` an EWMA of failures (5xx, 529, network). `quota` is the
+    smallest remaining share of any rate limit the backend reports, full
+    again at its reset time. A 429 keeps the backend out of rotation until
+    its retry-after while others are available. `checks_key` says whether
+    the backend itself authenticates the client's x-api-key.
+    """
+
+    kind = None
+    checks_key = False
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.breaker = CircuitBreaker(name, CONFIG)
+        self.session = None
+        self.latency = None
+        self.error_rate = 0.0
+        self.quota = 1.0
+        self.quota_reset = 0.0
+        self.throttled_until = 0.0
+        self.stats = collections.Counter()
+
+    def open(self):
+        self.session = create_http_client()
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+    @abc.abstractmethod
+    def prepare(self, headers, body, payload, stream):
+        """(url, headers, body) for this backend's form of a Messages API call"""
+
+    async def translate(self, response, stream):
+        """The backend's response in the Messages API's shape"""
+        return response
+
+    def update_quota(self, headers):
+        pass
+
+    async def post(self, headers, body, payload):
+        stream = bool(payload.get('stream'))
+        url, headers, body = self.prepare(headers, body, payload, stream)
+        start = time.perf_counter()
+        try:
+            response = await self.session.post(url, headers=headers, data=body)
+        except UPSTREAM_NETWORK_ERRORS:
+            self.observe(None, None, time.perf_counter() - start)
+            raise
+        self.observe(response.status, response.headers, time.perf_counter() - start)
+        return await self.translate(response, stream)
+
+    def observe(self, status, headers, elapsed):
+        """Fold one call's outcome into the health the router weighs"""
+        BACKEND_CALLS.inc((self.name, str(status or 'network')))
+        self.stats[status or 'network'] += 1
+        failed = status is None or (status in RETRYABLE_STATUSES and status != 429)
+        alpha = CONFIG['router_ewma_alpha']
+        self.error_rate += alpha * (failed - self.error_rate)
+        if not failed and status != 429:
+            self.latency = elapsed if self.latency is None else self.latency + alpha * (elapsed - self.latency)
+        if status == 429:
+            self.throttled_until = time.monotonic() + (parse_retry_after(headers) or 1.0)
+        if headers is not None:
+            self.update_quota(headers)
+        # A 429 is the backend pacing us, not failing
+        self.breaker.record(not failed)
+
+    def weight(self, now, default_latency):
+        latency = self.latency if self.latency is not None else default_latency
+        quota = self.quota if now < self.quota_reset else 1.0
+        return (
+            max(1.0 - self.error_rate, 0.05)
+            * max(min(1.0, quota / CONFIG['router_quota_low']), 0.01)
+            / max(latency, 0.001) ** CONFIG['router_latency_exponent']
+        )
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'url': self.url,
+            'latency_ewma': round(self.latency, 4) if self.latency is not None else None,
+            'error_rate': round(self.error_rate, 4),
+            'quota': round(self.quota if now < self.quota_reset else 1.0, 4),
+            'throttled_for': round(max(0.0, self.throttled_until - now), 1),
+            'calls': {str(status): count for status, count in self.stats.items()},
+            'breaker': self.breaker.snapshot(),
+        }
+
+
+class AnthropicBackend(Backend):
+    """The Anthropic Messages API, authenticated with the developer's own key"""
+
+    kind = 'anthropic'
+    checks_key = True
+
+    RATE_LIMITS = ('requests', 'tokens', 'input-tokens', 'output-tokens')
+
+    def __init__(self, url):
+        super().__init__('anthropic', url)
+
+    def prepare(self, headers, body, payload, stream):
+        model = payload.get('model')
+        if isinstance(model, str) and 'anthropic.' in model:
+            # A client configured for Bedrock; the body is otherwise already in the right shape
+            body = json.dumps(dict(payload, model=anthropic_model_id(model))).encode()
+        return f'{self.url}/messages', headers, body
+
+    def update_quota(self, headers):
+        """Track the tightest anthropic-ratelimit-*-remaining / -limit pair"""
+        shares, reset = [], None
+        for name in self.RATE_LIMITS:
+            limit = headers.get(f'anthropic-ratelimit-{name}-limit')
+            remaining = headers.get(f'anthropic-ratelimit-{name}-remaining')
+            if not limit or not remaining:
+                continue
+            with contextlib.suppress(ValueError, ZeroDivisionError):
+                shares.append((int(remaining) / int(limit), headers.get(f'anthropic-ratelimit-{name}-reset')))
+        if not shares:
+            return
+        self.quota, reset = min(shares, key=lambda share: share[0])
+        try:
+            # RFC 3339, converted to the monotonic clock everything else here uses
+            self.quota_reset = time.monotonic() + datetime.fromisoformat(reset).timestamp() - time.time()
+        except (TypeError, ValueError):
+            self.quota_reset = time.monotonic() + 60
+
+
+class BedrockBackend(Backend):
+    """Bedrock InvokeModel / InvokeModelWithResponseStream in one region, signed with the proxy's AWS role"""
+
+    kind = 'bedrock'
+
+    def __init__(self, region, url=None):
+        super().__init__(f'bedrock-{region}', url or f'https://bedrock-runtime.{region}.amazonaws.com')
+        self.region = region
 
-app = Flask(__name__)
+    def prepare(self, headers, body, payload, stream):
+        # Same body minus model and stream, which Bedrock takes from the URL
+        request = {key: value for key, value in payload.items() if key not in ('model', 'stream')}
+        request['anthropic_version'] = BEDROCK_ANTHROPIC_VERSION
+        if 'anthropic-beta' in headers:
+            request['anthropic_beta'] = [beta.strip() for beta in headers['anthropic-beta'].split(',')]
+        body = json.dumps(request).encode()
 
-# CloudWatch client
-cloudwatch = boto3.client('cloudwatch', region_name='ap-southeast-7')
-logs_client = boto3.client('logs', region_name='ap-southeast-7')
+        model_id = quote(bedrock_model_id(str(payload.get('model', ''))), safe='')
+        url = f"{self.url}/model/{model_id}/{'invoke-with-response-stream' if stream else 'invoke'}"
+        headers = sign_aws_request(url, {
+            'content-type': 'application/json',
+            'accept': 'application/vnd.amazon.eventstream' if stream else 'application/json',
+            'traceparent': headers['traceparent'],
+        }, body, self.region)
+        # Sent exactly as signed; yarl would otherwise decode the %3A in the model ID
+        return yarl.URL(url, encoded=True), headers, body
 
-LOG_GROUP = '/aws/ec2/code-server-multi-dev/claude-api'
-PROJECT_NAME = 'code-server-multi-dev'
+    async def translate(self, response, stream):
+        if response.status != 200:
+            async with response:
+                error = await response.read()
+            body = bedrock_error_body(response.status, response.headers, error)
+            return TranslatedResponse(response, response.status, single_chunk(body), 'application/json')
+        if stream:
+            return TranslatedResponse(response, 200, bedrock_sse(response), 'text/event-stream')
+        # InvokeModel's body already is a Messages API response
+        return response
 
-# Claude API endpoint
-CLAUDE_API_URL = "https://api.anthropic.com/v1"
 
-# Cost per token (as of 2024)
-COSTS = {
-    'claude-3-sonnet': {'input': 3.0 / 1_000_000, 'output': 15.0 / 1_000_000},
-    'claude-3-haiku': {'input': 0.25 / 1_000_000, 'output': 1.25 / 1_000_000},
-    'claude-3-opus': {'input': 15.0 / 1_000_000, 'output': 75.0 / 1_000_000},
-}
+def parse_backends(spec):
+    """Backends named in CLAUDE_PROXY_BACKENDS, or just the Anthropic API at CLAUDE_API_URL"""
+    backends = []
+    for entry in filter(None, (entry.strip() for entry in spec.split(','))):
+        kind, _, url = entry.partition('=')
+        kind, _, region = kind.partition(':')
+        if kind == 'anthropic':
+            backends.append(AnthropicBackend(url or CLAUDE_API_URL))
+        elif kind == 'bedrock' and region:
+            backends.append(BedrockBackend(region, url or None))
+        else:
+            raise ValueError(f"Unknown backend {entry!r} in CLAUDE_PROXY_BACKENDS")
+    return backends or [AnthropicBackend(CLAUDE_API_URL)]
 
 
-def get_developer_from_key(api_key):
-    """Extract developer ID from API key (stored in env)"""
-    for i in range(1, 9):
-        dev_key = os.environ.get(f'DEV{i}_CLAUDE_KEY', '')
-        if api_key == dev_key:
-            return f'dev{i}'
-    return 'unknown'
+class UpstreamRouter:
+    """Pick a backend for each upstream attempt
 
+    Backends are drawn at random in proportion to Backend.weight(), so
+    traffic leans toward the fastest healthy backend while the rest keep
+    getting enough calls to be measured. Backends whose breaker is open are
+    skipped, and throttled ones too while anything else is left. Callers
+    whose key the proxy doesn't recognise only go to backends that check
+    the key themselves, never to one signed with the proxy's own role.
+    """
 
-def calculate_cost(model, input_tokens, output_tokens):
-    """Calculate cost based on token usage"""
-    model_key = model.split('-')[0:3]  # Extract base model name
-    model_key = '-'.join(model_key)
+    def __init__(self, backends):
+        self.backends = backends
+        self.stats = collections.Counter()
 
-    if model_key not in COSTS:
-        model_key = 'claude-3-sonnet'  # Default
+    def allowed(self, trusted):
+        return self.backends if trusted else [backend for backend in self.backends if backend.checks_key]
+
+    def choose(self, exclude=(), trusted=True):
+        """A backend not in `exclude` if possible; raises CircuitOpen if every breaker is open"""
+        now = time.monotonic()
+        allowed = self.allowed(trusted)
+        ready = [backend for backend in allowed if backend.breaker.ready()]
+        if not ready:
+            self.stats['rejected'] += 1
+            raise CircuitOpen(
+                'No upstream backend is available; failing fast until one recovers',
+                retry_after=max(1, math.ceil(min(backend.breaker.remaining() for backend in allowed))),
+            )
+        ready = [backend for backend in ready if backend.throttled_until <= now] or ready
+        candidates = [backend for backend in ready if backend not in exclude] or ready
+        if len(candidates) == 1:
+            return candidates[0]
+        # Backends not measured yet look as fast as the best so they get tried
+        known = [backend.latency for backend in candidates if backend.latency is not None]
+        default_latency = min(known) if known else 1.0
+        weights = [backend.weight(now, default_latency) for backend in candidates]
+        return random.choices(candidates, weights)[0]
 
-    input_cost = input_tokens * COSTS[model_key]['input']
-    output_cost = output_tokens * COSTS[model_key]['output']
 
-    return input_cost + output_cost
+async def hedged_post(backend, headers, body, payload, hedge_after, trusted=True):
+    """backend.post(), plus a second identical call if the first hasn't answered after `hedge_after`
 
+    The hedge goes to another healthy backend when there is one. The first
+    good answer wins and the other call is cancelled, its response released
+    if it arrives anyway. A retryable error from one call waits for the
+    other rather than winning. Returns (response, backend that answered).
+    """
+    first = asyncio.ensure_future(backend.post(headers, body, payload))
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    if done or backend.breaker.state != 'closed' or not retry_budget.withdraw():
+        return await first, backend
+
+    try:
+        other = router.choose(exclude=(backend,), trusted=trusted)
+    except CircuitOpen:
+        other = backend
+    if other.breaker.state != 'closed':
+        other = backend
 
-def log_to_cloudwatch(log_data):
-    """Send logs to CloudWatch"""
+    RETRY_STATS['hedges'] += 1
+    second = asyncio.ensure_future(other.post(headers, body, payload))
+    backends = {first: backend, second: other}
+    pending = {first, second}
+    # The attempt whose answer is returned; the other is cancelled or released
+    winner = None
     try:
-        # Create log stream if not exists
-        stream_name = f"{log_data['developer']}/{datetime.now().strftime('%Y/%m/%d')}"
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if winner is None and task.exception() is None and task.result().status not in RETRYABLE_STATUSES:
+                    winner = task
+        if winner is None:
+            # Both failed. Gathered so neither exception goes unretrieved; an upstream error response
+            # speaks for both over a network error, and the first call's over the hedge's
+            outcomes = await asyncio.gather(first, second, return_exceptions=True)
+            answered = [task for task, outcome in zip((first, second), outcomes)
+                        if not isinstance(outcome, BaseException)]
+            if not answered:
+                raise outcomes[0]
+            winner = answered[0]
+            return winner.result(), backends[winner]
+        HEDGES.inc(('hedge_won' if winner is second else 'first_won',))
+        return winner.result(), backends[winner]
+    finally:
+        for task in (first, second):
+            if task is not winner:
+                task.cancel()
+                task.add_done_callback(discard_attempt)
+
+
+def discard_attempt(task):
+    """Done callback for a hedged attempt that lost: release its response, or retrieve its error"""
+    if not task.cancelled():
+        if task.exception() is None:
+            task.result().release()
+
+
+async def call_upstream(headers, body, payload, trace, hedge=False, trusted=True):
+    """Send a Messages API call to a backend with budgeted retries, failover, hedging and breakers
 
+    A failed attempt moves straight on to another backend if one is left;
+    backoff only applies when retrying a backend that already failed this
+    call. Returns (response, backend): the first non-retryable response, or
+    the last retryable one once retries are exhausted, so the client sees
+    upstream's own error. Raises CircuitOpen when failing fast, or the
+    network error from the last attempt. `trusted` is False for a key the
+    proxy doesn't recognise; see UpstreamRouter.
+    """
+    retry_budget.deposit()
+    started = time.monotonic()
+    hedge_after = CONFIG['hedge_after'] if hedge else 0
+    failed = []
+    backend = router.choose(trusted=trusted)
+    attempt = 0
+    while True:
+        backend.breaker.check()
+        response = error = None
         try:
-            logs_client.create_log_stream(
-                logGroupName=LOG_GROUP,
-                logStreamName=stream_name
-            )
-        except logs_client.exceptions.ResourceAlreadyExistsException:
-            pass
+            if hedge_after:
+                response, backend = await hedged_post(backend, headers, body, payload, hedge_after, trusted)
+            else:
+                response = await backend.post(headers, body, payload)
+        except UPSTREAM_NETWORK_ERRORS as e:
+            error = e
+        except BaseException:
+            backend.breaker.release_probe()
+            raise
 
-        # Put log event
-        logs_client.put_log_events(
-            logGroupName=LOG_GROUP,
-            logStreamName=stream_name,
-            logEvents=[{
-                'timestamp': int(time.time() * 1000),
-                'message': json.dumps(log_data)
-            }]
-        )
+        if response is not None and response.status not in RETRYABLE_STATUSES:
+            trace.attributes['upstream.backend'] = backend.name
+            return response, backend
+
+        failed.append(backend)
+        reason = str(response.status) if response is not None else 'network'
+        retry_after = parse_retry_after(response.headers) if response is not None else None
+        should_retry = response.headers.get('x-should-retry') if response is not None else None
+        try:
+            next_backend = router.choose(exclude=failed, trusted=trusted)
+        except CircuitOpen:
+            next_backend = None
+        # retry-after only speaks for the backend that sent it
+        delay = retry_delay(attempt, retry_after) if next_backend in failed else 0.0
+        if (
+            should_retry == 'false'
+            or next_backend is None
+            or attempt >= CONFIG['retry_max_retries']
+            or delay is None
+            or time.monotonic() - started + delay > CONFIG['retry_deadline']
+            or not retry_budget.withdraw()
+        ):
+            RETRY_STATS['gave_up'] += 1
+            trace.attributes['upstream.backend'] = backend.name
+            if response is not None:
+                return response, backend
+            raise error
+
+        if response is not None:
+            response.release()
+        RETRY_STATS['retries'] += 1
+        if next_backend is not backend:
+            RETRY_STATS['failovers'] += 1
+        RETRIES.inc((reason,))
+        trace.mark('upstream')
+        if delay:
+            await asyncio.sleep(delay)
+            trace.mark('backoff')
+        backend = next_backend
+        attempt += 1
+
+
+load_bedrock_models(CONFIG['bedrock_models_file'])
+router = UpstreamRouter(parse_backends(CONFIG['backends']))
+retry_budget = RetryBudget(CONFIG)
+
+
+async def record_usage(developer, model, input_tokens, output_tokens, elapsed_time, source='upstream', followers=0,
+                       cache_read_tokens=0, cache_write_tokens=0, ttft=None, requested_model=None, batch=False):
+    """Cost a completed call and ship it to CloudWatch Logs and Metrics
+
+    `source` is 'upstream', 'cache' (served from the response cache) or
+    'coalesced' (attached to an identical in-flight call). Only upstream
+    calls are billed; the others are logged with zero tokens and cost.
+    `ttft` is the streaming time to first byte, for the prompt cache report.
+    `requested_model` is the model the client asked for when model routing
+    sent the call to `model` instead. `batch` calls came back from a
+    Message Batches submission and are priced at the batch discount.
+    Calls to a model missing from the pricing table are logged with
+    cost_unknown and left out of budgets rather than priced as some other model.
+    """
+    # Calculate cost
+    cost = calculate_cost(model, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens, batch=batch)
+    cost_known = cost is not None
+    cost = cost or 0.0
+
+    saved_cost = 0.0
+    if source != 'upstream':
+        saved_cost, cost = cost, 0.0
+        input_tokens = output_tokens = cache_read_tokens = cache_write_tokens = 0
+
+    labels = (developer, metric_model(model))
+    REQUEST_DURATION.observe(labels + (source,), elapsed_time)
+    if source == 'upstream':
+        for kind, tokens in (('input', input_tokens), ('output', output_tokens),
+                             ('cache_read', cache_read_tokens), ('cache_write', cache_write_tokens)):
+            TOKENS.observe(labels + (kind,), tokens)
+        COST.inc(labels, cost)
+        prompt_cache_report.observe(developer, model, cache_read_tokens, cache_write_tokens, ttft)
+
+    record = UsageRecord(
+        time.time(), developer, model, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens,
+        cost, saved_cost, elapsed_time, source, followers, cost_known, requested_model, batch,
+    )
+    # Journal locally first so the record survives a CloudWatch outage
+    usage_journal.append(record)
+
+    budget.add(developer, cost)
+    send_metrics_to_cloudwatch(developer, model, input_tokens, output_tokens, cost)
+    # Last, since the block policy can hold this task while the log queue is full
+    await log_to_cloudwatch(usage_log_data(record))
+
+
+def log_error(developer, error, status='error'):
+    """Ship a failed call to CloudWatch Logs without holding up the error response"""
+    log_data = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'developer': developer,
+        'status': status,
+        'error': str(error)
+    }
+    spawn(log_to_cloudwatch(log_data))
+
+
+async def relay_stream(response, developer, start_time, cache_key=None, flight=None, permit=None,
+                       labels=None, upstream_start=None, capture=None, requested_model=None):
+    """Yield upstream SSE chunks as they arrive, then record usage"""
+    parser = SSEUsageParser()
+    # Keep a copy for the cache until the stream outgrows a cache entry
+    cached_chunks, cached_bytes = ([] if cache_key else None), 0
+    relayed_bytes = 0
+    ttft = None
+    try:
+        async for chunk in response.content.iter_any():
+            if not relayed_bytes and upstream_start is not None:
+                ttft = time.perf_counter() - upstream_start
+                if labels:
+                    UPSTREAM_TTFB.observe(labels, ttft)
+            relayed_bytes += len(chunk)
+            parser.feed(chunk)
+            if cached_chunks is not None:
+                cached_bytes += len(chunk)
+                if cached_bytes > response_cache.max_entry_bytes:
+                    cached_chunks = None
+                else:
+                    cached_chunks.append(chunk)
+            yield chunk
+        if cached_chunks is not None and parser.completed:
+            store_cached_response(
+                cache_key, response.status, forwarded_headers(response), b''.join(cached_chunks),
+                parser.model, parser.input_tokens, parser.output_tokens,
+            )
     except Exception as e:
-        print(f"Error logging to CloudWatch: {e}")
+        log_error(developer, e)
+        raise
+    finally:
+        response.release()
+        if permit:
+            permit.release()
+        if labels:
+            UPSTREAM_LATENCY.observe(labels, time.perf_counter() - upstream_start)
+            RESPONSE_BYTES.observe(labels, relayed_bytes)
+        if capture is not None:
+            capture.update(
+                upstream_ttfb=round(ttft, 4) if ttft is not None else None,
+                upstream_latency=round(time.perf_counter() - upstream_start, 4),
+                response_bytes=relayed_bytes, input_tokens=parser.input_tokens, output_tokens=parser.output_tokens,
+                cache_read_tokens=parser.cache_read_tokens, cache_write_tokens=parser.cache_write_tokens,
+            )
+        # Record in the background so the end of the stream isn't held up, and so
+        # tokens are still accounted when the client disconnects mid-stream
+        if parser.input_tokens or parser.output_tokens:
+            elapsed_time = time.time() - start_time
+            spawn(record_usage(
+                developer, parser.model, parser.input_tokens, parser.output_tokens, elapsed_time,
+                followers=flight.followers if flight else 0,
+                cache_read_tokens=parser.cache_read_tokens, cache_write_tokens=parser.cache_write_tokens, ttft=ttft,
+                requested_model=requested_model,
+            ))
 
 
-def send_metrics_to_cloudwatch(developer, model, input_tokens, output_tokens, cost):
-    """Send custom metrics to CloudWatch"""
-    try:
-        cloudwatch.put_metric_data(
-            Namespace='CodeServer/ClaudeAPI',
-            MetricData=[
-                {
-                    'MetricName': 'InputTokens',
-                    'Value': input_tokens,
-                    'Unit': 'Count',
-                    'Timestamp': datetime.utcnow(),
-                    'Dimensions': [
-                        {'Name': 'Developer', 'Value': developer},
-                        {'Name': 'Model', 'Value': model},
-                        {'Name': 'Project', 'Value': PROJECT_NAME},
-                    ]
-                },
-                {
-                    'MetricName': 'OutputTokens',
-                    'Value': output_tokens,
-                    'Unit': 'Count',
-                    'Timestamp': datetime.utcnow(),
-                    'Dimensions': [
-                        {'Name': 'Developer', 'Value': developer},
-                        {'Name': 'Model', 'Value': model},
-                        {'Name': 'Project', 'Value': PROJECT_NAME},
-                    ]
-                },
-                {
-                    'MetricName': 'TotalCost',
-                    'Value': cost,
-                    'Unit': 'None',
-                    'Timestamp': datetime.utcnow(),
-                    'Dimensions': [
-                        {'Name': 'Developer', 'Value': developer},
-                        {'Name': 'Model', 'Value': model},
-                        {'Name': 'Project', 'Value': PROJECT_NAME},
-                    ]
-                },
-                {
-                    'MetricName': 'APICall',
-                    'Value': 1,
-                    'Unit': 'Count',
-                    'Timestamp': datetime.utcnow(),
-                    'Dimensions': [
-                        {'Name': 'Developer', 'Value': developer},
-                        {'Name': 'Project', 'Value': PROJECT_NAME},
-                    ]
-                }
+class BatchQueue:
+    """Durable local queue of Messages API calls offloaded to the Message Batches API
+
+    Calls are stored in SQLite until they have been answered and the
+    answer has been kept for `result_ttl`, so neither a restart nor a
+    worker crash loses one. Each queued call goes through:
+
+    - 'queued': waiting to be packed. Calls are grouped by API key and API
+      headers, since a batch is submitted with one key.
+    - 'submitting': claimed by ready() for a submission not yet recorded.
+      They are never packed again, so a batch whose id failed to be stored
+      is not submitted (and billed) twice.
+    - 'submitted': part of a batch the API is processing. The key moves to
+      the batch row and is deleted from disk once the results are in.
+    - 'succeeded', 'errored', 'canceled' or 'expired': the batch result.
+      `result` holds the message, or the error object.
+
+    All methods block; call them through run_in_threadpool. Workers under
+    run_workers share the database, but only slot 0 submits and polls.
+    """
+
+    FINISHED = ('succeeded', 'errored', 'canceled', 'expired')
+
+    def __init__(self, path):
+        self.path = path
+        self.stats = collections.Counter()
+        self._db = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._db is not None or not self.path:
+            return self._db
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Holds developers' API keys until their batches finish
+        os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS queued (
+                id TEXT PRIMARY KEY, developer TEXT NOT NULL, api_key TEXT, headers TEXT NOT NULL,
+                body BLOB, bytes INTEGER NOT NULL, model TEXT, created REAL NOT NULL, state TEXT NOT NULL,
+                batch_id TEXT, webhook TEXT, result BLOB, finished REAL, key_digest BLOB, claimed REAL
+            )
+        """)
+        columns = {row[1] for row in db.execute('PRAGMA table_info(queued)')}
+        if 'key_digest' not in columns:
+            # Calls queued before results were tied to a key still finish and are billed, but can't be fetched
+            db.execute('ALTER TABLE queued ADD COLUMN key_digest BLOB')
+        if 'claimed' not in columns:
+            db.execute('ALTER TABLE queued ADD COLUMN claimed REAL')
+        db.execute('CREATE INDEX IF NOT EXISTS queued_state ON queued (state, created)')
+        db.execute('CREATE INDEX IF NOT EXISTS queued_batch ON queued (batch_id)')
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS batch (
+                id TEXT PRIMARY KEY, api_key TEXT NOT NULL, headers TEXT NOT NULL, submitted REAL NOT NULL,
+                requests INTEGER NOT NULL, bytes INTEGER NOT NULL, status TEXT NOT NULL, polled REAL NOT NULL
+            )
+        """)
+        db.commit()
+        self._db = db
+        return db
+
+    def exists(self):
+        return bool(self.path) and os.path.exists(self.path)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def enqueue(self, developer, api_key, headers, body, model, webhook=None):
+        """Queue one call; returns its id"""
+        queued_id = f'qmsg_{os.urandom(16).hex()}'
+        with self._lock:
+            db = self.open()
+            db.execute(
+                'INSERT INTO queued (id, developer, api_key, key_digest, headers, body, bytes, model, created, state, '
+                "webhook) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?)",
+                (queued_id, developer, api_key, DeveloperKeyIndex.digest(api_key), json.dumps(headers, sort_keys=True),
+                 body, len(body), model, time.time(), webhook),
+            )
+            db.commit()
+        self.stats['queued'] += 1
+        return queued_id
+
+    def get(self, queued_id):
+        with self._lock:
+            row = self.open().execute(
+                'SELECT developer, key_digest, state, batch_id, created, finished, result FROM queued WHERE id = ?',
+                (queued_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('developer', 'key_digest', 'state', 'batch_id', 'created', 'finished', 'result'), row))
+
+    def ready(self, min_requests, max_age, max_requests, max_bytes):
+        """Claim [(api_key, headers, [(id, body)])] for each batch due to be submitted
+
+        A group of calls sharing a key and headers is due once it holds
+        `min_requests` or its oldest call is `max_age` seconds old; it is
+        cut into batches of at most `max_requests` and `max_bytes`. The
+        calls move to 'submitting' until submitted() or release().
+        """
+        with self._lock:
+            db = self.open()
+            due = db.execute(
+                "SELECT api_key, headers FROM queued WHERE state = 'queued' GROUP BY api_key, headers "
+                'HAVING COUNT(*) >= ? OR MIN(created) <= ?', (min_requests, time.time() - max_age),
+            ).fetchall()
+            batches = []
+            for api_key, headers in due:
+                calls, size = [], 0
+                for queued_id, body in db.execute(
+                    "SELECT id, body FROM queued WHERE state = 'queued' AND api_key = ? AND headers = ? "
+                    'ORDER BY created', (api_key, headers),
+                ):
+                    if calls and (len(calls) >= max_requests or size + len(body) > max_bytes):
+                        batches.append((api_key, json.loads(headers), calls))
+                        calls, size = [], 0
+                    calls.append((queued_id, body))
+                    size += len(body)
+                if calls:
+                    batches.append((api_key, json.loads(headers), calls))
+            now = time.time()
+            db.executemany(
+                "UPDATE queued SET state = 'submitting', claimed = ? WHERE id = ?",
+                [(now, queued_id) for _, _, calls in batches for queued_id, _ in calls],
+            )
+            db.commit()
+        return batches
+
+    def release(self, ids):
+        """Put claimed calls back in the queue after a submission that didn't go through"""
+        with self._lock:
+            db = self.open()
+            db.executemany("UPDATE queued SET state = 'queued', claimed = NULL WHERE id = ? AND state = 'submitting'",
+                           [(queued_id,) for queued_id in ids])
+            db.commit()
+
+    def stranded(self, claimed_before, exclude=()):
+        """Ids claimed before `claimed_before` that no submission recorded, bar `exclude`
+
+        Their process stopped between posting the batch and storing its id,
+        so whether the API has them is unknown.
+        """
+        with self._lock:
+            rows = self.open().execute(
+                "SELECT id FROM queued WHERE state = 'submitting' AND claimed < ?", (claimed_before,),
+            ).fetchall()
+        return [queued_id for queued_id, in rows if queued_id not in exclude]
+    def submitted(self, batch_id, api_key, headers, ids, size):
+        with self._lock:
+            db = self.open()
+            now = time.time()
+            db.execute(
+                "INSERT INTO batch VALUES (?, ?, ?, ?, ?, ?, 'in_progress', ?)",
+                (batch_id, api_key, json.dumps(headers, sort_keys=True), now, len(ids), size, now),
+            )
+            db.executemany(
+                "UPDATE queued SET state = 'submitted', batch_id = ?, api_key = NULL, body = NULL WHERE id = ? "
+                "AND state = 'submitting'",
+                [(batch_id, queued_id) for queued_id in ids],
+            )
+            db.commit()
+        self.stats['batches_submitted'] += 1
+        self.stats['requests_submitted'] += len(ids)
+
+    def due_for_poll(self, poll_interval):
+        """[(batch id, api key, headers)] not polled for `poll_interval` seconds"""
+        with self._lock:
+            rows = self.open().execute(
+                'SELECT id, api_key, headers FROM batch WHERE polled <= ?', (time.time() - poll_interval,),
+            ).fetchall()
+        return [(batch_id, api_key, json.loads(headers)) for batch_id, api_key, headers in rows]
+
+    def fail(self, batch_id, result):
+        """Answer every call still in `batch_id` with the error `result`; returns what finish() does"""
+        with self._lock:
+            ids = [queued_id for queued_id, in self.open().execute(
+                "SELECT id FROM queued WHERE batch_id = ? AND state = 'submitted'", (batch_id,),
+            )]
+        self.stats['batches_failed'] += 1
+        return self.finish([(queued_id, 'errored', result) for queued_id in ids], batch_id)
+
+    def polled(self, batch_id, status):
+        with self._lock:
+            db = self.open()
+            db.execute('UPDATE batch SET status = ?, polled = ? WHERE id = ?', (status, time.time(), batch_id))
+            db.commit()
+
+    def finish(self, results, batch_id=None):
+        """Store [(id, state, result bytes)] and drop the finished batch with its key
+
+        Returns [(id, developer, model, created, webhook)] for the calls that
+        were still unanswered, so a result is only ever accounted once.
+        """
+        with self._lock:
+            db = self.open()
+            now = time.time()
+            finished = []
+            for queued_id, state, result in results:
+                row = db.execute(
+                    'SELECT developer, model, created, webhook FROM queued WHERE id = ? '
+                    "AND state IN ('queued', 'submitting', 'submitted')",
+                    (queued_id,),
+                ).fetchone()
+                if row is None:
+                    continue
+                db.execute(
+                    'UPDATE queued SET state = ?, result = ?, finished = ?, api_key = NULL, body = NULL WHERE id = ?',
+                    (state, result, now, queued_id),
+                )
+                finished.append((queued_id,) + row)
+                self.stats[state] += 1
+            if batch_id is not None:
+                db.execute('DELETE FROM batch WHERE id = ?', (batch_id,))
+            db.commit()
+        return finished
+
+    def prune(self, result_ttl):
+        """Forget answered calls older than `result_ttl`; returns how many"""
+        with self._lock:
+            db = self.open()
+            placeholders = ', '.join('?' * len(self.FINISHED))
+            removed = db.execute(
+                f'DELETE FROM queued WHERE state IN ({placeholders}) AND finished < ?',
+                self.FINISHED + (time.time() - result_ttl,),
+            ).rowcount
+            db.commit()
+        return removed
+
+    def snapshot(self):
+        with self._lock:
+            db = self.open()
+            states = dict(db.execute('SELECT state, COUNT(*) FROM queued GROUP BY state').fetchall())
+            oldest = db.execute("SELECT MIN(created) FROM queued WHERE state = 'queued'").fetchone()[0]
+            batches = [
+                dict(zip(('id', 'submitted', 'requests', 'bytes', 'status'), row))
+                for row in db.execute('SELECT id, submitted, requests, bytes, status FROM batch ORDER BY submitted')
             ]
+        return {
+            'states': states,
+            'oldest_queued_seconds': round(time.time() - oldest, 1) if oldest else None,
+            'batches': batches,
+            'stats': dict(self.stats),
+        }
+
+
+batch_queue = BatchQueue(CONFIG['batch_db'])
+batch_session = None
+BATCH_HEADER = 'x-claude-proxy-batch'
+BATCH_WEBHOOK_HEADER = 'x-claude-proxy-batch-webhook'
+# API headers that change how a batched call is answered; calls are only batched with identical ones
+BATCH_API_HEADERS = ('anthropic-version', 'anthropic-beta')
+# HTTP status a fetch returns for each batch error type
+BATCH_ERROR_STATUSES = {
+    'invalid_request_error': 400, 'authentication_error': 401, 'permission_error': 403, 'not_found_error': 404,
+    'request_too_large': 413, 'rate_limit_error': 429, 'overloaded_error': 529,
+}
+
+
+def batch_webhook_allowed(url):
+    prefixes = [prefix.strip() for prefix in CONFIG['batch_webhook_prefixes'].split(',') if prefix.strip()]
+    return any(url.startswith(prefix) for prefix in prefixes)
+
+
+async def enqueue_batch_call(request, developer, api_key, payload, body):
+    """Queue a /v1/messages call for the next Message Batches submission (202 with where to fetch it)"""
+    # The body is spliced into the submission as is, so one malformed call would sink its whole batch.
+    # A body that isn't a JSON object has been parsed as {}.
+    if not isinstance(payload.get('messages'), list) or not payload.get('model'):
+        return JSONResponse(
+            {'type': 'error', 'error': {'type': 'invalid_request_error',
+                                        'message': 'Batched calls need a JSON object body with model and messages'}},
+            status_code=400,
         )
-    except Exception as e:
-        print(f"Error sending metrics: {e}")
+    webhook = request.headers.get(BATCH_WEBHOOK_HEADER)
+    if webhook and not batch_webhook_allowed(webhook):
+        return JSONResponse(
+            {'type': 'error', 'error': {'type': 'invalid_request_error',
+                                        'message': f'{BATCH_WEBHOOK_HEADER} is not an allowed webhook URL'}},
+            status_code=400,
+        )
+    budget_status, budget_message = budget.check(developer)
+    if budget_status == 'exceeded':
+        raise BudgetExceeded(budget_message)
+    if 'stream' in payload:
+        # Batched calls are never streamed; the whole message is fetched later
+        body = json.dumps({key: value for key, value in payload.items() if key != 'stream'}).encode()
+    headers = {name: request.headers[name] for name in BATCH_API_HEADERS if name in request.headers}
+    headers.setdefault('anthropic-version', '2023-06-01')
+    queued_id = await run_in_threadpool(
+        batch_queue.enqueue, developer, api_key, headers, body, str(payload.get('model', '')), webhook,
+    )
+    extra = {'x-claude-proxy-budget-warning': budget_message} if budget_status == 'warn' else {}
+    return JSONResponse(
+        {'id': queued_id, 'type': 'queued_message', 'status': 'queued',
+         'results_url': f'/v1/messages/queued/{queued_id}'},
+        status_code=202, headers=extra,
+    )
+
+
+def batch_api_url():
+    return (CONFIG['batch_api_url'] or CLAUDE_API_URL).rstrip('/')
+
+
+async def submit_batch(api_key, headers, calls):
+    """POST one Message Batches submission; returns the batch id
+
+    The request bodies are spliced in as stored, without parsing them again.
+    """
+    body = b''.join((
+        b'{"requests":[',
+        b','.join(b'{"custom_id":"%s","params":%s}' % (queued_id.encode(), call) for queued_id, call in calls),
+        b']}',
+    ))
+    async with batch_session.post(
+        f'{batch_api_url()}/messages/batches', data=body,
+        headers=dict(headers, **{'x-api-key': api_key, 'content-type': 'application/json'}),
+    ) as response:
+        data = await response.read()
+        if response.status >= 400:
+            raise aiohttp.ClientResponseError(
+                response.request_info, response.history, status=response.status,
+                message=data[:500].decode('utf-8', 'replace'),
+            )
+    return json.loads(data)['id'], len(body)
+
+
+async def collect_batch(batch_id, api_key, headers):
+    """Poll a batch; once it has ended, store, account and deliver its results"""
+    headers = dict(headers, **{'x-api-key': api_key})
+    async with batch_session.get(f'{batch_api_url()}/messages/batches/{batch_id}', headers=headers) as response:
+        response.raise_for_status()
+        batch = await response.json()
+    status = batch.get('processing_status', 'in_progress')
+    if status != 'ended' or not batch.get('results_url'):
+        await run_in_threadpool(batch_queue.polled, batch_id, status)
+        return
+
+    results, usages = [], {}
+    async with batch_session.get(batch['results_url'], headers=headers) as response:
+        response.raise_for_status()
+        # One JSON line per call, in no particular order
+        async for line in read_lines(response):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            result = entry.get('result', {})
+            state = result.get('type', 'errored')
+            if state == 'succeeded':
+                message = result['message']
+                usages[entry['custom_id']] = (message.get('model'), message.get('usage', {}))
+                payload = message
+            else:
+                payload = result.get('error') or {'type': 'error', 'error': {'type': state, 'message': f'Batch call {state}'}}
+            results.append((entry['custom_id'], state, json.dumps(payload).encode()))
+    finished = await run_in_threadpool(batch_queue.finish, results, batch_id)
+
+    bodies = {queued_id: (state, body) for queued_id, state, body in results}
+    now = time.time()
+    for queued_id, developer, model, created, webhook in finished:
+        if queued_id in usages:
+            routed_model, usage = usages[queued_id]
+            spawn(record_usage(
+                developer, routed_model or model, usage.get('input_tokens', 0), usage.get('output_tokens', 0),
+                now - created, cache_read_tokens=usage.get('cache_read_input_tokens') or 0,
+                cache_write_tokens=usage.get('cache_creation_input_tokens') or 0, batch=True,
+            ))
+        if webhook:
+            spawn(deliver_batch_webhook(webhook, queued_id, *bodies[queued_id]))
+
+
+def batch_error_is_transient(error):
+    """Whether collecting a batch that raised `error` may work on a later pass
+
+    A 404 (the batch or its results are gone), a revoked key or results
+    this proxy can't read won't get better.
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRYABLE_STATUSES
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError, sqlite3.Error))
+
+
+async def fail_batch(batch_id, error):
+    """Answer every call in a batch whose results can't be collected with an error"""
+    print(f"Error collecting message batch {batch_id}, marking its calls errored: {error!r}")
+    result = batch_api_error(f'Batch {batch_id} results could not be collected')
+    deliver_errors(await run_in_threadpool(batch_queue.fail, batch_id, result), result)
 
 
-@app.route('/v1/messages', methods=['POST'])
-def proxy_messages():
+async def fail_calls(ids, message):
+    """Answer queued calls with an api_error"""
+    print(f"Error in message batches, marking {len(ids)} calls errored: {message}")
+    result = batch_api_error(message)
+    deliver_errors(await run_in_threadpool(batch_queue.finish, [(queued_id, 'errored', result) for queued_id in ids]),
+                   result)
+
+
+def batch_api_error(message):
+    return json.dumps({'type': 'error', 'error': {'type': 'api_error', 'message': message}}).encode()
+
+
+def deliver_errors(finished, result):
+    for queued_id, _, _, _, webhook in finished:
+        if webhook:
+            spawn(deliver_batch_webhook(webhook, queued_id, 'errored', result))
+
+
+async def deliver_batch_webhook(url, queued_id, state, result):
+    """POST one finished call to its webhook; the result stays fetchable either way"""
+    body = b'{"id":"%s","status":"%s","result":%s}' % (queued_id.encode(), state.encode(), result)
+    headers = {'content-type': 'application/json'}
+    if CONFIG['batch_webhook_secret']:
+        signature = hmac.new(CONFIG['batch_webhook_secret'].encode(), body, hashlib.sha256).hexdigest()
+        headers['x-claude-proxy-signature'] = f'sha256={signature}'
+    try:
+        async with batch_session.post(url, data=body, headers=headers,
+                                      timeout=aiohttp.ClientTimeout(total=30)) as response:
+            response.raise_for_status()
+        batch_queue.stats['webhooks_delivered'] += 1
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        batch_queue.stats['webhooks_failed'] += 1
+        print(f"Error delivering batch result {queued_id} to webhook: {e}")
+
+
+async def submit_due_batch(api_key, headers, calls, unrecorded):
+    """Submit one batch claimed by BatchQueue.ready() and record it
+
+    A submission the API accepted but that couldn't be stored goes on
+    `unrecorded` to be stored on a later pass, never submitted again.
+    """
+    ids = [queued_id for queued_id, _ in calls]
+    try:
+        batch_id, size = await submit_batch(api_key, headers, calls)
+    except aiohttp.ClientResponseError as e:
+        if e.status in RETRYABLE_STATUSES:
+            await run_in_threadpool(batch_queue.release, ids)
+            raise
+        # Rejected outright (say, a malformed call): answer every call in it with the error
+        error = json.dumps({'type': 'error', 'error': {'type': 'invalid_request_error',
+                                                       'message': e.message}}).encode()
+        await run_in_threadpool(batch_queue.finish, [(queued_id, 'errored', error) for queued_id in ids])
+        print(f"Error submitting batch of {len(calls)} calls: {e.status} {e.message}")
+        return
+    except BaseException:
+        # Not accepted as far as we know; blocking, so a cancelled runner still puts them back
+        batch_queue.release(ids)
+        raise
+    submission = (batch_id, api_key, headers, ids, size)
+    try:
+        await run_in_threadpool(batch_queue.submitted, *submission)
+    except sqlite3.Error:
+        unrecorded.append(submission)
+        raise
+
+
+async def run_batches():
+    """Submit due batches, poll submitted ones and prune old results, every batch_check_interval"""
+    last_prune = 0.0
+    # Submissions the API accepted that are not stored yet
+    unrecorded = []
+    while True:
+        await asyncio.sleep(CONFIG['batch_check_interval'])
+        # Nothing has ever been queued
+        if not batch_queue.exists():
+            continue
+        try:
+            while unrecorded:
+                await run_in_threadpool(batch_queue.submitted, *unrecorded[0])
+                unrecorded.pop(0)
+            # Claimed by a process that stopped before storing the batch id: answer them rather than
+            # risk submitting and billing them twice. A submission can't take longer than the timeout
+            stranded = await run_in_threadpool(
+                batch_queue.stranded, time.time() - 2 * CONFIG['upstream_timeout'],
+                {queued_id for submission in unrecorded for queued_id in submission[3]},
+            )
+            if stranded:
+                await fail_calls(stranded, 'Batch submission interrupted; its outcome is unknown, send the call again')
+            due = await run_in_threadpool(
+                batch_queue.ready, CONFIG['batch_min_requests'], CONFIG['batch_max_age'],
+                CONFIG['batch_max_requests'], CONFIG['batch_max_mb'] * 1024 * 1024,
+            )
+            for index, (api_key, headers, calls) in enumerate(due):
+                try:
+                    await submit_due_batch(api_key, headers, calls, unrecorded)
+                except BaseException:
+                    # Claimed but not tried this pass
+                    for _, _, rest in due[index + 1:]:
+                        batch_queue.release([queued_id for queued_id, _ in rest])
+                    raise
+            for batch_id, api_key, headers in await run_in_threadpool(batch_queue.due_for_poll,
+                                                                      CONFIG['batch_poll_interval']):
+                try:
+                    await collect_batch(batch_id, api_key, headers)
+                except Exception as e:
+                    # One batch's trouble must not hold up the others, or stop this loop
+                    if not batch_error_is_transient(e):
+                        await fail_batch(batch_id, e)
+                        continue
+                    batch_queue.stats['errors'] += 1
+                    print(f"Error collecting message batch {batch_id}: {e}")
+            if time.monotonic() - last_prune > 3600:
+                last_prune = time.monotonic()
+                await run_in_threadpool(batch_queue.prune, CONFIG['batch_result_ttl'])
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, sqlite3.Error, ValueError, KeyError) as e:
+            # Whatever was not stored yet is retried on the next pass
+            batch_queue.stats['errors'] += 1
+            print(f"Error processing message batches: {e}")
+
+
+async def fetch_queued(request):
+    """A queued call's result: 202 while it waits, then the message (or its error) as /v1/messages returns it"""
+    api_key = request.headers.get('x-api-key')
+    if not api_key:
+        return JSONResponse({'error': 'Missing API key'}, status_code=401)
+    queued_id = request.path_params['queued_id']
+    entry = await run_in_threadpool(batch_queue.get, queued_id) if batch_queue.exists() else None
+    # Only the key that queued a call can fetch it; every unrecognised key is developer 'unknown'
+    if entry is None or not hmac.compare_digest(entry['key_digest'] or b'', DeveloperKeyIndex.digest(api_key)):
+        return JSONResponse({'type': 'error', 'error': {'type': 'not_found_error', 'message': 'No such queued call'}},
+                            status_code=404)
+    if entry['state'] == 'succeeded':
+        return Response(entry['result'], media_type='application/json')
+    if entry['state'] in BatchQueue.FINISHED:
+        error_type = json.loads(entry['result']).get('error', {}).get('type')
+        return Response(entry['result'], status_code=BATCH_ERROR_STATUSES.get(error_type, 502),
+                        media_type='application/json')
+    return JSONResponse(
+        {'id': queued_id, 'type': 'queued_message', 'status': entry['state'], 'batch_id': entry['batch_id'],
+         'queued_seconds': round(time.time() - entry['created'], 1)},
+        status_code=202, headers={'retry-after': str(int(CONFIG['batch_poll_interval']))},
+    )
+
+
+async def proxy_messages(request):
     """Proxy Claude API messages endpoint with tracking"""
+    trace = request.state.trace = RequestTrace(request.headers.get('traceparent'), CONFIG['trace_sample_rate'])
+    traffic_capture.begin(trace)
+    response = await handle_messages(request)
+    labels = getattr(request.state, 'metric_labels', ('unknown', 'other'))
+    REQUESTS.inc(labels + (str(response.status_code),))
+
+    trace.attributes.update({'developer': labels[0], 'model': labels[1], 'http.response.status_code': response.status_code})
+    response.headers['server-timing'] = trace.server_timing()
+    response.background = BackgroundTask(after_response, trace, response.background)
+    return response
+
+
+async def after_response(trace, background):
+    """Close the trace once the body (or the whole stream) has been sent"""
+    try:
+        if background:
+            await background()
+    finally:
+        trace.mark('respond')
+        finish_trace(trace)
+
+
+async def handle_messages(request):
+    """Serve one Messages API call from the cache, an in-flight twin or upstream"""
 
     # Get API key from header
     api_key = request.headers.get('x-api-key')
     if not api_key:
-        return {'error': 'Missing API key'}, 401
+        return JSONResponse({'error': 'Missing API key'}, status_code=401)
 
     # Get developer ID
+    trace = request.state.trace
     developer = get_developer_from_key(api_key)
+    # Bedrock is signed with the proxy's role and never sees the key; with no backend that checks
+    # it, an unrecognised key stops here
+    if developer == 'unknown' and not router.allowed(trusted=False):
+        return JSONResponse({'error': 'Invalid API key'}, status_code=401)
+    trace.mark('auth')
 
     # Forward request to Claude API
     headers = {
         'x-api-key': api_key,
         'anthropic-version': request.headers.get('anthropic-version', '2023-06-01'),
         'content-type': 'application/json',
+        'traceparent': trace.upstream_traceparent(),
     }
+    if 'anthropic-beta' in request.headers:
+        headers['anthropic-beta'] = request.headers['anthropic-beta']
 
     start_time = time.time()
 
     try:
-        response = requests.post(
-            f"{CLAUDE_API_URL}/messages",
-            headers=headers,
-            json=request.json,
-            timeout=300
-        )
+        body = await request.body()
+        trace.mark('read')
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = {}
+        if not isinstance(payload, dict):
+            payload = {}
+        trace.mark('parse')
 
-        elapsed_time = time.time() - start_time
+        labels = request.state.metric_labels = (developer, metric_model(payload.get('model')))
+        REQUEST_BYTES.observe(labels, len(body))
+        capture = trace.capture
+        if capture is not None:
+            capture.update(traffic_capture.shape(payload, body))
 
-        # Parse response for usage data
-        if response.status_code == 200:
-            response_data = response.json()
-            usage = response_data.get('usage', {})
+        if request.headers.get(BATCH_HEADER) == '1' and batch_queue.path:
+            response = await enqueue_batch_call(request, developer, api_key, payload, body)
+            trace.mark('batch_queue')
+            return response
 
+        cache_key = cache_key_for(request, payload)
+        if cache_key:
+            cached = await lookup_cached_response(cache_key)
+            trace.mark('cache')
+            if cached:
+                spawn(record_usage(
+                    developer, cached.model, cached.input_tokens, cached.output_tokens,
+                    time.time() - start_time, source='cache',
+                ))
+                return Response(
+                    cached.body,
+                    status_code=cached.status,
+                    headers=dict(cached.headers, **{'x-claude-proxy-cache': 'hit'}),
+                )
+
+        # Lead a new flight straight away, so identical requests arriving while this one waits
+        # on budgets and admission join it rather than going upstream themselves
+        flight_key = coalesce_key_for(request, payload)
+        flight = None
+        while flight_key:
+            leader = in_flight.get(flight_key)
+            if leader is None:
+                flight = in_flight[flight_key] = Flight()
+                COALESCE_STATS['leaders'] += 1
+                break
+            response = await follow_flight(leader, developer, payload.get('model', 'unknown'), start_time)
+            if response is not None:
+                trace.mark('coalesced')
+                return response
+
+        try:
+            # Only requests that will actually go upstream count against budgets and rate limits
+            budget_status, budget_message = budget.check(developer)
+            if budget_status == 'exceeded':
+                raise BudgetExceeded(budget_message)
+            extra_headers = {'x-claude-proxy-budget-warning': budget_message} if budget_status == 'warn' else {}
+            trace.mark('budget')
+
+            # After the cache and coalescing keys, which stay those of the request as sent
+            requested_model = None
+            if model_routing.mode != 'off':
+                requested_model = model_routing.route(developer, request.headers, payload)
+                if requested_model:
+                    labels = request.state.metric_labels = (developer, metric_model(payload['model']))
+                    extra_headers['x-claude-proxy-routed-from'] = requested_model
+                    if capture is not None:
+                        capture['routed_model'] = payload['model']
+                trace.mark('model_routing')
+            injected = CONFIG['prompt_cache_enabled'] and prompt_cache.inject(developer, payload, body)
+            if requested_model or injected:
+                body = json.dumps(payload).encode()
+                trace.mark('prompt_cache' if injected else 'rewrite')
+
+            permit = await admission.acquire(developer, estimate_input_tokens(body))
+            trace.mark('admission')
+            ADMISSION_WAIT.observe((developer,), trace.phases[-1][2])
+        except BaseException:
+            if flight:
+                flight.fail(FlightAbandoned())
+                end_flight(flight_key, flight)
+            raise
+
+        try:
+            upstream_start = time.perf_counter()
+            # Only short non-streaming calls are worth paying twice for
+            max_tokens = payload.get('max_tokens')
+            hedge = (
+                not payload.get('stream') and isinstance(max_tokens, int)
+                and 0 < max_tokens <= CONFIG['hedge_max_tokens']
+            )
+            response, backend = await call_upstream(
+                headers, body, payload, trace, hedge=hedge, trusted=developer != 'unknown',
+            )
+            trace.mark('upstream')
+            extra_headers['x-claude-proxy-backend'] = backend.name
+
+            # Streamed completions are relayed chunk by chunk; the generator owns the response
+            # and releases the permit when the stream ends
+            if payload.get('stream') and response.status == 200:
+                stream = relay_stream(
+                    response, developer, start_time, cache_key, flight, permit,
+                    labels=labels, upstream_start=upstream_start, capture=capture, requested_model=requested_model,
+                )
+                if flight:
+                    # Followers read the same tee; the flight stays joinable until the stream ends
+                    tee = StreamTee()
+                    flight.publish(response.status, forwarded_headers(response), tee)
+                    spawn(pump_stream(stream, tee, flight_key, flight))
+                    stream = tee.follow()
+                return relay_response(
+                    response, stream, extra_headers,
+                    # In case the client goes away before the stream is ever started
+                    background=None if flight else BackgroundTask(release_stream, response, permit),
+                )
+
+            UPSTREAM_TTFB.observe(labels, trace.phases[-1][2])
+            async with response:
+                content = await read_body(response)
+            permit.release()
+            trace.mark('upstream_body')
+            UPSTREAM_LATENCY.observe(labels, time.perf_counter() - upstream_start)
+            RESPONSE_BYTES.observe(labels, len(content))
+            if capture is not None:
+                capture.update(
+                    upstream_ttfb=round(trace.phases[-2][2], 4),
+                    upstream_latency=round(time.perf_counter() - upstream_start, 4), response_bytes=len(content),
+                )
+        except BaseException as e:
+            permit.release()
+            if flight:
+                flight.fail(e if isinstance(e, Exception) else RuntimeError('upstream call cancelled'))
+                end_flight(flight_key, flight)
+            raise
+
+        # Relayed as a view of the read buffer, never copied into a bytes object
+        body_view = memoryview(content)
+        if flight:
+            flight.publish(response.status, forwarded_headers(response), body_view)
+            end_flight(flight_key, flight)
+
+        elapsed_time = time.time() - start_time
+
+        # Pull usage out of the head and tail of the body rather than parsing all of it
+        if response.status == 200:
+            scanned = scan_usage(content)
+            if scanned is None:
+                response_data = json.loads(content)
+                scanned = response_data.get('model', 'unknown'), response_data.get('usage', {})
+            model, usage = scanned
             input_tokens = usage.get('input_tokens', 0)
             output_tokens = usage.get('output_tokens', 0)
-            model = response_data.get('model', 'unknown')
-
-            # Calculate cost
-            cost = calculate_cost(model, input_tokens, output_tokens)
-
-            # Log to CloudWatch
-            log_data = {
-                'timestamp': datetime.utcnow().isoformat(),
-                'developer': developer,
-                'model': model,
-                'input_tokens': input_tokens,
-                'output_tokens': output_tokens,
-                'total_tokens': input_tokens + output_tokens,
-                'cost_usd': round(cost, 6),
-                'response_time_seconds': round(elapsed_time, 2),
-                'status': 'success'
-            }
+            if capture is not None:
+                capture.update(
+                    input_tokens=input_tokens, output_tokens=output_tokens,
+                    cache_read_tokens=usage.get('cache_read_input_tokens') or 0,
+                    cache_write_tokens=usage.get('cache_creation_input_tokens') or 0,
+                )
 
-            log_to_cloudwatch(log_data)
-            send_metrics_to_cloudwatch(developer, model, input_tokens, output_tokens, cost)
+            if cache_key:
+                store_cached_response(
+                    cache_key, response.status, forwarded_headers(response), bytes(content),
+                    model, input_tokens, output_tokens,
+                )
 
-        return Response(
-            response.content,
-            status=response.status_code,
-            headers=dict(response.headers)
+            # Telemetry never holds up the response
+            spawn(record_usage(
+                developer, model, input_tokens, output_tokens, elapsed_time,
+                followers=flight.followers if flight else 0,
+                cache_read_tokens=usage.get('cache_read_input_tokens') or 0,
+                cache_write_tokens=usage.get('cache_creation_input_tokens') or 0,
+                requested_model=requested_model,
+            ))
+
+        return relay_response(response, body_view, extra_headers)
+
+    except BudgetExceeded as e:
+        log_error(developer, e, status='budget_exceeded')
+
+        # Not retryable until the budget period rolls over, so not a 429
+        return JSONResponse(
+            {'type': 'error', 'error': {'type': 'permission_error', 'message': str(e)}},
+            status_code=403,
+        )
+
+    except RateLimited as e:
+        log_error(developer, e, status='rate_limited')
+
+        # Same shape as the Messages API's own 429 so clients back off the same way
+        return JSONResponse(
+            {'type': 'error', 'error': {'type': 'rate_limit_error', 'message': str(e)}},
+            status_code=429,
+            headers={'retry-after': str(e.retry_after)},
+        )
+
+    except CircuitOpen as e:
+        log_error(developer, e, status='circuit_open')
+
+        return JSONResponse(
+            {'type': 'error', 'error': {'type': 'overloaded_error', 'message': str(e)}},
+            status_code=503,
+            headers={'retry-after': str(e.retry_after)},
+        )
+
+    except UPSTREAM_NETWORK_ERRORS as e:
+        log_error(developer, e, status='upstream_unreachable')
+
+        return JSONResponse(
+            {'type': 'error', 'error': {'type': 'api_error', 'message': f'Upstream request failed: {e!r}'}},
+            status_code=502,
         )
 
     except Exception as e:
         # Log error
-        log_data = {
-            'timestamp': datetime.utcnow().isoformat(),
-            'developer': developer,
-            'status': 'error',
-            'error': str(e)
-        }
-        log_to_cloudwatch(log_data)
+        log_error(developer, e)
 
-        return {'error': str(e)}, 500
+        return JSONResponse({'error': str(e)}, status_code=500)
 
 
-@app.route('/health', methods=['GET'])
-def health():
+async def health(request):
     """Health check endpoint"""
-    return {'status': 'healthy', 'service': 'claude-proxy'}
+    return JSONResponse({'status': 'healthy', 'service': 'claude-proxy'})
+
+
+def create_pool_trace_config():
+    """aiohttp trace hooks that count new, reused and queued upstream connections"""
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_create(session, ctx, params):
+        POOL_STATS['connections_created'] += 1
+
+    async def on_reuse(session, ctx, params):
+        POOL_STATS['connections_reused'] += 1
+
+    async def on_queued_start(session, ctx, params):
+        ctx.queued_at = time.perf_counter()
+        POOL_STATS['waits'] += 1
+
+    async def on_queued_end(session, ctx, params):
+        POOL_STATS['wait_seconds'] += time.perf_counter() - ctx.queued_at
+
+    trace_config.on_connection_create_end.append(on_create)
+    trace_config.on_connection_reuseconn.append(on_reuse)
+    trace_config.on_connection_queued_start.append(on_queued_start)
+    trace_config.on_connection_queued_end.append(on_queued_end)
+    return trace_config
+
+
+def create_http_client():
+    """Upstream session with a persistent keep-alive connection pool (one per backend)"""
+    ssl_context = True
+    if CONFIG['upstream_ca_bundle']:
+        ssl_context = ssl.create_default_context(cafile=CONFIG['upstream_ca_bundle'])
+
+    keepalive_timeout = CONFIG['upstream_keepalive_timeout']
+    connector = aiohttp.TCPConnector(
+        limit=CONFIG['upstream_max_connections'],
+        limit_per_host=CONFIG['upstream_max_per_host'],
+        keepalive_timeout=keepalive_timeout if keepalive_timeout > 0 else None,
+        force_close=keepalive_timeout <= 0,
+        ssl=ssl_context,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=CONFIG['upstream_timeout']),
+        trace_configs=[create_pool_trace_config()],
+    )
+
+
+def pool_stats():
+    """Snapshot of upstream connection pool usage, totalled over the backends' pools"""
+    created = POOL_STATS['connections_created']
+    reused = POOL_STATS['connections_reused']
+    backends = {}
+    for backend in router.backends:
+        connector = backend.session.connector
+        # aiohttp has no public API for these; read the connector's bookkeeping
+        backends[backend.name] = {
+            'in_use': len(getattr(connector, '_acquired', ())),
+            'idle': sum(len(conns) for conns in getattr(connector, '_conns', {}).values()),
+        }
+    in_use = sum(pool['in_use'] for pool in backends.values())
+    idle = sum(pool['idle'] for pool in backends.values())
+    return {
+        'max_connections': CONFIG['upstream_max_connections'],
+        'max_per_host': CONFIG['upstream_max_per_host'],
+        'keepalive_timeout': CONFIG['upstream_keepalive_timeout'],
+        'connections_created': created,
+        'connections_reused': reused,
+        'reuse_ratio': round(reused / (created + reused), 4) if created + reused else 0.0,
+        'waits': POOL_STATS['waits'],
+        'wait_seconds': round(POOL_STATS['wait_seconds'], 3),
+        'open_sockets': in_use + idle,
+        'in_use': in_use,
+        'idle': idle,
+        'backends': backends,
+    }
+
+
+def upstream_connections():
+    stats = pool_stats()
+    return {('in_use',): stats['in_use'], ('idle',): stats['idle']}
+
+
+# Gauges are read from the live structures at scrape time, so they cost nothing per request
+prometheus.gauge(
+    'in_flight_requests', 'Admitted upstream calls in flight ("*" is the global total)', ('developer',),
+    lambda: {(key,): count for key, count in admission.in_flight.items()})
+prometheus.gauge(
+    'admission_queue_depth', 'Requests waiting for admission', ('developer',),
+    lambda: {(developer,): len(waiters) for developer, waiters in admission.waiters.items()})
+prometheus.gauge(
+    'upstream_connections', 'Upstream pool sockets by state', ('state',), upstream_connections)
+prometheus.gauge(
+    'upstream_circuit_open', 'Whether the upstream circuit breaker is failing calls fast (half-open counts)',
+    ('upstream',), lambda: {(backend.name,): int(backend.breaker.state != 'closed') for backend in router.backends},
+    merge='max')
+prometheus.gauge(
+    'upstream_latency_ewma_seconds', 'Smoothed seconds to response headers the router weighs backends by',
+    ('backend',), lambda: {(backend.name,): backend.latency or 0.0 for backend in router.backends},
+    merge='mean')
+prometheus.gauge(
+    'coalesced_flights', 'Upstream calls that identical requests can attach to', (),
+    lambda: {(): len(in_flight)})
+prometheus.gauge(
+    'log_queue_depth', 'Usage records waiting for the CloudWatch Logs shipper', (),
+    lambda: {(): log_shipper.queue.qsize()})
+prometheus.gauge(
+    'journal_pending_records', 'Usage records waiting for the next journal commit', (),
+    lambda: {(): len(usage_journal._pending)})
+
+
+async def metrics(request):
+    """Prometheus scrape endpoint"""
+    return Response(prometheus.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+async def debug_pool(request):
+    """Upstream connection pool statistics"""
+    return JSONResponse(pool_stats())
+
+
+async def debug_traces(request):
+    """Span exporter and slow-request log statistics"""
+    return JSONResponse({
+        'export': CONFIG['trace_export'] or None,
+        'sample_rate': CONFIG['trace_sample_rate'],
+        'exporter': dict(span_exporter.stats, **span_exporter.queue.stats, queue_depth=span_exporter.queue.qsize()),
+        'slow_request_seconds': CONFIG['slow_request_seconds'],
+        'slow_requests': SLOW_REQUEST_STATS,
+        'capture': {
+            'file': CONFIG['capture_file'] or None,
+            'sample_rate': CONFIG['capture_sample_rate'],
+            'writer': dict(traffic_capture.stats, **traffic_capture.queue.stats,
+                           queue_depth=traffic_capture.queue.qsize()),
+        },
+    })
+
+
+async def debug_upstream(request):
+    """Routing, retry, hedging and circuit breaker state for each backend"""
+    return JSONResponse({
+        'backends': [backend.snapshot() for backend in router.backends],
+        'rejected': router.stats['rejected'],
+        'retry_budget': round(retry_budget.balance, 2),
+        'stats': RETRY_STATS,
+        'config': {
+            key: value for key, value in CONFIG.items()
+            if key.startswith(('retry_', 'hedge_', 'breaker_', 'router_', 'bedrock_'))
+        },
+    })
+
+
+async def debug_logs(request):
+    """CloudWatch Logs shipper statistics"""
+    return JSONResponse(dict(
+        log_shipper.stats, **log_shipper.queue.stats,
+        queue_depth=log_shipper.queue.qsize(), policy=log_shipper.queue.policy,
+    ))
+
+
+async def debug_cache(request):
+    """Response cache statistics"""
+    if response_cache is None:
+        return JSONResponse({'enabled': False})
+    return JSONResponse(dict(
+        response_cache.stats, enabled=True, entries=len(response_cache.entries), bytes=response_cache.bytes,
+    ))
+
+
+async def debug_prompt_cache(request):
+    """Prompt cache breakpoint injection and per-developer cache savings"""
+    return JSONResponse({
+        'enabled': CONFIG['prompt_cache_enabled'],
+        'ttl': CONFIG['prompt_cache_ttl'],
+        'min_tokens': CONFIG['prompt_cache_min_tokens'],
+        'injector': prompt_cache.stats,
+        'developers': prompt_cache_report.snapshot(),
+    })
+
+
+async def debug_model_routing(request):
+    """Model routing mode, rules and how many requests fell in each class"""
+    return JSONResponse(model_routing.snapshot())
+
+
+async def debug_batches(request):
+    """Message Batches offload queue: calls by state and the batches in flight"""
+    if not batch_queue.exists():
+        return JSONResponse({'enabled': bool(batch_queue.path), 'states': {}, 'batches': []})
+    return JSONResponse(dict(await run_in_threadpool(batch_queue.snapshot), enabled=True))
+
+
+async def debug_coalesce(request):
+    """Request coalescing statistics"""
+    return JSONResponse(dict(COALESCE_STATS, enabled=CONFIG['coalesce_enabled'], in_flight=len(in_flight)))
+
+
+def admin_denied(request):
+    """A 403 response unless the request may use a state-changing debug endpoint, else None"""
+    token = CONFIG['admin_token']
+    if token:
+        allowed = hmac.compare_digest(request.headers.get('x-claude-proxy-admin-token', '').encode(), token.encode())
+    else:
+        host = request.client.host if request.client else ''
+        allowed = host == '::1' or host.startswith('127.')
+    if allowed:
+        return None
+    return JSONResponse({'error': 'Admin token required (or connect from localhost)'}, status_code=403)
+
+
+async def read_json_object(request):
+    """(request body as a dict, None), or (None, a 400 response) if it isn't a JSON object"""
+    try:
+        body = await request.json()
+    except ValueError:
+        return None, JSONResponse({'error': 'Body must be a JSON object'}, status_code=400)
+    if not isinstance(body, dict):
+        return None, JSONResponse({'error': 'Body must be a JSON object'}, status_code=400)
+    return body, None
+
+
+async def debug_limits(request):
+    """Admission control state; POST a JSON object of limit_* keys to change limits (admin only)"""
+    if request.method == 'POST':
+        denied = admin_denied(request)
+        if denied:
+            return denied
+        updates, error = await read_json_object(request)
+        if error:
+            return error
+        unknown = [key for key in updates if not key.startswith('limit_') or key not in CONFIG]
+        if unknown:
+            return JSONResponse({'error': f'Unknown limit(s): {", ".join(unknown)}'}, status_code=400)
+        for key, value in updates.items():
+            # bool is an int, but never a limit
+            if (not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value)
+                    or value < 0 or (isinstance(CONFIG[key], int) and value != int(value))):
+                kind = 'a whole number' if isinstance(CONFIG[key], int) else 'a number'
+                return JSONResponse({'error': f'{key} must be {kind} >= 0'}, status_code=400)
+        for key, value in updates.items():
+            CONFIG[key] = type(CONFIG[key])(value)
+        # Queued requests may fit under the new limits
+        admission._dispatch()
+    return JSONResponse(admission.snapshot())
+
+
+async def debug_budget(request):
+    """Running spend for the current day/month and the configured limits"""
+    return JSONResponse({
+        'limits': {k: v for k, v in CONFIG.items() if k.startswith('budget_') and k.endswith('_usd')},
+        'spent': budget.totals(),
+    })
+
+
+async def debug_journal(request):
+    """Usage journal counters; POST {"since": ..., "until": ...} replays that window into CloudWatch (admin only)
+
+    Times are epoch seconds or ISO 8601 (UTC unless an offset is given).
+    """
+    if request.method == 'POST':
+        denied = admin_denied(request)
+        if denied:
+            return denied
+        window, error = await read_json_object(request)
+        if error:
+            return error
+        try:
+            since, until = (parse_time(window.get(k)) for k in ('since', 'until'))
+        except (TypeError, ValueError) as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+        if since is None:
+            return JSONResponse({'error': 'since is required'}, status_code=400)
+        result = await run_in_threadpool(
+            replay_journal_to_cloudwatch, since, until, window.get('logs', True), window.get('metrics', True),
+        )
+        return JSONResponse(result)
+    segments = UsageJournal.segment_names(usage_journal.directory)
+    return JSONResponse(dict(
+        usage_journal.stats,
+        enabled=usage_journal.enabled,
+        directory=usage_journal.directory,
+        segment_files=len(segments),
+        pending=len(usage_journal._pending),
+    ))
+
+
+async def debug_usage(request):
+    """Usage totals from the rollup store
+
+    GET ?since=...&until=...&group_by=developer,model (default: this UTC month
+    to now, by developer and model). POST {"rebuild": true} rebuilds the
+    rollups from the journal segments on disk (admin only).
+    """
+    if request.method == 'POST':
+        denied = admin_denied(request)
+        if denied:
+            return denied
+        body, error = await read_json_object(request)
+        if error:
+            return error
+        if body.get('rebuild'):
+            added = await run_in_threadpool(rollups.rebuild)
+            return JSONResponse({'rebuilt_records': added, 'stats': rollups.stats})
+        return JSONResponse({'error': 'nothing to do'}, status_code=400)
+    params = request.query_params
+    now = time.time()
+    try:
+        since = parse_time(params.get('since')) or month_start(now)
+        until = parse_time(params.get('until')) or now
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    group_by = tuple(c for c in params.get('group_by', 'developer,model').split(',') if c)
+    if not set(group_by) <= {'developer', 'model'}:
+        return JSONResponse({'error': 'group_by takes developer and/or model'}, status_code=400)
+    rows = await run_in_threadpool(rollups.query, since, until, group_by)
+    return JSONResponse({
+        'since': datetime.utcfromtimestamp(since).isoformat(),
+        'until': datetime.utcfromtimestamp(until).isoformat(),
+        'ranges': [[grain, start, end] for grain, start, end in RollupStore.cover(since, until)],
+        'rows': rows,
+        'stats': rollups.stats,
+    })
+
+
+def parse_time(value):
+    """Epoch seconds or an ISO 8601 string (naive = UTC) as epoch seconds; None passes through"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    with contextlib.suppress(ValueError):
+        return float(value)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+async def debug_pricing(request):
+    """Pricing table in USD per million tokens, resolved model IDs and unpriced models"""
+    return JSONResponse(pricing.snapshot())
+
+
+async def debug_metrics(request):
+    """CloudWatch Metrics aggregator statistics"""
+    return JSONResponse(metrics_aggregator.stats)
+
+
+async def debug_workers(request):
+    """Which pre-forked worker answered, and the shared counter table"""
+    if shared_counters is None:
+        return JSONResponse({'workers': 1, 'pid': os.getpid()})
+    return JSONResponse({
+        'workers': CONFIG['workers'],
+        'slot': worker_slot,
+        'pid': os.getpid(),
+        'shared': shared_counters.snapshot(),
+    })
+
+
+async def publish_metrics():
+    """Periodically publish this worker's metrics so a scrape of any worker includes them"""
+    while True:
+        await asyncio.sleep(CONFIG['shared_publish_interval'])
+        prometheus.publish()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Open the backends' upstream clients for the lifetime of the server"""
+    global batch_session
+    # Startup fails loudly if a configured key source can't be read
+    print(f"Loaded {await run_in_threadpool(developer_keys.reload)} developer keys")
+    key_watcher = spawn(watch_key_file())
+    cache_pruner = spawn(prune_cache_dir()) if response_cache and response_cache.disk_dir else None
+    if budget.shared is None:
+        # Under run_workers the launcher restored budgets before forking
+        await run_in_threadpool(restore_budget)
+    await run_in_threadpool(usage_journal.start)
+    rollup_updater = spawn(update_rollups()) if usage_journal.enabled and rollups.path else None
+    budget_checkpointer = spawn(checkpoint_budget()) if worker_slot in (None, 0) else None
+    metrics_publisher = spawn(publish_metrics()) if prometheus.shared else None
+    batch_session = create_http_client() if batch_queue.path else None
+    batch_runner = spawn(run_batches()) if batch_queue.path and worker_slot in (None, 0) else None
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGHUP, lambda: spawn(reload_developer_keys('SIGHUP'))
+    )
+
+    for backend in router.backends:
+        backend.open()
+    print(f"Routing to {', '.join(backend.name for backend in router.backends)}")
+    if any(backend.kind == 'bedrock' for backend in router.backends) and aws_session.get_credentials() is None:
+        print("Error: Bedrock backends configured but no AWS credentials found; calls will be unsigned")
+    log_shipper.start()
+    metrics_aggregator.start()
+    span_exporter.start()
+    traffic_capture.start()
+    try:
+        yield
+    finally:
+        key_watcher.cancel()
+        if cache_pruner:
+            cache_pruner.cancel()
+        if budget_checkpointer:
+            budget_checkpointer.cancel()
+        if metrics_publisher:
+            metrics_publisher.cancel()
+        if rollup_updater:
+            rollup_updater.cancel()
+        if batch_runner:
+            batch_runner.cancel()
+        if batch_session:
+            await batch_session.close()
+        await run_in_threadpool(batch_queue.close)
+        for backend in router.backends:
+            await backend.close()
+        # Flush whatever is still buffered before the process exits
+        await run_in_threadpool(log_shipper.close)
+        await run_in_threadpool(metrics_aggregator.close)
+        await run_in_threadpool(span_exporter.close)
+        await run_in_threadpool(traffic_capture.close)
+        await run_in_threadpool(usage_journal.close)
+        if rollup_updater:
+            await run_in_threadpool(rollups.update)
+            await run_in_threadpool(rollups.close)
+        state = budget.snapshot()
+        if state is not None:
+            await run_in_threadpool(budget.checkpoint, state)
+        if metrics_publisher:
+            prometheus.publish()
+
+
+app = Starlette(
+    routes=[
+        Route('/v1/messages', proxy_messages, methods=['POST']),
+        Route('/v1/messages/queued/{queued_id}', fetch_queued, methods=['GET']),
+        Route('/health', health, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/debug/pool', debug_pool, methods=['GET']),
+        Route('/debug/logs', debug_logs, methods=['GET']),
+        Route('/debug/traces', debug_traces, methods=['GET']),
+        Route('/debug/upstream', debug_upstream, methods=['GET']),
+        Route('/debug/metrics', debug_metrics, methods=['GET']),
+        Route('/debug/workers', debug_workers, methods=['GET']),
+        Route('/debug/cache', debug_cache, methods=['GET']),
+        Route('/debug/prompt-cache', debug_prompt_cache, methods=['GET']),
+        Route('/debug/model-routing', debug_model_routing, methods=['GET']),
+        Route('/debug/coalesce', debug_coalesce, methods=['GET']),
+        Route('/debug/batches', debug_batches, methods=['GET']),
+        Route('/debug/limits', debug_limits, methods=['GET', 'POST']),
+        Route('/debug/budget', debug_budget, methods=['GET']),
+        Route('/debug/pricing', debug_pricing, methods=['GET']),
+        Route('/debug/journal', debug_journal, methods=['GET', 'POST']),
+        Route('/debug/usage', debug_usage, methods=['GET', 'POST']),
+    ],
+    lifespan=lifespan,
+)
+
+
+def reuseport_socket(host, port):
+    """A listening socket bound alongside the others; the kernel spreads new connections across them"""
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    return sock
+
+
+class WorkerServer(uvicorn.Server):
+    """uvicorn.Server that drains on SIGTERM before its graceful shutdown
+
+    The first SIGTERM stops accepting (the launcher keeps the socket open,
+    so connections queued on it wait for the replacement rather than being
+    reset) and for `grace` seconds responses carry Connection: close, so
+    keep-alive clients reconnect instead of racing the close. Then uvicorn
+    finishes in-flight requests as usual.
+    """
+
+    def __init__(self, config, grace):
+        super().__init__(config)
+        self.grace = grace
+        self.draining = False
+
+    def handle_exit(self, sig, frame):
+        if sig == signal.SIGTERM and not self.draining and not self.should_exit:
+            self.draining = True
+        else:
+            super().handle_exit(sig, frame)
+
+    async def drain(self):
+        while not self.draining:
+            if self.should_exit:
+                return
+            await asyncio.sleep(0.05)
+        for server in self.servers:
+            server.close()
+        await asyncio.sleep(self.grace)
+        self.should_exit = True
+
+    def wrap(self, app):
+        """`app`, with Connection: close added to responses started while draining"""
+        async def draining_app(scope, receive, send):
+            if scope['type'] != 'http':
+                return await app(scope, receive, send)
+
+            async def send_message(message):
+                if self.draining and message['type'] == 'http.response.start':
+                    message = dict(message, headers=list(message.get('headers', ())) + [(b'connection', b'close')])
+                await send(message)
+            return await app(scope, receive, send_message)
+        return draining_app
+
+
+def run_worker(slot, column, sock, ready):
+    """Forked worker: serve on the launcher's socket for `slot`; writes to the `ready` fd once accepting"""
+    global admission, worker_slot
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_DFL)
+    # Until the lifespan installs its handlers, a forwarded SIGHUP or stray SIGUSR1 must not kill us
+    for signum in (signal.SIGHUP, signal.SIGUSR1):
+        signal.signal(signum, signal.SIG_IGN)
+    random.seed()
+    worker_slot = slot
+    shared_counters.column = column
+    if usage_journal.directory:
+        usage_journal.directory = os.path.join(usage_journal.directory, f'worker-{slot}')
+    admission = SharedAdmissionController(CONFIG, shared_counters)
+    prometheus.share(shared_counters)
+
+    drain = int(CONFIG['worker_drain_timeout'])
+    config = uvicorn.Config(app, log_level='warning', timeout_graceful_shutdown=drain or None)
+    server = WorkerServer(config, CONFIG['worker_close_grace'])
+    config.app = server.wrap(app)
+
+    async def serve():
+        serving = asyncio.ensure_future(server.serve(sockets=[sock]))
+        draining = asyncio.ensure_future(server.drain())
+        while not server.started and not serving.done():
+            await asyncio.sleep(0.05)
+        if server.started:
+            os.write(ready, b'1')
+        os.close(ready)
+        await serving
+        draining.cancel()
+
+    with asyncio.Runner(loop_factory=config.get_loop_factory()) as runner:
+        runner.run(serve())
+    return 0 if server.started else 3
+
+
+def run_workers(count, start_timeout=60):
+    """Pre-fork `count` workers that share the port through SO_REUSEPORT
+
+    Budgets are restored once here and moved into SharedCounters before
+    forking. Each worker slot has its own SO_REUSEPORT socket, bound here
+    and inherited, so its queue outlives the worker serving it. A worker
+    that dies is replaced. SIGUSR1 replaces the workers
+    one at a time, each new one accepting before the old one is told to
+    drain; SIGHUP is passed on (developer key reload); SIGTERM/SIGINT drain
+    them all and exit. Each worker gets a column of the shared counters from
+    a pool of twice the worker count, so old and new workers can overlap.
+    """
+    global shared_counters
+    shared_counters = SharedCounters(CONFIG['shared_slots'], 2 * count + 1)
+    restore_budget()
+    budget.share(shared_counters)
+    if usage_journal.directory and rollups.path:
+        # Migrate the rollup cursor here; SQLite connections must not cross a fork
+        try:
+            rollups.open()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error opening usage rollups: {e}")
+        rollups.close()
+
+    sockets = [reuseport_socket(CONFIG['host'], CONFIG['port']) for _ in range(count)]
+    signals = []
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+    columns = list(range(1, 2 * count + 1))
+    workers = {}
+
+    def start(slot):
+        column = columns.pop(0)
+        ready, ready_writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready)
+            status = 1
+            try:
+                for other in sockets:
+                    if other is not sockets[slot]:
+                        other.close()
+                status = run_worker(slot, column, sockets[slot], ready_writer)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        os.close(ready_writer)
+        workers[pid] = {'slot': slot, 'column': column, 'ready': ready, 'started': time.monotonic(), 'stop_at': None}
+        return pid
+
+    def wait_ready(pid):
+        """True once the worker is accepting; False if it exited or timed out first"""
+        readable, _, _ = select.select([workers[pid]['ready']], [], [], start_timeout)
+        return bool(readable) and os.read(workers[pid]['ready'], 1) == b'1'
+
+    def stop(pid):
+        if workers[pid]['stop_at'] is None:
+            workers[pid]['stop_at'] = time.monotonic() + CONFIG['worker_drain_timeout'] + 5
+            os.kill(pid, signal.SIGTERM)
+
+    def reap():
+        """Forget exited workers; [(slot, seconds it ran)] for those that exited unasked"""
+        crashed = []
+        while workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            worker = workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker['ready'])
+            shared_counters.clear_column(worker['column'], ('inflight|', 'gauge|'))
+            columns.append(worker['column'])
+            if worker['stop_at'] is None:
+                print(f"Worker {worker['slot']} (pid {pid}) exited with status "
+                      f"{os.waitstatus_to_exitcode(status)}; restarting")
+                crashed.append((worker['slot'], time.monotonic() - worker['started']))
+        for pid, worker in workers.items():
+            if worker['stop_at'] is not None and time.monotonic() > worker['stop_at']:
+                os.kill(pid, signal.SIGKILL)
+        return crashed
+
+    def rolling_restart():
+        for pid in [pid for pid, worker in workers.items() if worker['stop_at'] is None]:
+            if not columns:
+                print("Rolling restart stopped: earlier workers are still draining")
+                return
+            replacement = start(workers[pid]['slot'])
+            if not wait_ready(replacement):
+                print(f"Rolling restart stopped: new worker {workers[pid]['slot']} did not start")
+                stop(replacement)
+                return
+            stop(pid)
+        print("Rolling restart done")
+
+    for slot in range(count):
+        start(slot)
+    print(f"Started {count} workers on {CONFIG['host']}:{CONFIG['port']}")
+    try:
+        while True:
+            crashed = reap()
+            # Don't spin when workers die at startup (e.g. the port is taken)
+            if any(ran < 1 for _, ran in crashed):
+                time.sleep(1)
+            for slot, _ in crashed:
+                start(slot)
+            while signals:
+                signum = signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    return
+                if signum == signal.SIGHUP:
+                    for pid in workers:
+                        os.kill(pid, signal.SIGHUP)
+                elif signum == signal.SIGUSR1:
+                    rolling_restart()
+            time.sleep(0.2)
+    finally:
+        for pid in list(workers):
+            stop(pid)
+        while workers:
+            reap()
+            time.sleep(0.1)
+        budget.checkpoint()
 
 
 if __name__ == '__main__':
-    # Run on all interfaces, port 8080
-    app.run(host='0.0.0.0', port=8000, debug=False)
+    if CONFIG['workers'] > 1:
+        # Pre-forked processes, each with its own event loop and GIL
+        run_workers(CONFIG['workers'])
+    else:
+        # Single asyncio process; each in-flight completion is a coroutine, not a thread
+        uvicorn.run(app, host=CONFIG['host'], port=CONFIG['port'], log_level='warning')
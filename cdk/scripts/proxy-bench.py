@@ -0,0 +1,2453 @@
+#!/usr/bin/env python3
+"""
+Claude Proxy Benchmarks
+Drives claude-proxy.py against a local fake upstream and reports latency
+"""
+
+import argparse
+import asyncio
+import base64
+import collections
+import contextlib
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import re
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import aiohttp
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+PROXY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'claude-proxy.py')
+
+SAMPLE_REQUEST = {
+    'model': 'claude-3-sonnet-20240229',
+    'max_tokens': 256,
+    'messages': [{'role': 'user', 'content': 'Write a commit message for a typo fix'}],
+}
+
+
+def load_proxy_module():
+    """Import claude-proxy.py (not a valid module name) for in-process benchmarks"""
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-southeast-7')
+    spec = importlib.util.spec_from_file_location('claude_proxy', PROXY_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port():
+    """Ask the OS for an unused local TCP port"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+# =============================================================================
+# Fake upstream
+# =============================================================================
+
+def sse_event(event_type, data):
+    """Encode one server-sent event the way the Messages API does"""
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+def make_fake_upstream(latency, tokens=20, token_delay=0.02, text_bytes=0):
+    """Starlette app that answers /v1/messages after a fixed delay
+
+    Streaming requests get a Messages-style SSE stream: the first event after
+    `latency`, then `tokens` text deltas spaced `token_delay` apart.
+    `text_bytes` pads the non-streaming reply to roughly that many bytes of
+    Thai text, which is multi-byte in UTF-8 like much real output.
+    """
+    stats = {'hits': 0, 'in_flight': 0, 'peak_in_flight': 0}
+
+    async def stream_events(model):
+        try:
+            await asyncio.sleep(latency)
+            yield sse_event('message_start', {'type': 'message_start', 'message': {
+                'id': f"msg_fake_{stats['hits']}", 'type': 'message', 'role': 'assistant',
+                'model': model, 'content': [], 'usage': {'input_tokens': 42, 'output_tokens': 1},
+            }})
+            yield sse_event('content_block_start', {
+                'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''},
+            })
+            for _ in range(tokens):
+                await asyncio.sleep(token_delay)
+                yield sse_event('content_block_delta', {
+                    'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': 'tok '},
+                })
+            yield sse_event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+            yield sse_event('message_delta', {
+                'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': tokens},
+            })
+            yield sse_event('message_stop', {'type': 'message_stop'})
+        finally:
+            stats['in_flight'] -= 1
+
+    async def messages(request):
+        body = await request.json()
+        model = body.get('model', 'claude-3-sonnet-20240229')
+        stats['hits'] += 1
+        stats['in_flight'] += 1
+        stats['peak_in_flight'] = max(stats['peak_in_flight'], stats['in_flight'])
+        if body.get('stream'):
+            return StreamingResponse(stream_events(model), media_type='text/event-stream')
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            stats['in_flight'] -= 1
+        return JSONResponse({
+            'id': f"msg_fake_{stats['hits']}",
+            'type': 'message',
+            'role': 'assistant',
+            'model': model,
+            'content': [{'type': 'text', 'text': 'ก' * (text_bytes // 3) if text_bytes else 'fix: correct typo'}],
+            'stop_reason': 'end_turn',
+            'usage': {'input_tokens': 42, 'output_tokens': 7},
+        })
+
+    async def get_stats(request):
+        return JSONResponse(stats)
+
+    app = Starlette(routes=[
+        Route('/v1/messages', messages, methods=['POST']),
+        Route('/stats', get_stats, methods=['GET']),
+    ])
+    app.state.stats = stats
+    return app
+
+
+@contextlib.asynccontextmanager
+async def serve_in_background(app, port, **config):
+    """Run an ASGI app on 127.0.0.1:port inside the current event loop"""
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning', **config))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    try:
+        yield server
+    finally:
+        server.should_exit = True
+        await task
+
+
+@contextlib.asynccontextmanager
+async def run_proxy(upstream_port, extra_env=None, with_process=False):
+    """Start claude-proxy.py as a subprocess pointed at the fake upstream
+
+    Yields the proxy URL, or (url, Popen) with `with_process`.
+    """
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'CLAUDE_API_URL': f'http://127.0.0.1:{upstream_port}/v1',
+        'CLAUDE_PROXY_HOST': '127.0.0.1',
+        'CLAUDE_PROXY_PORT': str(port),
+        'CLAUDE_PROXY_CLOUDWATCH': '0',
+        'CLAUDE_PROXY_JOURNAL_DIR': '',
+        'AWS_DEFAULT_REGION': env.get('AWS_DEFAULT_REGION', 'ap-southeast-7'),
+    })
+    env.update(extra_env or {})
+    proc = subprocess.Popen([sys.executable, PROXY_SCRIPT], env=env)
+    url = f'http://127.0.0.1:{port}'
+    try:
+        async with aiohttp.ClientSession() as session:
+            for _ in range(200):
+                with contextlib.suppress(aiohttp.ClientError):
+                    async with session.get(f'{url}/health') as response:
+                        if response.status == 200:
+                            break
+                if proc.poll() is not None:
+                    raise RuntimeError('claude-proxy.py exited during startup')
+                await asyncio.sleep(0.05)
+            else:
+                raise RuntimeError('claude-proxy.py did not become healthy')
+        yield (url, proc) if with_process else url
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+# =============================================================================
+# Load test
+# =============================================================================
+
+async def loadtest(args):
+    """Fire concurrent completions through the proxy while probing /health"""
+    upstream = make_fake_upstream(args.latency)
+    upstream_port = free_port()
+
+    async with serve_in_background(upstream, upstream_port), run_proxy(upstream_port) as proxy_url:
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=args.latency + 60)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            latencies, failures, health_latencies = [], 0, []
+            done = asyncio.Event()
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def one_request():
+                nonlocal failures
+                async with semaphore:
+                    start = time.perf_counter()
+                    async with session.post(
+                        f'{proxy_url}/v1/messages',
+                        json=SAMPLE_REQUEST,
+                        headers={'x-api-key': 'bench-key', 'anthropic-version': '2023-06-01'},
+                    ) as response:
+                        await response.read()
+                    if response.status == 200:
+                        latencies.append(time.perf_counter() - start)
+                    else:
+                        failures += 1
+
+            async def probe_health():
+                while not done.is_set():
+                    start = time.perf_counter()
+                    async with session.get(f'{proxy_url}/health') as response:
+                        await response.read()
+                    health_latencies.append(time.perf_counter() - start)
+                    await asyncio.sleep(0.1)
+
+            prober = asyncio.create_task(probe_health())
+            started = time.perf_counter()
+            await asyncio.gather(*(one_request() for _ in range(args.requests)))
+            wall = time.perf_counter() - started
+            done.set()
+            await prober
+
+    stats = upstream.state.stats
+    print("=========================================")
+    print("Claude Proxy Load Test")
+    print("=========================================")
+    print(f"Requests:               {args.requests} ({failures} failed)")
+    print(f"Client concurrency:     {args.concurrency}")
+    print(f"Upstream latency:       {args.latency:.2f}s")
+    print(f"Peak upstream in-flight: {stats['peak_in_flight']}")
+    print(f"Wall time:              {wall:.2f}s ({len(latencies) / wall:.1f} req/s)")
+    print(f"Latency p50 / p99:      {percentile(latencies, 50):.3f}s / {percentile(latencies, 99):.3f}s")
+    print(f"/health p50 / p99:      {percentile(health_latencies, 50) * 1000:.1f}ms / "
+          f"{percentile(health_latencies, 99) * 1000:.1f}ms")
+
+
+# =============================================================================
+# Streaming time-to-first-byte
+# =============================================================================
+
+async def timed_stream(session, url):
+    """POST a streaming request; return (time to first byte, total time)"""
+    start = time.perf_counter()
+    async with session.post(
+        f'{url}/v1/messages',
+        json=dict(SAMPLE_REQUEST, stream=True),
+        headers={'x-api-key': 'bench-key', 'anthropic-version': '2023-06-01'},
+    ) as response:
+        ttfb = None
+        async for _ in response.content.iter_any():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+    return ttfb, time.perf_counter() - start
+
+
+async def ttfb(args):
+    """Compare streaming TTFB going direct to the upstream vs through the proxy"""
+    upstream = make_fake_upstream(args.latency, tokens=args.tokens, token_delay=args.token_delay)
+    upstream_port = free_port()
+    direct_url = f'http://127.0.0.1:{upstream_port}'
+
+    async with serve_in_background(upstream, upstream_port), run_proxy(upstream_port) as proxy_url:
+        async with aiohttp.ClientSession() as session:
+            results = {}
+            for name, url in (('direct', direct_url), ('proxy', proxy_url)):
+                runs = [await timed_stream(session, url) for _ in range(args.requests)]
+                results[name] = ([r[0] for r in runs], [r[1] for r in runs])
+
+    print("=========================================")
+    print("Claude Proxy Streaming TTFB")
+    print("=========================================")
+    print(f"Upstream first event:   {args.latency:.2f}s, then {args.tokens} x {args.token_delay:.3f}s")
+    print(f"{'Path':<8} {'TTFB p50':>10} {'TTFB p99':>10} {'Total p50':>10}")
+    for name, (ttfbs, totals) in results.items():
+        print(f"{name:<8} {percentile(ttfbs, 50) * 1000:>8.1f}ms {percentile(ttfbs, 99) * 1000:>8.1f}ms "
+              f"{percentile(totals, 50) * 1000:>8.1f}ms")
+
+
+# =============================================================================
+# Connection pooling
+# =============================================================================
+
+def make_self_signed_cert(directory):
+    """Write a localhost certificate/key pair for the TLS stand-in"""
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+         '-keyout', key, '-out', cert],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+async def pool(args):
+    """Sequential latency with a new TLS connection per call vs a pooled one"""
+    upstream = make_fake_upstream(args.latency)
+    upstream_port = free_port()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = make_self_signed_cert(tmp)
+        tls_env = {'CLAUDE_API_URL': f'https://127.0.0.1:{upstream_port}/v1', 'CLAUDE_PROXY_CA_BUNDLE': cert}
+        results = {}
+        async with serve_in_background(upstream, upstream_port, ssl_certfile=cert, ssl_keyfile=key):
+            for name, keepalive in (('cold', '0'), ('pooled', '60')):
+                env = dict(tls_env, CLAUDE_PROXY_KEEPALIVE_TIMEOUT=keepalive)
+                async with run_proxy(upstream_port, env) as proxy_url, aiohttp.ClientSession() as session:
+                    latencies = []
+                    for _ in range(args.requests):
+                        start = time.perf_counter()
+                        async with session.post(
+                            f'{proxy_url}/v1/messages',
+                            json=SAMPLE_REQUEST,
+                            headers={'x-api-key': 'bench-key', 'anthropic-version': '2023-06-01'},
+                        ) as response:
+                            await response.read()
+                        latencies.append(time.perf_counter() - start)
+                    async with session.get(f'{proxy_url}/debug/pool') as response:
+                        results[name] = (latencies, await response.json())
+
+    print("=========================================")
+    print("Claude Proxy Upstream Pooling (TLS)")
+    print("=========================================")
+    print(f"{'Mode':<8} {'p50':>9} {'p99':>9} {'created':>8} {'reused':>7} {'reuse':>6}")
+    for name, (latencies, stats) in results.items():
+        print(f"{name:<8} {percentile(latencies, 50) * 1000:>7.2f}ms {percentile(latencies, 99) * 1000:>7.2f}ms "
+              f"{stats['connections_created']:>8} {stats['connections_reused']:>7} {stats['reuse_ratio']:>6.0%}")
+
+
+# =============================================================================
+# CloudWatch Logs shipping
+# =============================================================================
+
+class StubLogsClient:
+    """In-memory CloudWatch Logs client that enforces the PutLogEvents rules"""
+
+    class exceptions:
+        class ResourceAlreadyExistsException(Exception):
+            pass
+
+        class ResourceNotFoundException(Exception):
+            pass
+
+    def __init__(self, call_latency):
+        self.call_latency = call_latency
+        self.streams = {}
+        self.calls = {'create_log_stream': 0, 'put_log_events': 0}
+        self.lock = threading.Lock()
+
+    def create_log_stream(self, logGroupName, logStreamName):
+        time.sleep(self.call_latency)
+        with self.lock:
+            self.calls['create_log_stream'] += 1
+            if logStreamName in self.streams:
+                raise self.exceptions.ResourceAlreadyExistsException(logStreamName)
+            self.streams[logStreamName] = []
+
+    def put_log_events(self, logGroupName, logStreamName, logEvents):
+        time.sleep(self.call_latency)
+        with self.lock:
+            self.calls['put_log_events'] += 1
+            if logStreamName not in self.streams:
+                raise self.exceptions.ResourceNotFoundException(logStreamName)
+            size = sum(len(e['message'].encode('utf-8')) + 26 for e in logEvents)
+            timestamps = [e['timestamp'] for e in logEvents]
+            assert len(logEvents) <= 10_000 and size <= 1_048_576, 'batch over PutLogEvents limits'
+            assert timestamps == sorted(timestamps), 'batch not in chronological order'
+            self.streams[logStreamName].extend(logEvents)
+
+
+def logs(args):
+    """Per-request CloudWatch Logs calls vs the batched background shipper"""
+    proxy = load_proxy_module()
+    client = StubLogsClient(args.call_latency)
+    shipper = proxy.LogShipper(client, proxy.LOG_GROUP, flush_interval=args.flush_interval)
+    shipper.start()
+
+    submit_latencies = []
+
+    async def producer(developer, count):
+        for n in range(count):
+            log_data = {'developer': developer, 'model': 'claude-3-sonnet', 'n': n, 'status': 'success'}
+            start = time.perf_counter()
+            await shipper.submit(f'{developer}/2024/01/01', int(time.time() * 1000), log_data)
+            submit_latencies.append(time.perf_counter() - start)
+
+    async def produce():
+        await asyncio.gather(*(producer(f'dev{i}', per_dev) for i in range(1, 9)))
+
+    per_dev = args.events // 8
+    start = time.perf_counter()
+    asyncio.run(produce())
+    shipper.close()
+    wall = time.perf_counter() - start
+
+    total = per_dev * 8
+    delivered = sum(len(events) for events in client.streams.values())
+    print("=========================================")
+    print("CloudWatch Logs Shipping")
+    print("=========================================")
+    print(f"Events:                 {total} across 8 streams ({delivered} delivered, "
+          f"{shipper.queue.stats['dropped_newest']} dropped)")
+    print(f"Per-request path:       {total * 2} API calls, ~{total * 2 * args.call_latency:.1f}s on request threads")
+    print(f"Batched shipper:        {client.calls['create_log_stream']} create_log_stream + "
+          f"{client.calls['put_log_events']} put_log_events in {wall:.2f}s")
+    print(f"submit() p50 / p99:     {percentile(submit_latencies, 50) * 1e6:.1f}us / "
+          f"{percentile(submit_latencies, 99) * 1e6:.1f}us")
+
+
+# =============================================================================
+# CloudWatch Metrics aggregation
+# =============================================================================
+
+class StubCloudWatchClient:
+    """In-memory CloudWatch client that sums what put_metric_data receives"""
+
+    def __init__(self, call_latency=0.0):
+        self.call_latency = call_latency
+        self.calls = 0
+        self.sums = {}
+        self.lock = threading.Lock()
+
+    def put_metric_data(self, Namespace, MetricData):
+        assert len(MetricData) <= 1000, 'too many datums in one call'
+        time.sleep(self.call_latency)
+        with self.lock:
+            self.calls += 1
+            for datum in MetricData:
+                dims = {d['Name']: d['Value'] for d in datum['Dimensions']}
+                key = (datum['MetricName'], dims['Developer'])
+                self.sums[key] = self.sums.get(key, 0) + datum['StatisticValues']['Sum']
+
+
+def metrics(args):
+    """Per-request put_metric_data vs aggregated statistic sets"""
+    proxy = load_proxy_module()
+    client = StubCloudWatchClient()
+    aggregator = proxy.MetricsAggregator(client, proxy.PROJECT_NAME, flush_interval=args.flush_interval)
+    aggregator.start()
+
+    models = ['claude-3-sonnet-20240229', 'claude-3-haiku-20240307', 'claude-3-opus-20240229']
+    expected = {}
+    start = time.perf_counter()
+    for n in range(args.requests):
+        developer, model = f'dev{n % 8 + 1}', models[n % len(models)]
+        input_tokens, output_tokens = 100 + n % 900, 10 + n % 400
+        cost = proxy.calculate_cost(model, input_tokens, output_tokens)
+        aggregator.record(developer, model, input_tokens, output_tokens, cost)
+        for metric, value in (('InputTokens', input_tokens), ('OutputTokens', output_tokens),
+                              ('TotalCost', cost), ('APICall', 1)):
+            expected[(metric, developer)] = expected.get((metric, developer), 0) + value
+        if args.rate:
+            time.sleep(1 / args.rate)
+    record_time = time.perf_counter() - start
+    aggregator.close()
+
+    mismatches = [key for key, value in expected.items() if abs(client.sums.get(key, 0) - value) > 1e-6]
+    print("=========================================")
+    print("CloudWatch Metrics Aggregation")
+    print("=========================================")
+    print(f"Requests recorded:      {args.requests} ({record_time / args.requests * 1e6:.1f}us each)")
+    print(f"Per-request path:       {args.requests} put_metric_data calls")
+    print(f"Aggregated:             {client.calls} put_metric_data calls ({aggregator.stats['flushes']} flushes)")
+    print(f"Per-developer Sums:     {'identical' if not mismatches else f'MISMATCH {mismatches}'}")
+
+
+# =============================================================================
+# Developer key lookup
+# =============================================================================
+
+def legacy_key_scan(api_key, count):
+    """The original get_developer_from_key loop, extended to `count` keys"""
+    for i in range(1, count + 1):
+        if api_key == os.environ.get(f'DEV{i}_CLAUDE_KEY', ''):
+            return f'dev{i}'
+    return 'unknown'
+
+
+def keys(args):
+    """Lookup cost of the linear env scan vs the hashed key index as keys grow"""
+    proxy = load_proxy_module()
+    print("=========================================")
+    print("Developer Key Lookup (ns per call)")
+    print("=========================================")
+    print(f"{'Keys':>6} {'scan hit':>10} {'scan miss':>10} {'index hit':>10} {'index miss':>11}")
+
+    for count in args.sizes:
+        for name in [n for n in os.environ if proxy.DeveloperKeyIndex.ENV_KEY_PATTERN.match(n)]:
+            del os.environ[name]
+        for i in range(1, count + 1):
+            os.environ[f'DEV{i}_CLAUDE_KEY'] = f'sk-ant-bench-{i:06d}-' + 'x' * 80
+        index = proxy.DeveloperKeyIndex()
+        index.reload()
+        assert len(index) == count
+
+        # Worst case for the scan: the last developer's key, and a key nobody owns
+        hit, miss = os.environ[f'DEV{count}_CLAUDE_KEY'], 'sk-ant-nobody-' + 'y' * 80
+        assert legacy_key_scan(hit, count) == index.lookup(hit) == f'dev{count}'
+
+        timings = []
+        for fn in (lambda k: legacy_key_scan(k, count), index.lookup):
+            for key in (hit, miss):
+                start = time.perf_counter()
+                for _ in range(args.iterations):
+                    fn(key)
+                timings.append((time.perf_counter() - start) / args.iterations * 1e9)
+        print(f"{count:>6} {timings[0]:>10.0f} {timings[1]:>10.0f} {timings[2]:>10.0f} {timings[3]:>11.0f}")
+
+
+# =============================================================================
+# Usage journal
+# =============================================================================
+
+def journal(args):
+    """Binary group-committed journal vs the JSON log path, per usage record"""
+    proxy = load_proxy_module()
+    models = ['global.anthropic.claude-sonnet-4-5-20250929-v1:0', 'claude-haiku-4-5-20251001']
+
+    def make_record(n):
+        return proxy.UsageRecord(
+            time.time(), f'dev{n % 8 + 1}', models[n % 2], 100 + n % 900, 10 + n % 400, 0, 0,
+            0.0042, 0.0, 1.25, 'upstream', 0, True,
+        )
+
+    # Current path: build the log event and queue it; the shipper JSON-encodes it,
+    # which is done here too so both paths pay for serialization
+    client = StubLogsClient(0.0)
+    shipper = proxy.LogShipper(client, proxy.LOG_GROUP, flush_interval=1.0, max_queue=args.records)
+    shipper.start()
+    json_bytes = 0
+    start = time.perf_counter()
+    for n in range(args.records):
+        log_data = proxy.usage_log_data(make_record(n))
+        json_bytes += len(json.dumps(log_data)) + shipper.EVENT_OVERHEAD_BYTES
+        shipper.queue.put((f'dev{n % 8 + 1}/2024/01/01', int(time.time() * 1000), log_data))
+    json_produce = time.perf_counter() - start
+    shipper.close()
+    json_total = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        usage_journal = proxy.UsageJournal(directory, commit_interval=args.commit_interval)
+        usage_journal.start()
+        start = time.perf_counter()
+        for n in range(args.records):
+            usage_journal.append(make_record(n))
+        journal_produce = time.perf_counter() - start
+        usage_journal.close()
+        journal_total = time.perf_counter() - start
+        stats = usage_journal.stats
+
+        start = time.perf_counter()
+        replayed = sum(1 for _ in usage_journal.read())
+        read_time = time.perf_counter() - start
+
+    print("=========================================")
+    print(f"Usage Journal ({args.records} records, one process)")
+    print("=========================================")
+    print(f"{'':<24} {'us/record':>10} {'records/s':>11} {'bytes/record':>13}")
+    print(f"{'JSON -> log shipper':<24} {json_produce / args.records * 1e6:>10.2f} "
+          f"{args.records / json_total:>11.0f} {json_bytes / args.records:>13.1f}")
+    print(f"{'binary journal':<24} {journal_produce / args.records * 1e6:>10.2f} "
+          f"{args.records / journal_total:>11.0f} {stats['bytes_written'] / args.records:>13.1f}")
+    print(f"Journal commits:        {stats['commits']} fsyncs for {stats['committed']} records, {stats['lost']} lost")
+    print(f"Journal read/replay:    {replayed} records at {replayed / read_time:.0f} records/s")
+
+
+# =============================================================================
+# Usage rollups
+# =============================================================================
+
+def rollups(args):
+    """Rollup query time for fixed windows as stored history grows"""
+    proxy = load_proxy_module()
+    developers = [f'dev{i}' for i in range(1, args.developers + 1)]
+    models = ['claude-sonnet-4-5-20250929', 'claude-haiku-4-5-20251001']
+    now = time.time()
+    windows = [
+        ('last 24h', now - 86400, now),
+        ('last 7 days', now - 7 * 86400, now),
+        ('month to date', proxy.month_start(now), now),
+        ('last 90 days', now - 90 * 86400, now),
+    ]
+
+    print("=========================================")
+    print(f"Usage Rollups ({args.developers} developers x {len(models)} models, one call per hour each)")
+    print("=========================================")
+    print(f"{'History':>9} {'rows':>10} " + ' '.join(f'{name:>14}' for name, _, _ in windows))
+    with tempfile.TemporaryDirectory() as directory:
+        store = proxy.RollupStore(os.path.join(directory, 'rollups.sqlite3'), proxy.UsageJournal(directory))
+        db = store.open()
+        loaded_until = now
+        for days in sorted(args.history):
+            # Extend history backwards, one synthetic call per developer/model/hour
+            start = now - days * 86400
+            hour = start - start % 3600
+            records = []
+            while hour < loaded_until:
+                for developer in developers:
+                    for model in models:
+                        records.append(proxy.UsageRecord(hour + 60, developer, model, 1000, 100, 0, 0, 0.01, 0.0,
+                                                         1.0, 'upstream', 0, True))
+                hour += 3600
+                if len(records) >= 100_000:
+                    store._apply(db, records, '', 0)
+                    records = []
+            store._apply(db, records, '', 0)
+            loaded_until = start - start % 3600
+
+            rows = db.execute('SELECT COUNT(*) FROM rollup').fetchone()[0]
+            timings = []
+            for _, since, until in windows:
+                begin = time.perf_counter()
+                for _ in range(args.iterations):
+                    store.query(since, until)
+                timings.append((time.perf_counter() - begin) / args.iterations * 1000)
+            print(f"{days:>8}d {rows:>10,} " + ' '.join(f'{t:>12.2f}ms' for t in timings))
+        store.close()
+
+
+# =============================================================================
+# Model pricing
+# =============================================================================
+
+PRICING_SAMPLE_MODELS = [
+    'global.anthropic.claude-sonnet-4-5-20250929-v1:0',
+    'anthropic.claude-3-sonnet-20240229-v1:0',
+    'us.anthropic.claude-3-5-haiku-20241022-v1:0',
+    'claude-sonnet-4-20250514',
+    'claude-opus-4-1-20250805',
+    'claude-haiku-4-5@20251001',
+    'some-other-model',
+]
+
+
+def pricing(args):
+    """How each sample model ID resolves, and the per-call cost of pricing it"""
+    proxy = load_proxy_module()
+    print("=========================================")
+    print(f"Model Pricing (table {proxy.pricing.version})")
+    print("=========================================")
+    print(f"{'Model':<52} {'Family':<18} {'$ per 1M in/out':>16} {'ns/call':>8}")
+    for model in PRICING_SAMPLE_MODELS:
+        price = proxy.pricing.resolve(model)
+        rates = f"{price.input * 1e6:.2f}/{price.output * 1e6:.2f}" if price else '-'
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            proxy.calculate_cost(model, 1000, 500)
+        elapsed = (time.perf_counter() - start) / args.iterations * 1e9
+        print(f"{model:<52} {price.family if price else 'UNKNOWN':<18} {rates:>16} {elapsed:>8.0f}")
+
+
+def prometheus(args):
+    """Per-request cost of the /metrics instrumentation, and scrape time for the resulting series"""
+    proxy = load_proxy_module()
+    developers = [f'dev-{i}' for i in range(args.developers)]
+    calls = [(developers[i % len(developers)], PRICING_SAMPLE_MODELS[i % len(PRICING_SAMPLE_MODELS)])
+             for i in range(args.requests // args.rounds)]
+
+    def record(developer, model):
+        # Everything the request path records for one upstream call, including
+        # the perf_counter reads that feed the histograms
+        labels = (developer, proxy.metric_model(model))
+        proxy.REQUEST_BYTES.observe(labels, 4000)
+        queued_at = time.perf_counter()
+        proxy.ADMISSION_WAIT.observe((developer,), time.perf_counter() - queued_at)
+        upstream_start = time.perf_counter()
+        proxy.UPSTREAM_TTFB.observe(labels, time.perf_counter() - upstream_start)
+        proxy.UPSTREAM_LATENCY.observe(labels, time.perf_counter() - upstream_start)
+        proxy.RESPONSE_BYTES.observe(labels, 12000)
+        proxy.REQUEST_DURATION.observe(labels + ('upstream',), 1.5)
+        for kind, tokens in (('input', 1000), ('output', 500), ('cache_read', 0), ('cache_write', 0)):
+            proxy.TOKENS.observe(labels + (kind,), tokens)
+        proxy.COST.inc(labels, 0.0105)
+        proxy.REQUESTS.inc(labels + ('200',))
+
+    # Best of several rounds, so scheduler noise on a shared host doesn't count
+    rounds = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        for developer, model in calls:
+            record(developer, model)
+        rounds.append((time.perf_counter() - start) / len(calls))
+    per_request = min(rounds)
+
+    start = time.perf_counter()
+    text = proxy.prometheus.render()
+    render_time = time.perf_counter() - start
+    series = sum(1 for line in text.splitlines() if line and not line.startswith('#'))
+
+    print("=========================================")
+    print("Prometheus Instrumentation")
+    print("=========================================")
+    print(f"Requests:          {len(calls) * args.rounds} across {args.developers} developers")
+    print(f"Per request:       {per_request * 1e6:.2f}µs (worst round {max(rounds) * 1e6:.2f}µs)")
+    print(f"Scrape:            {series} samples, {len(text) / 1024:.0f}KB in {render_time * 1000:.1f}ms")
+
+
+# =============================================================================
+# Telemetry off the critical path
+# =============================================================================
+
+async def telemetry_run(upstream_port, args, call_latency=None, policy='block'):
+    """Completions through an in-process proxy; call_latency None leaves CloudWatch off"""
+    os.environ.update({
+        'CLAUDE_API_URL': f'http://127.0.0.1:{upstream_port}/v1',
+        'CLAUDE_PROXY_JOURNAL_DIR': '',
+        'CLAUDE_PROXY_ROLLUP_DB': '',
+    })
+    proxy = load_proxy_module()
+    proxy.CONFIG['cloudwatch_enabled'] = call_latency is not None
+    if call_latency is not None:
+        proxy.log_shipper = proxy.LogShipper(
+            StubLogsClient(call_latency), proxy.LOG_GROUP,
+            flush_interval=0.05, max_queue=args.queue, policy=policy, block_timeout=1.0,
+        )
+        proxy.metrics_aggregator.client = StubCloudWatchClient(call_latency)
+        proxy.metrics_aggregator.flush_interval = 0.05
+
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    latencies = []
+    async with serve_in_background(proxy.app, port):
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def one_request():
+                async with semaphore:
+                    start = time.perf_counter()
+                    async with session.post(
+                        f'{url}/v1/messages', json=SAMPLE_REQUEST, headers={'x-api-key': 'bench-key'},
+                    ) as response:
+                        await response.read()
+                    latencies.append(time.perf_counter() - start)
+
+            await asyncio.gather(*(one_request() for _ in range(args.requests)))
+    return latencies, dict(proxy.log_shipper.queue.stats)
+
+
+async def telemetry(args):
+    """Response latency with CloudWatch off vs artificially slow, for each full-queue policy"""
+    upstream_port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['CLAUDE_PROXY_BUDGET_STATE'] = os.path.join(directory, 'budget.json')
+        async with serve_in_background(make_fake_upstream(args.latency), upstream_port):
+            baseline, _ = await telemetry_run(upstream_port, args)
+            runs = [(policy, *await telemetry_run(upstream_port, args, args.call_latency, policy))
+                    for policy in ('drop_newest', 'drop_oldest', 'block')]
+
+    base_p50, base_p99 = percentile(baseline, 50), percentile(baseline, 99)
+    print("=========================================")
+    print("Telemetry Off The Response Path")
+    print("=========================================")
+    print(f"Requests:          {args.requests} per run, concurrency {args.concurrency}, "
+          f"upstream {args.latency * 1000:.0f}ms")
+    print(f"Slow CloudWatch:   {args.call_latency:.2f}s per API call, log queue of {args.queue}")
+    print(f"{'Run':<26} {'p50':>8} {'p99':>8} {'+p99':>8} {'dropped':>8} {'blocked':>8}")
+    print(f"{'CloudWatch off':<26} {base_p50 * 1000:>6.1f}ms {base_p99 * 1000:>6.1f}ms")
+    for policy, latencies, stats in runs:
+        p99 = percentile(latencies, 99)
+        dropped = stats['dropped_newest'] + stats['dropped_oldest']
+        print(f"{'slow, ' + policy:<26} {percentile(latencies, 50) * 1000:>6.1f}ms {p99 * 1000:>6.1f}ms "
+              f"{(p99 - base_p99) * 1000:>6.2f}ms {dropped:>8} {stats['blocked']:>8}")
+
+
+# =============================================================================
+# Large response relay
+# =============================================================================
+
+def process_memory(pid):
+    """(current RSS, peak RSS) of a process in bytes, from /proc"""
+    values = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                values[key] = int(rest.split()[0]) * 1024
+    return values['VmRSS'], values['VmHWM']
+
+
+async def relay(args):
+    """Peak proxy RSS per in-flight request for large non-streaming responses"""
+    upstream = make_fake_upstream(args.latency, text_bytes=args.size)
+    upstream_port = free_port()
+    async with serve_in_background(upstream, upstream_port), \
+            run_proxy(upstream_port, with_process=True) as (proxy_url, proc):
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+
+            async def one_request():
+                async with session.post(
+                    f'{proxy_url}/v1/messages', json=SAMPLE_REQUEST, headers={'x-api-key': 'bench-key'},
+                ) as response:
+                    body = await response.read()
+                assert response.status == 200 and len(json.loads(body)['content'][0]['text']) == args.size // 3
+                return len(body), response.headers
+
+            # Peak RSS only ever grows, so each level reports growth over the idle proxy
+            _, idle_peak = process_memory(proc.pid)
+            results = []
+            for concurrency in args.concurrency:
+                latencies = []
+                for _ in range(args.rounds):
+                    start = time.perf_counter()
+                    sizes = await asyncio.gather(*(one_request() for _ in range(concurrency)))
+                    latencies.append(time.perf_counter() - start)
+                rss, peak = process_memory(proc.pid)
+                results.append((concurrency, rss, peak, peak - idle_peak, percentile(latencies, 50)))
+            size, headers = sizes[0]
+
+    print("=========================================")
+    print(f"Large Response Relay ({size / 1e6:.2f}MB bodies)")
+    print("=========================================")
+    hop = [name for name in ('connection', 'keep-alive', 'transfer-encoding', 'content-encoding') if name in headers]
+    print(f"Hop-by-hop headers relayed: {', '.join(hop) or 'none'}")
+    print(f"{'Concurrent':>10} {'RSS':>9} {'peak RSS':>9} {'peak growth':>12} {'per request':>12} {'batch p50':>10}")
+    for concurrency, rss, peak, growth, p50 in results:
+        print(f"{concurrency:>10} {rss / 1e6:>7.1f}MB {peak / 1e6:>7.1f}MB {growth / 1e6:>10.1f}MB "
+              f"{growth / concurrency / 1e6:>10.2f}MB {p50 * 1000:>8.0f}ms")
+
+
+# =============================================================================
+# Request coalescing
+# =============================================================================
+
+async def coalesce(args):
+    """N identical concurrent requests should cost exactly one upstream call"""
+    upstream = make_fake_upstream(args.latency, tokens=20, token_delay=0.01)
+    upstream_port = free_port()
+    stats = upstream.state.stats
+
+    async with serve_in_background(upstream, upstream_port), \
+            run_proxy(upstream_port, {'CLAUDE_PROXY_COALESCE': '1'}) as proxy_url, \
+            aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+
+        async def one(payload):
+            async with session.post(
+                f'{proxy_url}/v1/messages',
+                json=payload,
+                headers={'x-api-key': 'bench-key', 'anthropic-version': '2023-06-01'},
+            ) as response:
+                return response.status, await response.read()
+
+        print("=========================================")
+        print("Claude Proxy Request Coalescing")
+        print("=========================================")
+        failed = False
+        for label, payload in (('non-streaming', SAMPLE_REQUEST), ('streaming', dict(SAMPLE_REQUEST, stream=True))):
+            hits_before = stats['hits']
+            results = await asyncio.gather(*(one(payload) for _ in range(args.requests)))
+            upstream_hits = stats['hits'] - hits_before
+            identical = len({body for _, body in results}) == 1 and all(status == 200 for status, _ in results)
+            failed |= upstream_hits != 1 or not identical
+            print(f"{label:<14} {args.requests} requests -> {upstream_hits} upstream call(s), "
+                  f"responses {'identical' if identical else 'DIFFER'}")
+
+        # Identical requests that queue in admission behind another call must still share one flight
+        async with session.post(f'{proxy_url}/debug/limits', json={'limit_global_max_in_flight': 1}) as response:
+            response.raise_for_status()
+        hits_before = stats['hits']
+        occupier = asyncio.create_task(one(dict(SAMPLE_REQUEST, max_tokens=255)))
+        await asyncio.sleep(args.latency / 4)
+        results = await asyncio.gather(*(one(SAMPLE_REQUEST) for _ in range(args.requests)))
+        await occupier
+        upstream_hits = stats['hits'] - hits_before - 1
+        identical = len({body for _, body in results}) == 1 and all(status == 200 for status, _ in results)
+        failed |= upstream_hits != 1 or not identical
+        print(f"{'admission-queued':<14} {args.requests} requests -> {upstream_hits} upstream call(s), "
+              f"responses {'identical' if identical else 'DIFFER'}")
+
+        async with session.get(f'{proxy_url}/debug/coalesce') as response:
+            print(f"Proxy counters:  {await response.json()}")
+    if failed:
+        sys.exit(1)
+
+
+# =============================================================================
+# Admission control fairness
+# =============================================================================
+
+async def fairness(args):
+    """Skewed load through a shared in-flight cap: FIFO semaphore vs fair queueing"""
+    proxy = load_proxy_module()
+    config = dict(proxy.CONFIG, limit_global_max_in_flight=args.slots, limit_queue_timeout=600)
+    load = {'dev1': args.heavy}
+    load.update({f'dev{i}': args.light for i in range(2, 9)})
+
+    async def run(acquire):
+        finished = {developer: [] for developer in load}
+        start = time.perf_counter()
+
+        async def one(developer):
+            release = await acquire(developer)
+            await asyncio.sleep(args.hold)
+            release()
+            finished[developer].append(time.perf_counter() - start)
+
+        # Worst case for FIFO: the heavy developer's whole burst arrives first
+        tasks = [one(developer) for developer, count in load.items() for _ in range(count)]
+        await asyncio.gather(*tasks)
+        return finished
+
+    semaphore = asyncio.Semaphore(args.slots)
+
+    async def fifo_acquire(developer):
+        await semaphore.acquire()
+        return semaphore.release
+
+    controller = proxy.AdmissionController(config)
+
+    async def fair_acquire(developer):
+        return (await controller.acquire(developer, 0)).release
+
+    results = {'FIFO semaphore': await run(fifo_acquire), 'fair queueing': await run(fair_acquire)}
+
+    print("=========================================")
+    print("Admission Control Fairness")
+    print("=========================================")
+    print(f"{args.slots} upstream slots, {args.hold * 1000:.0f}ms per call; "
+          f"dev1 sends {args.heavy}, dev2-dev8 send {args.light} each")
+    print(f"{'Policy':<16} {'dev1 done':>10} {'light p50':>10} {'light max':>10}")
+    for name, finished in results.items():
+        light = [t for developer, times in finished.items() if developer != 'dev1' for t in times]
+        print(f"{name:<16} {max(finished['dev1']):>9.2f}s {percentile(light, 50):>9.2f}s {max(light):>9.2f}s")
+
+
+# =============================================================================
+# Upstream retries, hedging and circuit breaker
+# =============================================================================
+
+def make_faulty_upstream(latency, error_rate=0.0, slow_rate=0.0, slow_latency=1.0, seed=1):
+    """Fake /v1/messages that injects the failures a real upstream has
+
+    `error_rate` of calls fail with an even mix of 429 (retry-after 1s), 529
+    overloaded and 503; `slow_rate` of calls take `slow_latency` extra to
+    make a latency tail. `app.state.outage(seconds)` fails every call with
+    529 for that long. Counts every call so retry amplification is visible.
+    """
+    rng = random.Random(seed)
+    stats = {'calls': 0, 'errors': 0, 'slow': 0, 'down_until': 0.0}
+    faults = (
+        (429, 'rate_limit_error', {'retry-after': '1'}),
+        (529, 'overloaded_error', {}),
+        (503, 'api_error', {}),
+    )
+
+    def error(status, error_type, headers):
+        stats['errors'] += 1
+        return JSONResponse({'type': 'error', 'error': {'type': error_type, 'message': 'injected fault'}},
+                            status_code=status, headers=headers)
+
+    async def messages(request):
+        body = await request.json()
+        stats['calls'] += 1
+        if time.monotonic() < stats['down_until']:
+            return error(*faults[1])
+        if rng.random() < error_rate:
+            return error(*rng.choice(faults))
+        delay = latency
+        if rng.random() < slow_rate:
+            stats['slow'] += 1
+            delay += slow_latency
+        await asyncio.sleep(delay)
+        return JSONResponse({
+            'id': f"msg_fake_{stats['calls']}", 'type': 'message', 'role': 'assistant',
+            'model': body.get('model', 'claude-3-sonnet-20240229'),
+            'content': [{'type': 'text', 'text': 'fix: correct typo'}],
+            'stop_reason': 'end_turn', 'usage': {'input_tokens': 42, 'output_tokens': 7},
+        })
+
+    def outage(seconds):
+        stats['down_until'] = time.monotonic() + seconds
+
+    app = Starlette(routes=[Route('/v1/messages', messages, methods=['POST'])])
+    app.state.stats = stats
+    app.state.outage = outage
+    return app
+
+
+async def open_loop(session, proxy_url, rate, duration):
+    """Send distinct requests at `rate` per second for `duration` seconds; [(status, seconds)]"""
+    results = []
+
+    async def one(i):
+        start = time.perf_counter()
+        # Distinct prompts so nothing is answered from the response cache
+        payload = dict(SAMPLE_REQUEST, messages=[{'role': 'user', 'content': f'request {i}'}])
+        async with session.post(
+            f'{proxy_url}/v1/messages',
+            json=payload,
+            headers={'x-api-key': 'bench-key', 'anthropic-version': '2023-06-01'},
+        ) as response:
+            await response.read()
+            results.append((response.status, time.perf_counter() - start))
+
+    tasks = []
+    for i in range(int(rate * duration)):
+        tasks.append(asyncio.create_task(one(i)))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+    return results
+
+
+async def retries_run(args, proxy_env, outage=0.0, **faults):
+    """Open-loop load at `args.rate` req/s through a proxy in front of a faulty upstream"""
+    upstream = make_faulty_upstream(args.latency, **faults)
+    upstream_port = free_port()
+    env = {'CLAUDE_PROXY_COALESCE': '0', 'CLAUDE_PROXY_CACHE': '0'}
+    env.update(proxy_env)
+
+    async with serve_in_background(upstream, upstream_port), \
+            run_proxy(upstream_port, env) as proxy_url, \
+            aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        upstream.state.outage(outage)
+        results = await open_loop(session, proxy_url, args.rate, args.duration)
+        async with session.get(f'{proxy_url}/debug/upstream') as response:
+            debug = await response.json()
+
+    ok = [elapsed for status, elapsed in results if status == 200]
+    return {
+        'success': len(ok) / len(results) * 100,
+        'p50': percentile(ok, 50) * 1000 if ok else 0,
+        'p99': percentile(ok, 99) * 1000 if ok else 0,
+        'amplification': upstream.state.stats['calls'] / len(results),
+        'fast_fail': debug['rejected'] + sum(backend['breaker'].get('rejected', 0) for backend in debug['backends']),
+    }
+
+
+async def retries(args):
+    """Client-visible success, latency and upstream load under injected faults"""
+    off = {'CLAUDE_PROXY_RETRY_MAX': '0', 'CLAUDE_PROXY_BREAKER_FAILURES': '0'}
+    on = {'CLAUDE_PROXY_BREAKER_FAILURES': '0'}
+    scenarios = [
+        (f'{args.error_rate:.0%} errors', 'no retries', off, {}, {'error_rate': args.error_rate}),
+        (f'{args.error_rate:.0%} errors', 'retries', on, {}, {'error_rate': args.error_rate}),
+        (f'{args.slow_rate:.0%} slow tail', 'no hedging', on, {}, {'slow_rate': args.slow_rate}),
+        (f'{args.slow_rate:.0%} slow tail', f'hedge {args.hedge_after * 1000:.0f}ms', dict(
+            on, CLAUDE_PROXY_HEDGE_AFTER=str(args.hedge_after)), {}, {'slow_rate': args.slow_rate}),
+        (f'{args.outage:.0f}s outage', 'retries', on, {'outage': args.outage}, {}),
+        (f'{args.outage:.0f}s outage', 'retries+breaker', {
+            'CLAUDE_PROXY_BREAKER_FAILURES': '5', 'CLAUDE_PROXY_BREAKER_RESET_TIMEOUT': '1',
+        }, {'outage': args.outage}, {}),
+    ]
+
+    print("=========================================")
+    print("Upstream Retries, Hedging and Circuit Breaker")
+    print("=========================================")
+    print(f"{args.rate:.0f} req/s for {args.duration:.0f}s, {args.latency * 1000:.0f}ms upstream latency")
+    print(f"{'Scenario':<16} {'Proxy':<18} {'success':>8} {'p50':>8} {'p99':>8} {'calls/req':>10} {'fast-fail':>10}")
+    for scenario, label, env, extra, faults in scenarios:
+        r = await retries_run(args, env, **extra, **faults)
+        print(f"{scenario:<16} {label:<18} {r['success']:>7.1f}% {r['p50']:>6.0f}ms {r['p99']:>6.0f}ms "
+              f"{r['amplification']:>10.2f} {r['fast_fail']:>10}")
+
+
+# =============================================================================
+# Multi-backend routing
+# =============================================================================
+
+def eventstream_message(headers, payload):
+    """One AWS event stream frame: prelude, string headers, payload and CRC32s"""
+    encoded = b''.join(
+        struct.pack('>B', len(name)) + name.encode() + struct.pack('>BH', 7, len(value)) + value.encode()
+        for name, value in headers.items()
+    )
+    prelude = struct.pack('>II', 16 + len(encoded) + len(payload), len(encoded))
+    message = prelude + struct.pack('>I', zlib.crc32(prelude)) + encoded + payload
+    return message + struct.pack('>I', zlib.crc32(message))
+
+
+def make_fake_bedrock(latency, tokens=20, token_delay=0.01):
+    """Bedrock runtime InvokeModel / InvokeModelWithResponseStream for Anthropic models
+
+    Checks the request is in Bedrock's form (anthropic_version, no model or
+    stream in the body) and counts SigV4-signed calls. `app.state.outage(s)`
+    answers 503 ServiceUnavailableException for that long.
+    """
+    stats = {'calls': 0, 'signed': 0, 'malformed': 0, 'models': set(), 'down_until': 0.0}
+
+    def message(model_id, text):
+        return {
+            'id': f"msg_bdrk_{stats['calls']}", 'type': 'message', 'role': 'assistant',
+            'model': model_id.split('anthropic.')[-1].rsplit('-v', 1)[0],
+            'content': [{'type': 'text', 'text': text}],
+            'stop_reason': 'end_turn', 'usage': {'input_tokens': 42, 'output_tokens': tokens},
+        }
+
+    async def events(model_id):
+        start = message(model_id, '')
+        start['content'], start['usage'] = [], {'input_tokens': 42, 'output_tokens': 1}
+        stream = [{'type': 'message_start', 'message': start},
+                  {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}}]
+        stream += [{'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': 'tok '}}
+                   for _ in range(tokens)]
+        stream += [{'type': 'content_block_stop', 'index': 0},
+                   {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': tokens}},
+                   {'type': 'message_stop'}]
+        await asyncio.sleep(latency)
+        for event in stream:
+            payload = json.dumps({'bytes': base64.b64encode(json.dumps(event).encode()).decode()}).encode()
+            yield eventstream_message(
+                {':event-type': 'chunk', ':content-type': 'application/json', ':message-type': 'event'}, payload,
+            )
+            if event['type'] == 'content_block_delta':
+                await asyncio.sleep(token_delay)
+
+    async def invoke(request):
+        body = await request.json()
+        model_id = request.path_params['model_id']
+        stats['calls'] += 1
+        stats['models'].add(model_id)
+        stats['signed'] += request.headers.get('authorization', '').startswith('AWS4-HMAC-SHA256')
+        if time.monotonic() < stats['down_until']:
+            return JSONResponse({'message': 'injected outage'}, status_code=503,
+                                headers={'x-amzn-errortype': 'ServiceUnavailableException:http://internal.amazon.com/'})
+        if body.get('anthropic_version') != 'bedrock-2023-05-31' or 'model' in body or 'stream' in body:
+            stats['malformed'] += 1
+            return JSONResponse({'message': 'Malformed input request'}, status_code=400,
+                                headers={'x-amzn-errortype': 'ValidationException:http://internal.amazon.com/'})
+        if request.url.path.endswith('/invoke-with-response-stream'):
+            return StreamingResponse(events(model_id), media_type='application/vnd.amazon.eventstream')
+        await asyncio.sleep(latency)
+        return JSONResponse(message(model_id, 'fix: correct typo'))
+
+    def outage(seconds):
+        stats['down_until'] = time.monotonic() + seconds
+
+    app = Starlette(routes=[
+        Route('/model/{model_id}/invoke', invoke, methods=['POST']),
+        Route('/model/{model_id}/invoke-with-response-stream', invoke, methods=['POST']),
+    ])
+    app.state.stats = stats
+    app.state.outage = outage
+    return app
+
+
+async def router_run(args, outage=0.0):
+    """Load through a proxy routing over one Anthropic and two Bedrock mocks"""
+    anthropic = make_faulty_upstream(args.latency[0])
+    bedrock_a, bedrock_b = make_fake_bedrock(args.latency[1]), make_fake_bedrock(args.latency[2])
+    ports = [free_port() for _ in range(3)]
+    env = {
+        'CLAUDE_PROXY_BACKENDS': f'anthropic=http://127.0.0.1:{ports[0]}/v1,'
+                                 f'bedrock:ap-southeast-1=http://127.0.0.1:{ports[1]},'
+                                 f'bedrock:us-west-2=http://127.0.0.1:{ports[2]}',
+        'CLAUDE_PROXY_BREAKER_RESET_TIMEOUT': '1',
+        # Only recognised keys may go to Bedrock
+        'DEV1_CLAUDE_KEY': 'bench-key',
+        # Dummy credentials so calls are SigV4-signed as they would be on the instance role
+        'AWS_ACCESS_KEY_ID': 'AKIDBENCH', 'AWS_SECRET_ACCESS_KEY': 'bench',
+    }
+    async with serve_in_background(anthropic, ports[0]), serve_in_background(bedrock_a, ports[1]), \
+            serve_in_background(bedrock_b, ports[2]), run_proxy(ports[0], env) as proxy_url, \
+            aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        anthropic.state.outage(outage)
+        results = await open_loop(session, proxy_url, args.rate, args.duration)
+
+    calls = [anthropic.state.stats['calls'], bedrock_a.state.stats['calls'], bedrock_b.state.stats['calls']]
+    ok = [elapsed for status, elapsed in results if status == 200]
+    return {
+        'success': len(ok) / len(results) * 100,
+        'p50': percentile(ok, 50) * 1000 if ok else 0,
+        'p99': percentile(ok, 99) * 1000 if ok else 0,
+        'shares': [count / sum(calls) * 100 for count in calls],
+        'signed': bedrock_a.state.stats['signed'] + bedrock_b.state.stats['signed'],
+        'bedrock_calls': calls[1] + calls[2],
+    }
+
+
+async def router_translation():
+    """Streaming and non-streaming calls through a Bedrock-only proxy come back in Messages API form"""
+    bedrock = make_fake_bedrock(0.01, tokens=5)
+    port = free_port()
+    env = {'CLAUDE_PROXY_BACKENDS': f'bedrock:ap-southeast-1=http://127.0.0.1:{port}',
+           'DEV1_CLAUDE_KEY': 'bench-key'}
+    problems = []
+    async with serve_in_background(bedrock, port), run_proxy(port, env) as proxy_url, \
+            aiohttp.ClientSession() as session:
+        for model in ('claude-sonnet-4-5-20250929', 'global.anthropic.claude-sonnet-4-5-20250929-v1:0'):
+            for stream in (False, True):
+                async with session.post(
+                    f'{proxy_url}/v1/messages',
+                    json=dict(SAMPLE_REQUEST, model=model, stream=stream),
+                    headers={'x-api-key': 'bench-key', 'anthropic-version': '2023-06-01'},
+                ) as response:
+                    body = await response.text()
+                    if response.status != 200:
+                        problems.append(f'{model} stream={stream}: HTTP {response.status} {body[:200]}')
+                    elif stream and (body.count('event: content_block_delta') != 5 or 'event: message_stop' not in body):
+                        problems.append(f'{model} stream=True: not a Messages SSE stream: {body[:200]}')
+                    elif not stream and json.loads(body)['content'][0]['text'] != 'fix: correct typo':
+                        problems.append(f'{model} stream=False: unexpected body {body[:200]}')
+        # Bedrock never sees the key, so the proxy has to turn an unrecognised one away itself
+        calls_before = bedrock.state.stats['calls']
+        async with session.post(
+            f'{proxy_url}/v1/messages', json=SAMPLE_REQUEST,
+            headers={'x-api-key': 'not-a-key', 'anthropic-version': '2023-06-01'},
+        ) as response:
+            if response.status != 401 or bedrock.state.stats['calls'] != calls_before:
+                problems.append(f'unrecognised key: HTTP {response.status}, '
+                                f"{bedrock.state.stats['calls'] - calls_before} Bedrock call(s)")
+    if bedrock.state.stats['malformed']:
+        problems.append(f"{bedrock.state.stats['malformed']} request(s) not in Bedrock form")
+    return problems, sorted(bedrock.state.stats['models'])
+
+
+async def router(args):
+    """Traffic share per backend by latency, and failover when the fastest one goes down"""
+    print("=========================================")
+    print("Multi-Backend Routing")
+    print("=========================================")
+    problems, models = await router_translation()
+    print(f"Format translation: {'OK' if not problems else 'FAILED'}; Bedrock saw {', '.join(models)}")
+    for problem in problems:
+        print(f"  {problem}")
+
+    latencies = '/'.join(f'{latency * 1000:.0f}' for latency in args.latency)
+    print(f"{args.rate:.0f} req/s for {args.duration:.0f}s; anthropic/bedrock-a/bedrock-b latency {latencies}ms")
+    print(f"{'Run':<20} {'success':>8} {'p50':>8} {'p99':>8} {'anthropic':>10} {'bedrock-a':>10} {'bedrock-b':>10}")
+    for label, outage in (('steady', 0.0), (f'anthropic down {args.outage:.0f}s', args.outage)):
+        r = await router_run(args, outage)
+        print(f"{label:<20} {r['success']:>7.1f}% {r['p50']:>6.0f}ms {r['p99']:>6.0f}ms "
+              + ' '.join(f"{share:>9.1f}%" for share in r['shares']))
+        if r['signed'] != r['bedrock_calls']:
+            problems.append(f"{r['bedrock_calls'] - r['signed']} Bedrock call(s) were not SigV4-signed")
+    if problems:
+        sys.exit(1)
+
+
+# =============================================================================
+# Prompt cache breakpoint injection
+# =============================================================================
+
+def make_caching_upstream(latency, prefill_per_token):
+    """Streaming /v1/messages that caches prompt prefixes at cache_control breakpoints like the API
+
+    Prefixes are hashed per tools / system / message, the same granularity
+    the proxy works at. The first byte waits `latency` plus
+    `prefill_per_token` for every token not read from the cache.
+    """
+    stats = {'calls': 0, 'input_tokens': 0, 'cache_read_tokens': 0, 'cache_write_tokens': 0}
+    cache = set()
+
+    def canonical(part):
+        # A string is the same prompt as one text block; cache_control doesn't change the prefix
+        if isinstance(part, str):
+            return [{'type': 'text', 'text': part}]
+        if isinstance(part, list):
+            return [canonical(item) if isinstance(item, (dict, list)) else item for item in part]
+        if isinstance(part, dict):
+            return {key: canonical(value) if key in ('content', 'system') or isinstance(value, (dict, list)) else value
+                    for key, value in part.items() if key != 'cache_control'}
+        return part
+
+    async def messages(request):
+        body = await request.json()
+        stats['calls'] += 1
+        parts = ([body['tools']] if body.get('tools') else []) + ([body['system']] if body.get('system') else [])
+        parts += body['messages']
+        digest, size, prefixes, breakpoints = b'', 0, [], []
+        for i, part in enumerate(parts):
+            encoded = json.dumps(canonical(part), sort_keys=True).encode()
+            size += len(encoded) // 4
+            digest = hashlib.blake2b(digest + encoded, digest_size=16).digest()
+            prefixes.append((size, digest))
+            if '"cache_control"' in json.dumps(part):
+                breakpoints.append(i)
+        read = max((prefixes[i][0] for i in breakpoints if prefixes[i][1] in cache), default=0)
+        write = max((prefixes[i][0] for i in breakpoints), default=0)
+        write = write - read if write > read else 0
+        cache.update(prefixes[i][1] for i in breakpoints)
+        uncached = size - read - write
+        for key, tokens in (('input_tokens', uncached), ('cache_read_tokens', read), ('cache_write_tokens', write)):
+            stats[key] += tokens
+
+        async def events():
+            await asyncio.sleep(latency + (uncached + write) * prefill_per_token)
+            yield sse_event('message_start', {'type': 'message_start', 'message': {
+                'id': f"msg_fake_{stats['calls']}", 'type': 'message', 'role': 'assistant',
+                'model': body['model'], 'content': [], 'usage': {
+                    'input_tokens': uncached, 'output_tokens': 1,
+                    'cache_read_input_tokens': read, 'cache_creation_input_tokens': write,
+                },
+            }})
+            yield sse_event('content_block_start', {
+                'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''},
+            })
+            yield sse_event('content_block_delta', {
+                'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': 'done'},
+            })
+            yield sse_event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+            yield sse_event('message_delta', {
+                'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': 20},
+            })
+            yield sse_event('message_stop', {'type': 'message_stop'})
+
+        return StreamingResponse(events(), media_type='text/event-stream')
+
+    app = Starlette(routes=[Route('/v1/messages', messages, methods=['POST'])])
+    app.state.stats = stats
+    return app
+
+
+async def prompt_cache_run(args, enabled):
+    """Agent-style sessions through the proxy: same tools and system prompt, one growing conversation each"""
+    upstream = make_caching_upstream(args.latency, args.prefill_us / 1_000_000)
+    upstream_port = free_port()
+    tools = [{'name': f'tool_{i}', 'description': 'Runs a step of the build. ' * (args.tools_tokens // 60),
+              'input_schema': {'type': 'object', 'properties': {'path': {'type': 'string'}}}} for i in range(10)]
+    system = 'You are a coding agent working in a monorepo. ' * (args.system_tokens // 11)
+    ttfts = []
+
+    async with serve_in_background(upstream, upstream_port), \
+            run_proxy(upstream_port, {'CLAUDE_PROXY_PROMPT_CACHE': '1' if enabled else '0'}) as proxy_url, \
+            aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+
+        async def session_turns(developer):
+            conversation = []
+            for turn in range(args.turns):
+                conversation.append({'role': 'user', 'content': f'{developer} turn {turn}: ' + 'fix the tests. ' * 50})
+                start = time.perf_counter()
+                async with session.post(
+                    f'{proxy_url}/v1/messages',
+                    json={'model': args.model, 'max_tokens': 1024, 'stream': True,
+                          'tools': tools, 'system': system, 'messages': conversation},
+                    headers={'x-api-key': 'bench-key', 'anthropic-version': '2023-06-01'},
+                ) as response:
+                    await response.content.readany()
+                    ttfts.append(time.perf_counter() - start)
+                    await response.read()
+                conversation.append({'role': 'assistant', 'content': 'done'})
+
+        await asyncio.gather(*(session_turns(f'dev{i}') for i in range(args.developers)))
+        # Usage is recorded in the background after each stream ends
+        await asyncio.sleep(0.5)
+        async with session.get(f'{proxy_url}/debug/prompt-cache') as response:
+            report = await response.json()
+    return upstream.state.stats, ttfts, report
+
+
+async def prompt_cache(args):
+    """Cost and time to first token with and without automatic cache_control breakpoints"""
+    proxy = load_proxy_module()
+    print("=========================================")
+    print("Prompt Cache Breakpoint Injection")
+    print("=========================================")
+    print(f"{args.developers} developers x {args.turns} turns, ~{args.system_tokens} token system prompt, "
+          f"~{args.tools_tokens} tokens of tools, {args.prefill_us:.0f}us prefill per uncached token")
+    print(f"{'Mode':<10} {'uncached':>10} {'read':>10} {'written':>10} {'cost':>9} {'TTFT p50':>9} {'TTFT p95':>9}")
+    for label, enabled in (('off', False), ('injected', True)):
+        stats, ttfts, report = await prompt_cache_run(args, enabled)
+        cost = proxy.calculate_cost(args.model, stats['input_tokens'], 20 * stats['calls'],
+                                    stats['cache_read_tokens'], stats['cache_write_tokens'])
+        print(f"{label:<10} {stats['input_tokens']:>10} {stats['cache_read_tokens']:>10} "
+              f"{stats['cache_write_tokens']:>10} {cost:>8.4f}$ {percentile(ttfts, 50) * 1000:>7.0f}ms "
+              f"{percentile(ttfts, 95) * 1000:>7.0f}ms")
+        if enabled:
+            print(f"Proxy injector: {report['injector']}")
+            for developer, entry in report['developers'].items():
+                ttft = ', '.join(f"{outcome} {cell['mean']:.0f}ms" for outcome, cell in entry['ttft_ms'].items())
+                print(f"  {developer}: saved ${entry['saved_usd']:.4f}, mean TTFT {ttft}")
+
+
+# =============================================================================
+# Pre-forked workers
+# =============================================================================
+
+@contextlib.contextmanager
+def serve_in_process(app, port):
+    """Run an ASGI app on 127.0.0.1:port in a forked process, so it doesn't share the benchmark's CPU"""
+    process = multiprocessing.get_context('fork').Process(
+        target=uvicorn.run, args=(app,), kwargs={'host': '127.0.0.1', 'port': port, 'log_level': 'warning'},
+        daemon=True)
+    process.start()
+    try:
+        for _ in range(200):
+            with contextlib.suppress(OSError):
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            time.sleep(0.05)
+        yield process
+    finally:
+        process.terminate()
+        process.join()
+
+
+async def closed_loop(session, proxy_url, concurrency, duration, developers):
+    """`concurrency` clients sending back-to-back requests for `duration` seconds; [(status, seconds)]"""
+    results = []
+    deadline = time.perf_counter() + duration
+
+    async def client(i):
+        headers = {'x-api-key': f'bench-key-{i % developers + 1}', 'anthropic-version': '2023-06-01'}
+        n = 0
+        while time.perf_counter() < deadline:
+            payload = dict(SAMPLE_REQUEST, messages=[{'role': 'user', 'content': f'client {i} request {n}'}])
+            n += 1
+            start = time.perf_counter()
+            try:
+                async with session.post(f'{proxy_url}/v1/messages', json=payload, headers=headers) as response:
+                    await response.read()
+                    status = response.status
+            except aiohttp.ClientError:
+                status = 'error'
+            results.append((status, time.perf_counter() - start))
+
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    return results
+
+
+async def workers_run(args, count, upstream_port, state_dir):
+    """Load one proxy running `count` workers; client results plus what the proxy itself counted"""
+    env = {
+        'CLAUDE_PROXY_WORKERS': str(count),
+        'CLAUDE_PROXY_BUDGET_STATE': os.path.join(state_dir, f'budget-{count}.json'),
+        'MAX_PROJECT_DAILY': '1000000',
+    }
+    env.update({f'DEV{i}_CLAUDE_KEY': f'bench-key-{i}' for i in range(1, args.developers + 1)})
+    async with run_proxy(upstream_port, env, with_process=True) as (proxy_url, proc), \
+            aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        # /health answers once one worker is up; wait until new connections reach all of them
+        pids = set()
+        for _ in range(200):
+            async with aiohttp.ClientSession() as probe, probe.get(f'{proxy_url}/debug/workers') as response:
+                pids.add((await response.json())['pid'])
+            if len(pids) >= count:
+                break
+            await asyncio.sleep(0.05)
+        if args.restart:
+            # Rolling restart halfway through: every worker is replaced under load
+            asyncio.get_running_loop().call_later(args.duration / 2, proc.send_signal, signal.SIGUSR1)
+        started = time.perf_counter()
+        results = await closed_loop(session, proxy_url, args.concurrency, args.duration, args.developers)
+        wall = time.perf_counter() - started
+        # Workers publish metrics every second; usage is recorded just after each response
+        await asyncio.sleep(1.5)
+        async with session.get(f'{proxy_url}/metrics') as response:
+            exposition = await response.text()
+        async with session.get(f'{proxy_url}/debug/budget') as response:
+            spent = (await response.json())['spent']
+
+    counted = sum(
+        float(line.rsplit(' ', 1)[1]) for line in exposition.splitlines()
+        if line.startswith('claude_proxy_requests_total{') and 'status="200"' in line
+    )
+    day = time.strftime('%Y-%m-%d', time.gmtime())
+    return results, wall, len(pids), counted, spent.get(day, {}).get('*', 0.0)
+
+
+def workers(args):
+    """Throughput as the worker count grows, and whether shared totals match what clients saw"""
+    proxy = load_proxy_module()
+    upstream_port = free_port()
+    cost = proxy.calculate_cost(SAMPLE_REQUEST['model'], 42, 7)
+    print("=========================================")
+    print("Pre-forked Workers")
+    print("=========================================")
+    print(f"{os.cpu_count()} CPUs, {args.concurrency} clients over {args.developers} developers for "
+          f"{args.duration:.0f}s per run, fake upstream in its own process"
+          + (", rolling restart halfway" if args.restart else ""))
+    print(f"{'Workers':>7} {'req/s':>8} {'p50':>8} {'p99':>8} {'failed':>7} {'pids':>5} {'ok':>7} "
+          f"{'counted':>8} {'budget':>10} {'expected':>10}")
+    with serve_in_process(make_fake_upstream(args.latency), upstream_port), \
+            tempfile.TemporaryDirectory() as state_dir:
+        for count in args.workers:
+            results, wall, pids, counted, spent = asyncio.run(workers_run(args, count, upstream_port, state_dir))
+            ok = [seconds for status, seconds in results if status == 200]
+            print(f"{count:>7} {len(ok) / wall:>8.0f} {percentile(ok, 50) * 1000:>6.1f}ms "
+                  f"{percentile(ok, 99) * 1000:>6.1f}ms {len(results) - len(ok):>7} {pids:>5} {len(ok):>7} "
+                  f"{counted:>8.0f} {spent:>9.4f}$ {len(ok) * cost:>9.4f}$")
+
+
+# =============================================================================
+# Traffic capture replay
+# =============================================================================
+
+def load_capture(path):
+    """Records from a CLAUDE_PROXY_CAPTURE file that have a request shape, oldest first"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            with contextlib.suppress(ValueError):
+                record = json.loads(line)
+                if record.get('request_bytes'):
+                    records.append(record)
+    records.sort(key=lambda record: record['ts'])
+    return records
+
+
+# Seconds per output token and time to first byte relative to sonnet, by model family; used for
+# synthetic traces and to replay a record against a different model than it was captured from
+MODEL_SPEEDS = {'haiku': (0.004, 0.5), 'sonnet': (0.008, 1.0), 'opus': (0.015, 1.5)}
+
+
+def model_speed(model):
+    for family, speed in MODEL_SPEEDS.items():
+        if family in (model or ''):
+            return speed
+    return MODEL_SPEEDS['sonnet']
+
+
+def synthetic_capture(count, rate, seed=1):
+    """A capture-shaped trace for when there is no real one: eight developers, mostly streaming"""
+    rng = random.Random(seed)
+    # model, share of calls
+    models = (('claude-haiku-4-5-20251001', 0.3), ('claude-sonnet-4-5-20250929', 0.6),
+              ('claude-opus-4-1-20250805', 0.1))
+    ts = 1_700_000_000.0
+    records = []
+    for _ in range(count):
+        ts += rng.expovariate(rate)
+        model = rng.choices([model for model, _ in models], weights=[share for _, share in models])[0]
+        per_token, ttfb_factor = model_speed(model)
+        input_tokens = int(min(50_000, rng.lognormvariate(8, 1.2)))
+        output_tokens = max(1, int(min(2000, rng.lognormvariate(4.5, 0.8))))
+        ttfb = rng.uniform(0.05, 0.4) * ttfb_factor
+        records.append({
+            'ts': round(ts, 3), 'developer': f'dev{rng.randrange(8)}', 'model': model,
+            'stream': rng.random() < 0.7, 'request_bytes': input_tokens * 4, 'max_tokens': 4096,
+            'messages': rng.randrange(1, 30) | 1, 'tools': rng.choice((0, 0, 10, 20)), 'system': True,
+            'status': 200, 'source': 'upstream', 'upstream_ttfb': round(ttfb, 4),
+            'upstream_latency': round(ttfb + output_tokens * per_token, 4), 'response_bytes': output_tokens * 4 + 300,
+            'input_tokens': input_tokens, 'output_tokens': output_tokens, 'cache_read_tokens': 0,
+            'cache_write_tokens': 0,
+        })
+    return records
+
+
+def expected_status(record):
+    """Only upstream answers are replayed; the proxy's own rejections depend on its config"""
+    return record.get('status') or 200 if record.get('source') == 'upstream' else 200
+
+
+def make_replay_upstream(records, latency_scale=1.0, max_events=50):
+    """Fake upstream that answers request i like captured record i
+
+    Requests carry their record index in metadata.user_id. Streams send the
+    first event after the recorded time to first byte and spread the
+    recorded output over the rest of the recorded latency, in at most
+    `max_events` deltas; other replies come whole after the recorded
+    latency. Records the proxy answered itself (cache hits, coalesced
+    followers) have no upstream timings and replay their total duration.
+    A request for another model family than the record was served by (model
+    routing) gets its timings rescaled by MODEL_SPEEDS.
+    """
+
+    async def replay_events(model, ttfb, latency, usage, text_bytes):
+        await asyncio.sleep(ttfb)
+        yield sse_event('message_start', {'type': 'message_start', 'message': {
+            'id': 'msg_replay', 'type': 'message', 'role': 'assistant', 'model': model, 'content': [],
+            'usage': dict(usage, output_tokens=1),
+        }})
+        yield sse_event('content_block_start', {
+            'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''},
+        })
+        events = max(1, min(max_events, usage['output_tokens']))
+        text = 'x' * max(1, text_bytes // events)
+        for _ in range(events):
+            await asyncio.sleep((latency - ttfb) / events)
+            yield sse_event('content_block_delta', {
+                'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text},
+            })
+        yield sse_event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        yield sse_event('message_delta', {
+            'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'},
+            'usage': {'output_tokens': usage['output_tokens']},
+        })
+        yield sse_event('message_stop', {'type': 'message_stop'})
+
+    async def messages(request):
+        body = await request.json()
+        record = records[int(body['metadata']['user_id'].rsplit('-', 1)[1])]
+        latency = (record.get('upstream_latency') or record.get('duration') or 0.0) * latency_scale
+        ttfb = min(latency, (record.get('upstream_ttfb') or latency) * latency_scale)
+        served, model = model_speed(record.get('routed_model') or record.get('model')), model_speed(body.get('model'))
+        if served != model:
+            generation = (latency - ttfb) * model[0] / served[0]
+            ttfb *= model[1] / served[1]
+            latency = ttfb + generation
+        status = expected_status(record)
+        if status != 200:
+            await asyncio.sleep(ttfb)
+            return JSONResponse({'type': 'error', 'error': {'type': 'api_error', 'message': 'replayed error'}},
+                                status_code=status)
+        usage = {
+            'input_tokens': record.get('input_tokens') or record['request_bytes'] // 4,
+            'output_tokens': max(1, record.get('output_tokens') or 1),
+            'cache_read_input_tokens': record.get('cache_read_tokens') or 0,
+            'cache_creation_input_tokens': record.get('cache_write_tokens') or 0,
+        }
+        text_bytes = max(1, (record.get('response_bytes') or 0) - 300)
+        model = body.get('model', SAMPLE_REQUEST['model'])
+        if body.get('stream'):
+            return StreamingResponse(replay_events(model, ttfb, latency, usage, text_bytes),
+                                     media_type='text/event-stream')
+        await asyncio.sleep(latency)
+        return JSONResponse({
+            'id': 'msg_replay', 'type': 'message', 'role': 'assistant', 'model': model,
+            'content': [{'type': 'text', 'text': 'x' * text_bytes}], 'stop_reason': 'end_turn', 'usage': usage,
+        })
+
+    return Starlette(routes=[Route('/v1/messages', messages, methods=['POST'])])
+
+
+def replay_body(record, index):
+    """A request with the recorded model, stream flag, message and tool counts, padded to the recorded size"""
+    messages = [{'role': 'assistant' if i % 2 else 'user', 'content': 'x'} for i in range(record.get('messages') or 1)]
+    if messages[-1]['role'] != 'user':
+        messages.append({'role': 'user', 'content': 'x'})
+    payload = {
+        'model': record.get('model') or SAMPLE_REQUEST['model'],
+        'max_tokens': record.get('max_tokens') or 1024,
+        'stream': bool(record.get('stream')),
+        'metadata': {'user_id': f'replay-{index}'},
+        'messages': messages,
+    }
+    if record.get('tools'):
+        payload['tools'] = [{'name': f'tool_{i}', 'description': 'x', 'input_schema': {'type': 'object'}}
+                            for i in range(record['tools'])]
+    if record.get('system'):
+        payload['system'] = 'x'
+    messages[-1]['content'] = 'x' * max(1, record['request_bytes'] - len(json.dumps(payload)) + 1)
+    return json.dumps(payload).encode()
+
+
+def process_tree(pid):
+    """pid and all its descendants (pre-forked workers), from /proc"""
+    pids = [pid]
+    for parent in pids:
+        with contextlib.suppress(OSError):
+            with open(f'/proc/{parent}/task/{parent}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+    return pids
+
+
+def process_cpu(pid):
+    """User + system CPU seconds used so far by a process tree"""
+    ticks = 0
+    for member in process_tree(pid):
+        with contextlib.suppress(OSError):
+            with open(f'/proc/{member}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+async def replay_run(args, records, proxy_env=(), collect=None):
+    """Replay `records` through a fresh proxy
+
+    Returns per-request (status, TTFB, latency, model routed from), the wall
+    time, the proxy's CPU seconds and peak RSS, and what `collect(session,
+    proxy_url)` returned just before the proxy was stopped.
+    """
+    developers = sorted({record['developer'] for record in records})
+    keys = {developer: f'replay-key-{i + 1}' for i, developer in enumerate(developers)}
+    env = {f'DEV{i + 1}_CLAUDE_KEY': key for i, key in enumerate(keys.values())}
+    env.update(item.split('=', 1) for item in list(args.proxy_env) + list(proxy_env))
+    bodies = [replay_body(record, i) for i, record in enumerate(records)]
+    results = [None] * len(records)
+    upstream_port = free_port()
+
+    with serve_in_process(make_replay_upstream(records, args.latency_scale), upstream_port):
+        async with run_proxy(upstream_port, env, with_process=True) as (proxy_url, proc), \
+                aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0),
+                                      timeout=aiohttp.ClientTimeout(total=None)) as session:
+            # Let pre-forked workers finish starting before the clock starts
+            await asyncio.sleep(1)
+            peak_rss = 0
+
+            async def sample_rss():
+                nonlocal peak_rss
+                while True:
+                    rss = 0
+                    for member in process_tree(proc.pid):
+                        with contextlib.suppress(OSError, KeyError):
+                            rss += process_memory(member)[0]
+                    peak_rss = max(peak_rss, rss)
+                    await asyncio.sleep(0.1)
+
+            async def one(i):
+                headers = {'x-api-key': keys[records[i]['developer']], 'anthropic-version': '2023-06-01',
+                           'content-type': 'application/json'}
+                start = time.perf_counter()
+                ttfb, status, routed_from = None, 'error', None
+                try:
+                    async with session.post(f'{proxy_url}/v1/messages', data=bodies[i], headers=headers) as response:
+                        await response.content.readany()
+                        ttfb = time.perf_counter() - start
+                        await response.read()
+                        status = response.status
+                        routed_from = response.headers.get('x-claude-proxy-routed-from')
+                except aiohttp.ClientError:
+                    pass
+                results[i] = (status, ttfb, time.perf_counter() - start, routed_from)
+
+            sampler = asyncio.create_task(sample_rss())
+            cpu_before = process_cpu(proc.pid)
+            first = records[0]['ts']
+            started = time.perf_counter()
+            tasks = []
+            for i, record in enumerate(records):
+                delay = (record['ts'] - first) / args.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(one(i)))
+            await asyncio.gather(*tasks)
+            wall = time.perf_counter() - started
+            cpu = process_cpu(proc.pid) - cpu_before
+            sampler.cancel()
+            collected = await collect(session, proxy_url) if collect else None
+    return results, wall, cpu, peak_rss, collected
+
+
+# name, label, higher is better, smallest change worth flagging
+REPLAY_METRICS = (
+    ('throughput', 'throughput (req/s)', True, 0.0),
+    ('latency_p50_ms', 'latency p50 (ms)', False, 1.0),
+    ('latency_p95_ms', 'latency p95 (ms)', False, 1.0),
+    ('latency_p99_ms', 'latency p99 (ms)', False, 1.0),
+    ('ttfb_p50_ms', 'TTFB p50 (ms)', False, 1.0),
+    ('ttfb_p95_ms', 'TTFB p95 (ms)', False, 1.0),
+    ('ttfb_p99_ms', 'TTFB p99 (ms)', False, 1.0),
+    ('peak_rss_mb', 'peak RSS (MB)', False, 1.0),
+    ('cpu_ms_per_request', 'CPU per request (ms)', False, 0.05),
+)
+
+
+def summarize_replay(records, results, wall, cpu, peak_rss):
+    ok = [result for result in results if result[0] == 200]
+    latencies = [result[2] for result in ok]
+    ttfbs = [result[1] for result in ok if result[1] is not None]
+    summary = {
+        'requests': len(results),
+        'ok': len(ok),
+        'unexpected_status': sum(1 for record, result in zip(records, results) if result[0] != expected_status(record)),
+        'wall_seconds': round(wall, 3),
+        'throughput': round(len(ok) / wall, 2),
+        'peak_rss_mb': round(peak_rss / 1e6, 1),
+        'cpu_ms_per_request': round(cpu * 1000 / max(1, len(results)), 3),
+    }
+    for p in (50, 95, 99):
+        summary[f'latency_p{p}_ms'] = round(percentile(latencies, p) * 1000, 2)
+        summary[f'ttfb_p{p}_ms'] = round(percentile(ttfbs, p) * 1000, 2)
+    return summary
+
+
+def compare_replays(baseline, current, threshold):
+    """Print each metric against the baseline; returns the labels that regressed by more than `threshold`"""
+    regressions = []
+    print(f"{'Metric':<22} {'baseline':>10} {'current':>10} {'change':>8}")
+    for key, label, higher_is_better, floor in REPLAY_METRICS:
+        before, after = baseline[key], current[key]
+        change = (after - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        verdict = ''
+        if abs(after - before) > floor:
+            if worse > threshold:
+                verdict = 'REGRESSION'
+                regressions.append(label)
+            elif worse < -threshold:
+                verdict = 'better'
+        print(f"{label:<22} {before:>10.2f} {after:>10.2f} {change:>+7.1%} {verdict}")
+    if current['unexpected_status'] > baseline['unexpected_status']:
+        regressions.append('unexpected statuses')
+        print(f"Unexpected statuses: {baseline['unexpected_status']} -> {current['unexpected_status']} REGRESSION")
+    return regressions
+
+
+def replay_trace(args):
+    """(records, description) for --capture, or a synthetic trace without one"""
+    if args.capture:
+        records = load_capture(args.capture)
+        if not records:
+            sys.exit(f'No replayable records in {args.capture}')
+        return records, args.capture
+    return synthetic_capture(args.synthetic, args.rate), f'synthetic, {args.synthetic} requests at {args.rate:g}/s'
+
+
+def replay(args):
+    """Drive the proxy with a captured (or synthetic) trace; report, save and compare against a baseline"""
+    records, source = replay_trace(args)
+    results, wall, cpu, peak_rss, _ = asyncio.run(replay_run(args, records))
+    summary = summarize_replay(records, results, wall, cpu, peak_rss)
+    summary['capture'] = source
+    summary['proxy_env'] = args.proxy_env
+
+    print("=========================================")
+    print("Traffic Replay")
+    print("=========================================")
+    streams = sum(1 for record in records if record.get('stream'))
+    print(f"Trace: {source}; {len(records)} requests, {streams} streaming, "
+          f"arrivals x{args.speed:g}, upstream latency x{args.latency_scale:g}")
+    if args.proxy_env:
+        print(f"Proxy env: {' '.join(args.proxy_env)}")
+    print(f"Completed:        {summary['ok']}/{summary['requests']} "
+          f"({summary['unexpected_status']} with a status other than recorded) in {wall:.1f}s")
+    print(f"Throughput:       {summary['throughput']:.1f} req/s")
+    print(f"Latency p50/p95/p99: {summary['latency_p50_ms']:.0f} / {summary['latency_p95_ms']:.0f} / "
+          f"{summary['latency_p99_ms']:.0f} ms")
+    print(f"TTFB p50/p95/p99:    {summary['ttfb_p50_ms']:.0f} / {summary['ttfb_p95_ms']:.0f} / "
+          f"{summary['ttfb_p99_ms']:.0f} ms")
+    print(f"Proxy peak RSS:   {summary['peak_rss_mb']:.1f}MB")
+    print(f"Proxy CPU:        {summary['cpu_ms_per_request']:.2f}ms per request")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"Saved to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nAgainst {args.baseline} (regression = worse by more than {args.threshold:.0%}):")
+        if compare_replays(baseline, summary, args.threshold):
+            sys.exit(1)
+
+
+async def proxy_costs(session, proxy_url):
+    """USD billed per model family, from the proxy's /metrics once pending usage is recorded"""
+    await asyncio.sleep(0.5)
+    async with session.get(f'{proxy_url}/metrics') as response:
+        text = await response.text()
+    costs = {}
+    for line in text.splitlines():
+        if line.startswith('claude_proxy_cost_usd_total{'):
+            labels, value = line.rsplit(' ', 1)
+            model = re.search(r'model="([^"]*)"', labels).group(1)
+            costs[model] = costs.get(model, 0.0) + float(value)
+    return costs
+
+
+def routing(args):
+    """Replay one trace with model routing off and on; latency and cost change overall and for routed calls"""
+    records, source = replay_trace(args)
+    env = [f'CLAUDE_PROXY_MODEL_ROUTING_SMALL_TOKENS={args.small_tokens}',
+           f"CLAUDE_PROXY_MODEL_ROUTING_TOOLS={'1' if args.tools else '0'}"]
+    runs = {}
+    for mode in ('off', 'on'):
+        runs[mode] = asyncio.run(replay_run(args, records, env + [f'CLAUDE_PROXY_MODEL_ROUTING={mode}'],
+                                            collect=proxy_costs))
+
+    print("=========================================")
+    print("Model Routing Evaluation")
+    print("=========================================")
+    print(f"Trace: {source}; {len(records)} requests; small = estimated input <= {args.small_tokens} tokens, "
+          f"tool definitions {'allowed' if args.tools else 'excluded'}")
+    routed = [i for i, result in enumerate(runs['on'][0]) if result[3]]
+    print(f"Routed: {len(routed)}/{len(records)} requests")
+
+    def figures(results, indices):
+        ok = [results[i] for i in indices if results[i][0] == 200]
+        latencies, ttfbs = [r[2] for r in ok], [r[1] for r in ok if r[1] is not None]
+        return (len(ok), percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+                percentile(ttfbs, 50) * 1000, percentile(ttfbs, 95) * 1000)
+
+    for title, indices in (('All requests', range(len(records))), ('Routed requests', routed)):
+        if not indices:
+            continue
+        print(f"\n{title}:")
+        print(f"{'Routing':<8} {'ok':>5} {'p50 ms':>8} {'p95 ms':>8} {'TTFB p50':>9} {'TTFB p95':>9}")
+        rows = {mode: figures(runs[mode][0], indices) for mode in runs}
+        for mode, row in rows.items():
+            print(f"{mode:<8} {row[0]:>5} {row[1]:>8.0f} {row[2]:>8.0f} {row[3]:>9.0f} {row[4]:>9.0f}")
+        change = [(after - before) / before if before else 0.0 for before, after in zip(rows['off'], rows['on'])]
+        print(f"{'change':<8} {'':>5} {change[1]:>+8.1%} {change[2]:>+8.1%} {change[3]:>+9.1%} {change[4]:>+9.1%}")
+
+    print("\nCost (USD, from the proxy's cost_usd_total):")
+    models = sorted(set(runs['off'][4]) | set(runs['on'][4]))
+    for model in models:
+        print(f"  {model:<22} {runs['off'][4].get(model, 0.0):>10.4f} -> {runs['on'][4].get(model, 0.0):>10.4f}")
+    before, after = sum(runs['off'][4].values()), sum(runs['on'][4].values())
+    print(f"  {'total':<22} {before:>10.4f} -> {after:>10.4f} ({(after - before) / before if before else 0.0:+.1%})")
+
+
+def compare(args):
+    """Compare two saved replay summaries; exits 1 if the second regressed"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    print(f"{args.current} against {args.baseline} (regression = worse by more than {args.threshold:.0%}):")
+    if compare_replays(baseline, current, args.threshold):
+        sys.exit(1)
+
+
+# =============================================================================
+# Message Batches offload
+# =============================================================================
+
+def make_batch_api(processing_seconds):
+    """Stub of the Message Batches API: create, retrieve and results
+
+    A batch ends `processing_seconds` after it was created. Calls whose
+    metadata.user_id is 'invalid' come back errored, 'huge' ones succeed
+    with a 1.5 MB result line and 'garbled' ones get a line that isn't
+    JSON; the rest succeed with usage sized from the request. `api.submissions` records each batch's
+    size and the key it was submitted with.
+    """
+    batches = {}
+
+    async def create(request):
+        body = await request.json()
+        batch_id = f'msgbatch_{len(batches) + 1:04d}'
+        batches[batch_id] = {'created': time.monotonic(), 'requests': body['requests']}
+        api.submissions.append((request.headers.get('x-api-key'), len(body['requests'])))
+        return JSONResponse(batch_object(request, batch_id))
+
+    def batch_object(request, batch_id):
+        batch = batches[batch_id]
+        ended = time.monotonic() - batch['created'] >= processing_seconds
+        return {
+            'id': batch_id, 'type': 'message_batch',
+            'processing_status': 'ended' if ended else 'in_progress',
+            'request_counts': {'processing': 0 if ended else len(batch['requests']),
+                               'succeeded': len(batch['requests']) if ended else 0,
+                               'errored': 0, 'canceled': 0, 'expired': 0},
+            'results_url': f'{request.base_url}v1/messages/batches/{batch_id}/results' if ended else None,
+        }
+
+    async def retrieve(request):
+        batch_id = request.path_params['batch_id']
+        if batch_id not in batches:
+            return JSONResponse({'type': 'error', 'error': {'type': 'not_found_error'}}, status_code=404)
+        return JSONResponse(batch_object(request, batch_id))
+
+    async def results(request):
+        lines = []
+        for call in batches[request.path_params['batch_id']]['requests']:
+            params = call['params']
+            user_id = params.get('metadata', {}).get('user_id')
+            if user_id == 'garbled':
+                lines.append('{"custom_id": "%s", "result": {"type": "succ' % call['custom_id'])
+                continue
+            if user_id == 'invalid':
+                result = {'type': 'errored', 'error': {'type': 'error', 'error': {
+                    'type': 'invalid_request_error', 'message': 'invalid call'}}}
+            else:
+                result = {'type': 'succeeded', 'message': {
+                    'id': f"msg_{call['custom_id']}", 'type': 'message', 'role': 'assistant',
+                    'model': params['model'],
+                    'content': [{'type': 'text', 'text': 'x' * 1_500_000 if user_id == 'huge' else 'Batched reply'}],
+                    'stop_reason': 'end_turn',
+                    'usage': {'input_tokens': len(json.dumps(params['messages'])) // 4,
+                              'output_tokens': min(params.get('max_tokens', 50), 50)},
+                }}
+            lines.append(json.dumps({'custom_id': call['custom_id'], 'result': result}))
+        return Response('\n'.join(lines) + '\n', media_type='application/x-jsonl')
+
+    api = Starlette(routes=[
+        Route('/v1/messages/batches', create, methods=['POST']),
+        Route('/v1/messages/batches/{batch_id}', retrieve, methods=['GET']),
+        Route('/v1/messages/batches/{batch_id}/results', results, methods=['GET']),
+    ])
+    api.submissions = []
+    return api
+
+
+async def batches(args):
+    """Queue calls for batching, survive a restart, and collect results by fetch and webhook"""
+    api_port, hook_port = free_port(), free_port()
+    api = make_batch_api(args.processing)
+    delivered = []
+
+    async def hook(request):
+        delivered.append(await request.json())
+        return JSONResponse({})
+
+    developers = 4
+    keys = [f'batch-key-{i + 1}' for i in range(developers)]
+    # The call whose result is one 1.5 MB line
+    HUGE = 7
+    env = {f'DEV{i + 1}_CLAUDE_KEY': key for i, key in enumerate(keys)}
+    workdir = tempfile.mkdtemp(prefix='proxy-bench-batches-')
+    env.update({
+        'CLAUDE_PROXY_BATCH_DB': os.path.join(workdir, 'batches.sqlite3'),
+        'CLAUDE_PROXY_BATCH_API_URL': f'http://127.0.0.1:{api_port}/v1',
+        'CLAUDE_PROXY_BATCH_MIN_REQUESTS': str(args.min_requests),
+        'CLAUDE_PROXY_BATCH_CHECK_INTERVAL': '0.2',
+        'CLAUDE_PROXY_BATCH_POLL_INTERVAL': '0.5',
+        'CLAUDE_PROXY_BATCH_WEBHOOK_PREFIXES': f'http://127.0.0.1:{hook_port}/',
+        'CLAUDE_PROXY_BUDGET_STATE': os.path.join(workdir, 'budget.json'),
+    })
+
+    def call(i, developer):
+        user_id = 'invalid' if i % 50 == 49 else 'huge' if i == HUGE else f'job-{i}'
+        payload = dict(SAMPLE_REQUEST, stream=True, metadata={'user_id': user_id})
+        headers = {'x-api-key': keys[developer], 'anthropic-version': '2023-06-01',
+                   'content-type': 'application/json', 'x-claude-proxy-batch': '1'}
+        if i % 10 == 0:
+            headers['x-claude-proxy-batch-webhook'] = f'http://127.0.0.1:{hook_port}/hook'
+        return json.dumps(payload).encode(), headers
+
+    async def enqueue(session, proxy_url, indices):
+        queued, latencies = [], []
+        for i in indices:
+            body, headers = call(i, i % developers)
+            start = time.perf_counter()
+            async with session.post(f'{proxy_url}/v1/messages', data=body, headers=headers) as response:
+                data = await response.json()
+                latencies.append(time.perf_counter() - start)
+                assert response.status == 202, data
+            queued.append((data['id'], keys[i % developers], time.perf_counter()))
+        return queued, latencies
+
+    async with serve_in_background(api, api_port), \
+            serve_in_background(Starlette(routes=[Route('/hook', hook, methods=['POST'])]), hook_port), \
+            aiohttp.ClientSession() as session:
+        # A first proxy queues calls that are not yet due, then stops
+        early = list(range(args.min_requests // 2))
+        async with run_proxy(free_port(), dict(env, CLAUDE_PROXY_BATCH_MAX_AGE='3600')) as proxy_url:
+            queued, latencies = await enqueue(session, proxy_url, early)
+        submitted_before_restart = len(api.submissions)
+
+        # A second one picks them up from the database along with the rest
+        async with run_proxy(free_port(), dict(env, CLAUDE_PROXY_BATCH_MAX_AGE=str(args.max_age))) as proxy_url:
+            more, more_latencies = await enqueue(session, proxy_url, range(len(early), args.requests))
+            queued += more
+            latencies += more_latencies
+            # A batch of its own whose results can't be parsed; it must not hold up the others
+            garbled = []
+            for _ in range(3):
+                body, headers = call(0, 0)
+                body = json.dumps(dict(json.loads(body), metadata={'user_id': 'garbled'})).encode()
+                headers['x-api-key'] = 'batch-key-garbled'
+                headers.pop('x-claude-proxy-batch-webhook')
+                async with session.post(f'{proxy_url}/v1/messages', data=body, headers=headers) as response:
+                    garbled.append(((await response.json())['id'], 'batch-key-garbled', time.perf_counter()))
+
+            outcomes, waits, statuses = collections.Counter(), [], {}
+            pending = queued + garbled
+            deadline = time.perf_counter() + args.processing + args.max_age + 30
+            while pending and time.perf_counter() < deadline:
+                await asyncio.sleep(0.2)
+                still = []
+                for queued_id, key, enqueued in pending:
+                    async with session.get(f'{proxy_url}/v1/messages/queued/{queued_id}',
+                                           headers={'x-api-key': key}) as response:
+                        await response.read()
+                        if response.status == 202:
+                            still.append((queued_id, key, enqueued))
+                            continue
+                        statuses[queued_id] = response.status
+                        if (queued_id, key, enqueued) in garbled:
+                            continue
+                        outcomes[response.status] += 1
+                        waits.append(time.perf_counter() - enqueued)
+                pending = still
+            async with session.get(f'{proxy_url}/v1/messages/queued/{queued[HUGE][0]}',
+                                   headers={'x-api-key': queued[HUGE][1]}) as response:
+                huge = response.status, len(await response.read())
+            async with session.get(f'{proxy_url}/v1/messages/queued/{queued[0][0]}',
+                                   headers={'x-api-key': keys[1]}) as response:
+                other_developer = response.status
+            # Unrecognised keys are all developer 'unknown', but still can't read each other's calls
+            body, headers = call(0, 0)
+            async with session.post(f'{proxy_url}/v1/messages', data=body,
+                                    headers=dict(headers, **{'x-api-key': 'stranger-1'})) as response:
+                stranger_id = (await response.json())['id']
+            async with session.get(f'{proxy_url}/v1/messages/queued/{stranger_id}',
+                                   headers={'x-api-key': 'stranger-2'}) as response:
+                other_stranger = response.status
+            malformed = []
+            for bad in (b'{"model": "claude', b'[1, 2]', b'{"max_tokens": 10}'):
+                async with session.post(f'{proxy_url}/v1/messages', data=bad, headers=headers) as response:
+                    malformed.append(response.status)
+            await asyncio.sleep(1)
+            async with session.get(f'{proxy_url}/metrics') as response:
+                text = await response.text()
+            async with session.get(f'{proxy_url}/debug/batches') as response:
+                queue_state = await response.json()
+
+    billed = sum(float(line.rsplit(' ', 1)[1]) for line in text.splitlines()
+                 if line.startswith('claude_proxy_cost_usd_total{'))
+    discount = load_proxy_module().pricing.batch_discount
+
+    print("=========================================")
+    print("Message Batches Offload")
+    print("=========================================")
+    print(f"{args.requests} calls from {developers} developers; a developer's queue is submitted at "
+          f"{args.min_requests} calls or {args.max_age:g}s; the stub takes {args.processing:g}s per batch")
+    print(f"Enqueue latency:  p50 {percentile(latencies, 50) * 1000:.1f}ms  p99 {percentile(latencies, 99) * 1000:.1f}ms")
+    print(f"Queued before restart: {len(early)} calls, {submitted_before_restart} batches submitted by then")
+    sizes = [size for _, size in api.submissions]
+    print(f"Batches submitted: {len(sizes)} (sizes {min(sizes)}-{max(sizes)}, "
+          f"{len({key for key, _ in api.submissions})} API keys)")
+    print(f"Results fetched:  {dict(outcomes)}; {len(pending)} still pending")
+    print(f"Enqueue to result: p50 {percentile(waits, 50):.1f}s  max {max(waits):.1f}s")
+    print(f"Webhooks delivered: {len(delivered)} of {len(queued[::10])} requested")
+    print(f"1.5 MB result line: HTTP {huge[0]}, {huge[1] / 1e6:.1f} MB; unreadable batch's calls: "
+          f"{[statuses.get(queued_id, 'pending') for queued_id, _, _ in garbled]}")
+    print(f"Another developer fetching a call: {other_developer}; another unrecognised key: {other_stranger}")
+    print(f"Malformed calls (broken JSON, not an object, no messages): {malformed}")
+    print(f"Billed:           ${billed:.4f} at batch pricing (${billed / discount:.4f} at list price)")
+    print(f"Queue after:      {queue_state['states']}, {len(queue_state['batches'])} batches open")
+
+
+
+
+# =============================================================================
+# Response cache
+# =============================================================================
+
+async def cache(args):
+    """Response cache hits, TTL expiry and the disk tier surviving a restart"""
+    upstream = make_fake_upstream(args.latency, tokens=10, token_delay=0.005)
+    upstream_port = free_port()
+    stats = upstream.state.stats
+    # temperature 0 opts the non-streaming call in; the streaming one uses the header
+    calls = (
+        ('non-streaming', dict(SAMPLE_REQUEST, temperature=0), {}),
+        ('streaming', dict(SAMPLE_REQUEST, stream=True), {'x-claude-proxy-cache': '1'}),
+    )
+
+    async def one(session, proxy_url, payload, extra_headers, api_key='bench-key'):
+        headers = dict({'x-api-key': api_key, 'anthropic-version': '2023-06-01'}, **extra_headers)
+        hits_before = stats['hits']
+        start = time.perf_counter()
+        async with session.post(f'{proxy_url}/v1/messages', json=payload, headers=headers) as response:
+            body = await response.read()
+            assert response.status == 200, response.status
+            return (response.headers.get('x-claude-proxy-cache') == 'hit', stats['hits'] - hits_before,
+                    time.perf_counter() - start, body)
+
+    print("=========================================")
+    print("Response Cache")
+    print("=========================================")
+    print(f"{args.latency * 1000:.0f}ms upstream, CLAUDE_PROXY_CACHE_TTL={args.ttl:g}s, disk tier on")
+    print(f"{'Step':<42} {'expected':>8} {'cache':>6} {'upstream':>9} {'latency':>9}")
+    failed = False
+    bodies = {}
+
+    def report(step, expect_hit, result, label):
+        nonlocal failed
+        hit, upstream_calls, elapsed, body = result
+        ok = hit == expect_hit and upstream_calls == (0 if expect_hit else 1)
+        if hit:
+            # A hit replays exactly what the upstream first sent
+            ok &= body == bodies[label]
+        else:
+            bodies[label] = body
+        failed |= not ok
+        print(f"{step + ' (' + label + ')':<42} {'hit' if expect_hit else 'miss':>8} {'hit' if hit else 'miss':>6} "
+              f"{upstream_calls:>9} {elapsed * 1000:>7.1f}ms{'' if ok else '  UNEXPECTED'}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            'CLAUDE_PROXY_CACHE': '1',
+            'CLAUDE_PROXY_CACHE_TTL': str(args.ttl),
+            'CLAUDE_PROXY_CACHE_DIR': os.path.join(directory, 'cache'),
+        }
+        async with serve_in_background(upstream, upstream_port), aiohttp.ClientSession() as session:
+            async with run_proxy(upstream_port, env) as proxy_url:
+                for label, payload, headers in calls:
+                    report('first call', False, await one(session, proxy_url, payload, headers), label)
+                    report('repeat', True, await one(session, proxy_url, payload, headers), label)
+                # Disk writes happen in the background after the response
+                await asyncio.sleep(0.5)
+
+            async with run_proxy(upstream_port, env) as proxy_url:
+                for label, payload, headers in calls:
+                    report('after restart, from disk', True, await one(session, proxy_url, payload, headers), label)
+                async with session.get(f'{proxy_url}/debug/cache') as response:
+                    restarted = await response.json()
+                await asyncio.sleep(args.ttl + 0.5)
+                for label, payload, headers in calls:
+                    report('after the TTL', False, await one(session, proxy_url, payload, headers), label)
+                # Entries are per API key, so another key never gets them
+                for label, payload, headers in calls:
+                    report('another API key', False,
+                           await one(session, proxy_url, payload, headers, api_key='other-key'), label)
+
+    print(f"Proxy counters after restart: disk_hits {restarted['disk_hits']}, entries {restarted['entries']}")
+    if failed:
+        sys.exit(1)
+
+
+# =============================================================================
+# Budget restore across restarts
+# =============================================================================
+
+def flatten_spend(spent):
+    """{(period, scope): spent} from /debug/budget's nested totals"""
+    return {(period, scope): value for period, totals in spent.items() for scope, value in totals.items()}
+
+
+async def budget(args):
+    """Spend after a restart should equal spend before it, however the proxy stopped"""
+    upstream = make_fake_upstream(0.01, tokens=5, token_delay=0.001)
+    upstream_port = free_port()
+    developers = 4
+    keys = [f'budget-key-{i + 1}' for i in range(developers)]
+    base_env = {f'DEV{i + 1}_CLAUDE_KEY': key for i, key in enumerate(keys)}
+
+    async def send(session, proxy_url, start, count):
+        for i in range(start, start + count):
+            payload = dict(SAMPLE_REQUEST, stream=i % 2 == 0,
+                           messages=[{'role': 'user', 'content': f'Write a commit message for change {i}'}])
+            headers = {'x-api-key': keys[i % developers], 'anthropic-version': '2023-06-01'}
+            async with session.post(f'{proxy_url}/v1/messages', json=payload, headers=headers) as response:
+                await response.read()
+                assert response.status == 200, response.status
+
+    async def spend(session, proxy_url):
+        async with session.get(f'{proxy_url}/debug/budget') as response:
+            return flatten_spend((await response.json())['spent'])
+
+    def checkpointed(state_file):
+        if not os.path.exists(state_file):
+            return {}
+        with open(state_file) as f:
+            return flatten_spend(json.load(f)['spent'])
+
+    # How the first proxy stops, and whether it checkpointed before the last calls
+    scenarios = (
+        ('graceful restart', signal.SIGTERM, False),
+        ('crash after checkpoint', signal.SIGKILL, True),
+        ('crash, no checkpoint', signal.SIGKILL, False),
+    )
+
+    print("=========================================")
+    print("Budget Restore Across Restarts")
+    print("=========================================")
+    print(f"{args.requests} calls from {developers} developers before each restart")
+    print(f"{'Scenario':<24} {'before':>10} {'after':>10} {'replayed':>10}  scopes  result")
+    failed = False
+    async with serve_in_background(upstream, upstream_port), aiohttp.ClientSession() as session:
+        for label, stop, checkpoint_first in scenarios:
+            with tempfile.TemporaryDirectory() as workdir:
+                state_file = os.path.join(workdir, 'budget.json')
+                env = dict(base_env, **{
+                    'CLAUDE_PROXY_BUDGET_STATE': state_file,
+                    'CLAUDE_PROXY_JOURNAL_DIR': os.path.join(workdir, 'journal'),
+                    'CLAUDE_PROXY_BUDGET_CHECKPOINT_INTERVAL': '2' if checkpoint_first else '3600',
+                })
+                async with run_proxy(upstream_port, env, with_process=True) as (proxy_url, proc):
+                    half = args.requests // 2
+                    await send(session, proxy_url, 0, half)
+                    # The rest follow the first periodic checkpoint, so only the journal has them
+                    while checkpoint_first and not os.path.exists(state_file):
+                        await asyncio.sleep(0.05)
+                    await send(session, proxy_url, half, args.requests - half)
+                    before = await spend(session, proxy_url)
+                    # Past the journal's group commit, which is all a crash may lose
+                    await asyncio.sleep(0.3)
+                    proc.send_signal(stop)
+                    proc.wait(timeout=10)
+                saved = checkpointed(state_file)
+                async with run_proxy(upstream_port, env) as proxy_url:
+                    after = await spend(session, proxy_url)
+                matches = before.keys() == after.keys() and all(
+                    abs(before[key] - after[key]) < 1e-9 for key in before)
+                failed |= not matches
+                # The project-wide ('*') monthly total
+                month = time.strftime('%Y-%m', time.gmtime())
+                before_total, after_total = before.get((month, '*'), 0), after.get((month, '*'), 0)
+                print(f"{label:<24} ${before_total:>9.4f} ${after_total:>9.4f} "
+                      f"${after_total - saved.get((month, '*'), 0):>9.4f}  {len(after):>6}  "
+                      f"{'matches' if matches else 'MISMATCH'}")
+    if failed:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('loadtest', help='concurrent completions against a slow fake upstream')
+    p.add_argument('--requests', type=int, default=1000)
+    p.add_argument('--concurrency', type=int, default=500)
+    p.add_argument('--latency', type=float, default=2.0, help='fake upstream delay in seconds')
+    p.set_defaults(func=loadtest)
+
+    p = subparsers.add_parser('ttfb', help='streaming time-to-first-byte, direct vs proxy')
+    p.add_argument('--requests', type=int, default=50)
+    p.add_argument('--latency', type=float, default=0.2, help='delay before the first SSE event')
+    p.add_argument('--tokens', type=int, default=50)
+    p.add_argument('--token-delay', type=float, default=0.02)
+    p.set_defaults(func=ttfb)
+
+    p = subparsers.add_parser('pool', help='cold vs pooled upstream latency against a local TLS stand-in')
+    p.add_argument('--requests', type=int, default=200)
+    p.add_argument('--latency', type=float, default=0.0)
+    p.set_defaults(func=pool)
+
+    p = subparsers.add_parser('logs', help='batched CloudWatch Logs shipper against a local stub')
+    p.add_argument('--events', type=int, default=40_000)
+    p.add_argument('--call-latency', type=float, default=0.02, help='stub latency per AWS call')
+    p.add_argument('--flush-interval', type=float, default=1.0)
+    p.set_defaults(func=logs)
+
+    p = subparsers.add_parser('metrics', help='aggregated CloudWatch metrics against a local stub')
+    p.add_argument('--requests', type=int, default=100_000)
+    p.add_argument('--rate', type=float, default=0, help='requests/sec to simulate (0 = as fast as possible)')
+    p.add_argument('--flush-interval', type=float, default=1.0)
+    p.set_defaults(func=metrics)
+
+    p = subparsers.add_parser('keys', help='developer key lookup cost vs number of keys')
+    p.add_argument('--sizes', type=int, nargs='+', default=[8, 100, 500, 2000])
+    p.add_argument('--iterations', type=int, default=2000)
+    p.set_defaults(func=keys)
+
+    p = subparsers.add_parser('journal', help='binary usage journal vs the JSON log path')
+    p.add_argument('--records', type=int, default=200_000)
+    p.add_argument('--commit-interval', type=float, default=0.05, help='seconds between group commits')
+    p.set_defaults(func=journal)
+
+    p = subparsers.add_parser('rollups', help='rollup query time as stored history grows')
+    p.add_argument('--developers', type=int, default=20)
+    p.add_argument('--history', type=int, nargs='+', default=[30, 90, 180, 365], help='days of history')
+    p.add_argument('--iterations', type=int, default=20)
+    p.set_defaults(func=rollups)
+
+    p = subparsers.add_parser('pricing', help='model ID resolution and pricing cost per call')
+    p.add_argument('--iterations', type=int, default=100_000)
+    p.set_defaults(func=pricing)
+
+    p = subparsers.add_parser('prometheus', help='per-request cost of /metrics instrumentation')
+    p.add_argument('--requests', type=int, default=200_000)
+    p.add_argument('--developers', type=int, default=50)
+    p.add_argument('--rounds', type=int, default=5)
+    p.set_defaults(func=prometheus)
+
+    p = subparsers.add_parser('telemetry', help='response latency while CloudWatch is slow')
+    p.add_argument('--requests', type=int, default=2000)
+    p.add_argument('--concurrency', type=int, default=10)
+    p.add_argument('--latency', type=float, default=0.05, help='fake upstream delay in seconds')
+    p.add_argument('--call-latency', type=float, default=1.0, help='stub latency per CloudWatch call')
+    p.add_argument('--queue', type=int, default=100, help='log queue size, small so it fills up')
+    p.set_defaults(func=telemetry)
+
+    p = subparsers.add_parser('relay', help='proxy peak RSS per request for large responses')
+    p.add_argument('--size', type=int, default=1_000_000, help='response text bytes')
+    p.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+    p.add_argument('--rounds', type=int, default=5)
+    p.add_argument('--latency', type=float, default=0.05)
+    p.set_defaults(func=relay)
+
+    p = subparsers.add_parser('coalesce', help='identical concurrent requests share one upstream call')
+    p.add_argument('--requests', type=int, default=50)
+    p.add_argument('--latency', type=float, default=0.5)
+    p.set_defaults(func=coalesce)
+
+    p = subparsers.add_parser('fairness', help='admission control under a skewed load mix')
+    p.add_argument('--slots', type=int, default=4, help='global max in-flight')
+    p.add_argument('--hold', type=float, default=0.02, help='seconds each admitted call holds a slot')
+    p.add_argument('--heavy', type=int, default=400)
+    p.add_argument('--light', type=int, default=10)
+    p.set_defaults(func=fairness)
+
+    p = subparsers.add_parser('retries', help='retries, hedging and the circuit breaker against injected faults')
+    p.add_argument('--rate', type=float, default=50, help='client requests/sec')
+    p.add_argument('--duration', type=float, default=10)
+    p.add_argument('--latency', type=float, default=0.1, help='fake upstream delay in seconds')
+    p.add_argument('--error-rate', type=float, default=0.2)
+    p.add_argument('--slow-rate', type=float, default=0.05)
+    p.add_argument('--hedge-after', type=float, default=0.3)
+    p.add_argument('--outage', type=float, default=3.0, help='seconds of total upstream failure at the start')
+    p.set_defaults(func=retries)
+
+    p = subparsers.add_parser('router', help='latency-weighted routing and failover across Anthropic and Bedrock mocks')
+    p.add_argument('--rate', type=float, default=50, help='client requests/sec')
+    p.add_argument('--duration', type=float, default=10)
+    p.add_argument('--latency', type=float, nargs=3, default=[0.1, 0.2, 0.4],
+                   help='Anthropic, Bedrock region A and region B delays in seconds')
+    p.add_argument('--outage', type=float, default=4.0, help='seconds the fastest backend fails in the failover run')
+    p.set_defaults(func=router)
+
+    p = subparsers.add_parser('prompt-cache', help='cost and TTFT with automatic prompt cache breakpoints')
+    p.add_argument('--developers', type=int, default=4)
+    p.add_argument('--turns', type=int, default=10)
+    p.add_argument('--system-tokens', type=int, default=6000)
+    p.add_argument('--tools-tokens', type=int, default=2000)
+    p.add_argument('--latency', type=float, default=0.05, help='fake upstream delay before prefill')
+    p.add_argument('--prefill-us', type=float, default=20, help='simulated prefill microseconds per uncached token')
+    p.add_argument('--model', default='claude-sonnet-4-5-20250929')
+    p.set_defaults(func=prompt_cache)
+
+    p = subparsers.add_parser('workers', help='throughput and shared totals as the worker count grows')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    p.add_argument('--concurrency', type=int, default=64)
+    p.add_argument('--developers', type=int, default=8)
+    p.add_argument('--duration', type=float, default=10)
+    p.add_argument('--latency', type=float, default=0.0, help='fake upstream delay in seconds')
+    p.add_argument('--restart', action='store_true', help='send SIGUSR1 for a rolling restart halfway through')
+    p.set_defaults(func=workers)
+
+    def add_trace_arguments(p):
+        p.add_argument('--capture', help='CLAUDE_PROXY_CAPTURE file (default: a synthetic trace)')
+        p.add_argument('--synthetic', type=int, default=500, help='requests in the synthetic trace')
+        p.add_argument('--rate', type=float, default=20, help='synthetic arrivals per second')
+        p.add_argument('--speed', type=float, default=1.0, help='replay arrivals this many times faster')
+        p.add_argument('--latency-scale', type=float, default=1.0, help='multiply recorded upstream timings')
+        p.add_argument('--proxy-env', nargs='*', default=[], metavar='NAME=VALUE', help='extra proxy environment')
+
+    p = subparsers.add_parser('replay', help='replay captured traffic shapes and timings through the proxy')
+    add_trace_arguments(p)
+    p.add_argument('--output', help='save the summary as JSON')
+    p.add_argument('--baseline', help='saved summary to compare against; exits 1 on a regression')
+    p.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    p.set_defaults(func=replay)
+
+    p = subparsers.add_parser('compare', help='compare two saved replay summaries')
+    p.add_argument('baseline')
+    p.add_argument('current')
+    p.add_argument('--threshold', type=float, default=0.1)
+    p.set_defaults(func=compare)
+
+    p = subparsers.add_parser('routing', help='latency and cost of a replayed trace with model routing off vs on')
+    add_trace_arguments(p)
+    p.add_argument('--small-tokens', type=int, default=2000, help='CLAUDE_PROXY_MODEL_ROUTING_SMALL_TOKENS')
+    p.add_argument('--tools', action='store_true', help='also route requests that define tools')
+    p.set_defaults(func=routing)
+
+    p = subparsers.add_parser('batches', help='Message Batches offload lifecycle against a local batch API stub')
+    p.add_argument('--requests', type=int, default=400)
+    p.add_argument('--min-requests', type=int, default=50, help='CLAUDE_PROXY_BATCH_MIN_REQUESTS')
+    p.add_argument('--max-age', type=float, default=2, help='CLAUDE_PROXY_BATCH_MAX_AGE')
+    p.add_argument('--processing', type=float, default=2, help='seconds the stub takes to end a batch')
+    p.set_defaults(func=batches)
+
+    p = subparsers.add_parser('cache', help='response cache hits, TTL expiry and reload from the disk tier')
+    p.add_argument('--latency', type=float, default=0.3, help='fake upstream latency (s)')
+    p.add_argument('--ttl', type=float, default=5, help='CLAUDE_PROXY_CACHE_TTL')
+    p.set_defaults(func=cache)
+
+    p = subparsers.add_parser('budget', help='budget spend restored after a graceful restart or a crash')
+    p.add_argument('--requests', type=int, default=200)
+    p.set_defaults(func=budget)
+
+    args = parser.parse_args()
+    result = args.func(args)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+
+if __name__ == '__main__':
+    main()
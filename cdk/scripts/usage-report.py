@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Claude API Usage Report
+Per-developer, per-model and per-day usage from CloudWatch or the local usage journal
+"""
+
+import argparse
+import os
+import sqlite3
+import struct
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError as e:
+    print(f"Error: {e.name} is required for usage reports; install it with:", file=sys.stderr)
+    print("  pip3 install numpy pandas", file=sys.stderr)
+    sys.exit(1)
+
+REGION = 'ap-southeast-7'
+NAMESPACE = 'CodeServer/ClaudeAPI'
+PROJECT = 'code-server-multi-dev'
+JOURNAL_DIR = '/mnt/ebs-data/claude-proxy/journal'
+ROLLUP_DB = '/mnt/ebs-data/claude-proxy/usage-rollups.sqlite3'
+
+# GetMetricData accepts at most 500 queries per call
+MAX_QUERIES_PER_CALL = 500
+
+# (column, MetricName, statistic); SampleCount of InputTokens is one per call
+METRIC_QUERIES = [
+    ('input_tokens', 'InputTokens', 'Sum'),
+    ('output_tokens', 'OutputTokens', 'Sum'),
+    ('cost', 'TotalCost', 'Sum'),
+    ('calls', 'InputTokens', 'SampleCount'),
+]
+
+COLUMNS = ['developer', 'model', 'day', 'calls', 'input_tokens', 'output_tokens', 'cost']
+
+
+def empty_frame():
+    return pd.DataFrame({
+        'developer': pd.Series(dtype=str),
+        'model': pd.Series(dtype=str),
+        'day': pd.Series(dtype='datetime64[ns, UTC]'),
+        'calls': pd.Series(dtype=np.int64),
+        'input_tokens': pd.Series(dtype=np.int64),
+        'output_tokens': pd.Series(dtype=np.int64),
+        'cost': pd.Series(dtype=np.float64),
+    })
+
+
+# Colors
+GREEN = '\033[0;32m'
+BLUE = '\033[0;34m'
+YELLOW = '\033[1;33m'
+NC = '\033[0m'
+
+
+# =============================================================================
+# CloudWatch source
+# =============================================================================
+
+def list_series(client, project):
+    """Every (Developer, Model) pair that has published InputTokens for the project"""
+    series = set()
+    paginator = client.get_paginator('list_metrics')
+    for page in paginator.paginate(
+        Namespace=NAMESPACE,
+        MetricName='InputTokens',
+        Dimensions=[{'Name': 'Project', 'Value': project}],
+    ):
+        for metric in page['Metrics']:
+            dims = {d['Name']: d['Value'] for d in metric['Dimensions']}
+            if 'Developer' in dims and 'Model' in dims:
+                series.add((dims['Developer'], dims['Model']))
+    return sorted(series)
+
+
+def load_cloudwatch(start, end, region, project):
+    """Daily sums for every series, fetched with batched GetMetricData calls"""
+    import boto3
+
+    client = boto3.client('cloudwatch', region_name=region)
+    queries, keys = [], []
+    for developer, model in list_series(client, project):
+        for column, metric_name, stat in METRIC_QUERIES:
+            keys.append((developer, model, column))
+            queries.append({
+                'Id': f'q{len(queries)}',
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': NAMESPACE,
+                        'MetricName': metric_name,
+                        'Dimensions': [
+                            {'Name': 'Developer', 'Value': developer},
+                            {'Name': 'Model', 'Value': model},
+                            {'Name': 'Project', 'Value': project},
+                        ],
+                    },
+                    'Period': 86400,
+                    'Stat': stat,
+                },
+                'ReturnData': True,
+            })
+
+    developers, models, days, columns, values = [], [], [], [], []
+    calls = 0
+    for i in range(0, len(queries), MAX_QUERIES_PER_CALL):
+        batch = queries[i:i + MAX_QUERIES_PER_CALL]
+        kwargs = {'MetricDataQueries': batch, 'StartTime': start, 'EndTime': end, 'ScanBy': 'TimestampAscending'}
+        while True:
+            response = client.get_metric_data(**kwargs)
+            calls += 1
+            for result in response['MetricDataResults']:
+                developer, model, column = keys[int(result['Id'][1:])]
+                n = len(result['Values'])
+                developers.extend([developer] * n)
+                models.extend([model] * n)
+                columns.extend([column] * n)
+                days.extend(result['Timestamps'])
+                values.extend(result['Values'])
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+
+    if not values:
+        return empty_frame(), calls
+    long = pd.DataFrame({
+        'developer': developers,
+        'model': models,
+        'day': pd.to_datetime(days, utc=True).floor('D'),
+        'column': columns,
+        'value': values,
+    })
+    frame = long.pivot_table(index=['developer', 'model', 'day'], columns='column', values='value', aggfunc='sum')
+    frame = frame.reindex(columns=[c for c in COLUMNS if c not in ('developer', 'model', 'day')], fill_value=0)
+    return frame.fillna(0).reset_index(), calls
+
+
+# =============================================================================
+# Journal source
+# =============================================================================
+
+# Segment layout written by UsageJournal in claude-proxy.py; kept here so the
+# report doesn't need the proxy's server dependencies. A format change bumps
+# JOURNAL_VERSION there and segments of another version are skipped here.
+JOURNAL_MAGIC = b'CPUJ'
+JOURNAL_VERSION = 1
+JOURNAL_HEADER = struct.Struct('<4sBd')
+JOURNAL_STRING = struct.Struct('<cHH')
+JOURNAL_RECORD = np.dtype({
+    'names': ['tag', 'timestamp', 'developer', 'model', 'input_tokens', 'output_tokens', 'cache_read_tokens',
+              'cache_write_tokens', 'cost', 'saved_cost', 'elapsed', 'flags', 'followers'],
+    'formats': ['S1', '<f8', '<u2', '<u2', '<u4', '<u4', '<u4', '<u4', '<f8', '<f8', '<f4', 'u1', '<u2'],
+})
+
+
+def segment_names(directory):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(name for name in names if name.startswith('usage-') and name.endswith('.journal'))
+
+
+def journal_directories(directory):
+    """The journal directory plus the worker-<n> journals the proxy keeps there when pre-forked"""
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.startswith('worker-'))
+    except OSError:
+        names = []
+    return [directory] + [os.path.join(directory, name) for name in names]
+
+
+def segment_start(name):
+    return int(name[len('usage-'):-len('.journal')]) / 1000
+
+
+def decode_segment(data):
+    """(records, developer names, model names) for one segment, decoded a run of records at a time
+
+    Records are fixed width, so a run of them between two string definitions
+    is found with one strided comparison and viewed as a structured array
+    without a per-record Python loop. A torn tail ends the segment.
+    """
+    dtype = JOURNAL_RECORD
+    if len(data) < JOURNAL_HEADER.size or JOURNAL_HEADER.unpack_from(data)[:2] != (JOURNAL_MAGIC, JOURNAL_VERSION):
+        return np.empty(0, dtype), [], []
+    raw = np.frombuffer(data, dtype=np.uint8)
+    strings = {b'D': [], b'M': []}
+    runs = []
+    record_size = dtype.itemsize
+    pos, end = JOURNAL_HEADER.size, len(data)
+    while pos < end:
+        tag = data[pos:pos + 1]
+        if tag == b'U':
+            # Probe growing windows: string definitions cluster near the start of a segment
+            available, count, window = (end - pos) // record_size, 0, 64
+            while count < available:
+                step = min(window, available - count)
+                start = pos + count * record_size
+                not_records = np.flatnonzero(raw[start:start + step * record_size:record_size] != ord('U'))
+                if len(not_records):
+                    count += int(not_records[0])
+                    break
+                count += step
+                window *= 8
+            if not count:
+                break
+            runs.append(np.frombuffer(data, dtype=dtype, count=count, offset=pos))
+            pos += count * record_size
+        elif tag in strings:
+            if pos + JOURNAL_STRING.size > end:
+                break
+            _, _, length = JOURNAL_STRING.unpack_from(data, pos)
+            pos += JOURNAL_STRING.size
+            if pos + length > end:
+                break
+            strings[tag].append(data[pos:pos + length].decode('utf-8', 'replace'))
+            pos += length
+        else:
+            break
+    records = np.concatenate(runs) if runs else np.empty(0, dtype)
+    return records, strings[b'D'], strings[b'M']
+
+
+def load_journal(start, end, directory):
+    """The same daily frame as load_cloudwatch, read straight from journal segments"""
+    since, until = start.timestamp(), end.timestamp()
+
+    developer_codes, model_codes = {}, {}
+    parts = []
+    for journal_dir in journal_directories(directory):
+        names = segment_names(journal_dir)
+        for i, name in enumerate(names):
+            # Segments are named by creation time; skip any rotated out before the window.
+            # Later ones are all read: a record is stamped when queued, not when a commit writes it
+            if i + 1 < len(names) and segment_start(names[i + 1]) < since:
+                continue
+            with open(os.path.join(journal_dir, name), 'rb') as f:
+                records, developers, models = decode_segment(f.read())
+            records = records[(records['timestamp'] >= since) & (records['timestamp'] < until)]
+            if not len(records):
+                continue
+            # Segment-local string ids -> report-wide codes
+            developer_map = np.array([developer_codes.setdefault(d, len(developer_codes)) for d in developers])
+            model_map = np.array([model_codes.setdefault(m, len(model_codes)) for m in models])
+            parts.append((records, developer_map[records['developer']], model_map[records['model']]))
+
+    if not parts:
+        return empty_frame(), 0
+    records = np.concatenate([p[0] for p in parts])
+    frame = pd.DataFrame({
+        'developer': pd.Categorical.from_codes(np.concatenate([p[1] for p in parts]), list(developer_codes)),
+        'model': pd.Categorical.from_codes(np.concatenate([p[2] for p in parts]), list(model_codes)),
+        # Whole UTC days since the epoch; only the grouped rows are converted to dates
+        'day': (records['timestamp'] // 86400).astype(np.int64),
+        'calls': 1,
+        # Cache hits and coalesced followers are journaled with zero tokens and cost
+        'input_tokens': records['input_tokens'].astype(np.int64),
+        'output_tokens': records['output_tokens'].astype(np.int64),
+        'cost': records['cost'],
+    })
+    frame = frame.groupby(['developer', 'model', 'day'], observed=True, sort=False).sum().reset_index()
+    frame['day'] = pd.to_datetime(frame['day'] * 86400, unit='s', utc=True)
+    frame['developer'] = frame['developer'].astype(str)
+    frame['model'] = frame['model'].astype(str)
+    return frame, 0
+
+
+# =============================================================================
+# Rollup source
+# =============================================================================
+
+def load_rollups(start, end, path):
+    """The same daily frame from the proxy's rollup store: whole days plus today's hours
+
+    Reads one row per developer, model and day in the window, however much
+    history the store holds.
+    """
+    if not os.path.exists(path):
+        return empty_frame(), 0
+    today = int(end.timestamp() // 86400 * 86400)
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        rows = db.execute(
+            "SELECT developer, model, start - start % 86400 AS day, "
+            "SUM(calls), SUM(input_tokens), SUM(output_tokens), SUM(cost) FROM rollup "
+            "WHERE (grain = 'day' AND start >= ? AND start < ?) OR (grain = 'hour' AND start >= ? AND start < ?) "
+            "GROUP BY developer, model, day",
+            (int(start.timestamp()), today, today, end.timestamp()),
+        ).fetchall()
+    finally:
+        db.close()
+    if not rows:
+        return empty_frame(), 0
+    frame = pd.DataFrame(rows, columns=COLUMNS)
+    frame['day'] = pd.to_datetime(frame['day'], unit='s', utc=True)
+    for column in ('calls', 'input_tokens', 'output_tokens'):
+        frame[column] = frame[column].astype(np.int64)
+    return frame, 0
+
+
+# =============================================================================
+# Report
+# =============================================================================
+
+def totals_by(frame, key):
+    table = frame.groupby(key)[['calls', 'input_tokens', 'output_tokens', 'cost']].sum()
+    table['total_tokens'] = table['input_tokens'] + table['output_tokens']
+    return table
+
+
+def print_report(frame, days, source, color):
+    green, blue, yellow, nc = (GREEN, BLUE, YELLOW, NC) if color else ('', '', '', '')
+    rule = '━' * 68
+
+    print("=========================================")
+    print("Claude API Usage Report")
+    print("=========================================")
+    print("")
+    print(f"Period: Last {days} days ({source})")
+    print("")
+    print(rule)
+    print(f"{'Developer':<12} {'Input Tokens':<15} {'Output Tokens':<15} {'Total Tokens':<15} {'Cost (USD)':<12}")
+    print(rule)
+
+    by_developer = totals_by(frame, 'developer')
+    # dev2 before dev10
+    order = sorted(by_developer.index, key=lambda d: (len(d), d))
+    for developer, row in by_developer.loc[order].iterrows():
+        total = int(row['total_tokens'])
+        tint = yellow if total > 1_000_000 else blue if total > 100_000 else green
+        print(f"{tint}{developer:<12}{nc} {int(row['input_tokens']):>15,} {int(row['output_tokens']):>15,} "
+              f"{total:>15,} ${row['cost']:<11.2f}")
+
+    total_cost = float(frame['cost'].sum())
+    total_input, total_output = int(frame['input_tokens'].sum()), int(frame['output_tokens'].sum())
+    print(rule)
+    print(f"{'TOTAL':<12} {total_input:>15,} {total_output:>15,} {total_input + total_output:>15,} ${total_cost:<11.2f}")
+    print(rule)
+    print("")
+
+    if days < 30:
+        print(f"Monthly Projection: ${total_cost * 30 / days:.2f}")
+        print("")
+
+    print("Top 3 Users:")
+    print(rule)
+    for developer, cost in by_developer['cost'].nlargest(3).items():
+        print(f"{yellow}{developer:<12}{nc} ${cost:.2f}")
+    print("")
+
+    print("By Model:")
+    print(rule)
+    print(f"{'Model':<52} {'Calls':>8} {'Cost (USD)':>10}")
+    for model, row in totals_by(frame, 'model').sort_values('cost', ascending=False).iterrows():
+        print(f"{model:<52} {int(row['calls']):>8,} ${row['cost']:>9.2f}")
+    print("")
+
+    print("By Day (UTC):")
+    print(rule)
+    print(f"{'Day':<12} {'Calls':>8} {'Total Tokens':>15} {'Cost (USD)':>10}")
+    for day, row in totals_by(frame, 'day').sort_index().iterrows():
+        print(f"{day:%Y-%m-%d}   {int(row['calls']):>8,} {int(row['total_tokens']):>15,} ${row['cost']:>9.2f}")
+    print("")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('days', nargs='?', type=int, default=30, help='report window in days, today included')
+    parser.add_argument('--source', choices=['cloudwatch', 'journal', 'rollups'], default='cloudwatch')
+    parser.add_argument('--journal-dir', default=os.environ.get('CLAUDE_PROXY_JOURNAL_DIR', JOURNAL_DIR))
+    parser.add_argument('--rollup-db', default=os.environ.get('CLAUDE_PROXY_ROLLUP_DB', ROLLUP_DB))
+    parser.add_argument('--region', default=REGION)
+    parser.add_argument('--project', default=PROJECT)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    # Whole UTC days, so per-day rows line up between sources
+    end = datetime.now(timezone.utc)
+    start = end.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=args.days - 1)
+
+    if args.source == 'journal':
+        frame, calls = load_journal(start, end, args.journal_dir)
+        source = f'journal {args.journal_dir}'
+    elif args.source == 'rollups':
+        frame, calls = load_rollups(start, end, args.rollup_db)
+        source = f'rollups {args.rollup_db}'
+    else:
+        frame, calls = load_cloudwatch(start, end, args.region, args.project)
+        source = f'CloudWatch, {calls} GetMetricData calls'
+
+    print_report(frame, args.days, source, sys.stdout.isatty())
+    print("=========================================")
+    print(f"Built in {time.perf_counter() - started:.2f}s")
+    print(f"Usage: {os.path.basename(sys.argv[0])} [days] [--source cloudwatch|journal|rollups]")
+    print(f"Example: {os.path.basename(sys.argv[0])} 7  (last 7 days)")
+    print("=========================================")
+
+
+if __name__ == '__main__':
+    main()
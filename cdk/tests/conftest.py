@@ -0,0 +1,88 @@
+"""Shared fixtures for the claude-proxy.py tests"""
+
+import asyncio
+import contextlib
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+import uvicorn
+
+PROXY_SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'scripts', 'claude-proxy.py')
+
+# Keep an imported or launched proxy off /mnt/ebs-data and CloudWatch
+PROXY_ENV = {
+    'AWS_DEFAULT_REGION': 'ap-southeast-7',
+    'CLAUDE_PROXY_CLOUDWATCH': '0',
+    'CLAUDE_PROXY_JOURNAL_DIR': '',
+    'CLAUDE_PROXY_ROLLUP_DB': '',
+    'CLAUDE_PROXY_BATCH_DB': '',
+}
+
+
+@pytest.fixture(scope='session')
+def proxy():
+    """claude-proxy.py imported as a module (its file name isn't a valid module name)"""
+    for name, value in PROXY_ENV.items():
+        os.environ.setdefault(name, value)
+    spec = importlib.util.spec_from_file_location('claude_proxy', PROXY_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.asynccontextmanager
+async def serving(app, port):
+    """Run an ASGI app with uvicorn on the current event loop"""
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.01)
+    try:
+        yield
+    finally:
+        server.should_exit = True
+        await task
+
+
+@contextlib.contextmanager
+def running_proxy(upstream_port, state_dir, extra_env=None):
+    """claude-proxy.py as a subprocess pointed at a local upstream; yields its URL"""
+    port = free_port()
+    env = dict(os.environ, **PROXY_ENV)
+    env.update({
+        'CLAUDE_API_URL': f'http://127.0.0.1:{upstream_port}/v1',
+        'CLAUDE_PROXY_HOST': '127.0.0.1',
+        'CLAUDE_PROXY_PORT': str(port),
+        'CLAUDE_PROXY_BUDGET_STATE': os.path.join(state_dir, 'budget.json'),
+    })
+    env.update(extra_env or {})
+    proc = subprocess.Popen([sys.executable, PROXY_SCRIPT], env=env, stdout=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.monotonic() + 20
+        while True:
+            with contextlib.suppress(OSError):
+                with urllib.request.urlopen(f'{url}/health', timeout=1) as response:
+                    if response.status == 200:
+                        break
+            if proc.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError('claude-proxy.py did not become healthy')
+            time.sleep(0.05)
+        yield url
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
@@ -0,0 +1,91 @@
+"""AdmissionController fair queueing, driven step by step on one event loop"""
+
+import asyncio
+
+import pytest
+
+SLOTS = 2
+HEAVY, LIGHT = 40, 10
+
+
+@pytest.fixture
+def controller(proxy):
+    config = dict(
+        proxy.CONFIG,
+        limit_dev_requests_per_sec=0, limit_dev_tokens_per_min=0, limit_dev_max_in_flight=0,
+        limit_global_requests_per_sec=0, limit_global_tokens_per_min=0, limit_global_max_in_flight=SLOTS,
+        limit_queue_timeout=60,
+    )
+    return proxy.AdmissionController(config)
+
+
+async def serve(controller, arrivals):
+    """Admission order for arrivals [(after_n_admitted, developer, count)]
+
+    Only the global in-flight cap is set, so the order is decided by the
+    queue alone: each step releases the oldest admitted permit, which admits
+    exactly one waiter.
+    """
+    admitted = []
+
+    async def one(developer):
+        admitted.append((developer, await controller.acquire(developer, 100)))
+
+    async def settle():
+        for _ in range(20):
+            await asyncio.sleep(0)
+
+    total = sum(count for _, _, count in arrivals)
+    tasks = []
+    released = 0
+    while released < total:
+        for after, developer, count in arrivals:
+            if after == released:
+                tasks += [asyncio.create_task(one(developer)) for _ in range(count)]
+        await settle()
+        assert len(admitted) == min(total, released + SLOTS)
+        admitted[released][1].release()
+        released += 1
+    await asyncio.gather(*tasks)
+    assert controller.in_flight[controller.GLOBAL] == 0
+    return [developer for developer, _ in admitted]
+
+
+def test_light_developer_not_starved_behind_backlog(controller):
+    order = asyncio.run(serve(controller, [(0, 'heavy', HEAVY), (0, 'light', LIGHT)]))
+
+    # The first SLOTS heavy requests start immediately; after that the two queues alternate
+    queued = order[SLOTS:SLOTS + 2 * LIGHT]
+    assert queued.count('light') / len(queued) >= 0.45
+    # FIFO would finish the light developer at position 50; round-robin does by 2 * LIGHT + SLOTS
+    last_light = max(i for i, developer in enumerate(order) if developer == 'light')
+    assert last_light < 2 * LIGHT + SLOTS
+    light_positions = [i for i, developer in enumerate(order) if developer == 'light']
+    assert max(b - a for a, b in zip(light_positions, light_positions[1:])) <= 2
+    assert order.count('heavy') == HEAVY
+
+
+def test_late_arrival_served_within_one_turn(controller):
+    # The light developer shows up once the heavy backlog is already being served
+    order = asyncio.run(serve(controller, [(0, 'heavy', HEAVY), (10, 'light', 1)]))
+
+    # Queued behind at most one heavy request, not the 30 still waiting
+    assert order.index('light') <= 10 + SLOTS + 1
+
+
+def test_queued_requests_keep_arrival_order_per_developer(controller):
+    admitted = []
+
+    async def run():
+        async def one(developer, n):
+            permit = await controller.acquire(developer, 100)
+            admitted.append((developer, n))
+            return permit
+
+        tasks = [asyncio.create_task(one('dev1', n)) for n in range(6)]
+        for task in tasks:
+            (await task).release()
+
+    asyncio.run(run())
+
+    assert admitted == [('dev1', n) for n in range(6)]
@@ -0,0 +1,112 @@
+"""Request coalescing through a running proxy (CLAUDE_PROXY_COALESCE=1)"""
+
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from conftest import free_port, running_proxy, serving
+
+KEYS = {'dev1': 'key-dev1', 'dev2': 'key-dev2'}
+REQUEST = {
+    'model': 'claude-3-sonnet-20240229',
+    'max_tokens': 256,
+    'messages': [{'role': 'user', 'content': 'Write a commit message for a typo fix'}],
+}
+LATENCY = 0.5
+
+
+def make_upstream():
+    """Fake Messages API: every call gets a distinct message id; unknown keys get 401"""
+    calls = []
+
+    async def messages(request):
+        body = await request.json()
+        key = request.headers.get('x-api-key')
+        calls.append(key)
+        message_id = f'msg_{len(calls)}'
+        await asyncio.sleep(LATENCY)
+        if key not in KEYS.values():
+            return JSONResponse({'type': 'error', 'error': {'type': 'authentication_error'}}, status_code=401)
+        if body.get('stream'):
+            async def events():
+                start = {'type': 'message_start', 'message': {
+                    'id': message_id, 'type': 'message', 'role': 'assistant', 'model': body['model'],
+                    'content': [], 'usage': {'input_tokens': 42, 'output_tokens': 1},
+                }}
+                delta = {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': 7}}
+                for name, data in (('message_start', start), ('message_delta', delta),
+                                   ('message_stop', {'type': 'message_stop'})):
+                    yield f'event: {name}\ndata: {json.dumps(data)}\n\n'.encode()
+                    await asyncio.sleep(0.05)
+            return StreamingResponse(events(), media_type='text/event-stream')
+        return JSONResponse({
+            'id': message_id, 'type': 'message', 'role': 'assistant', 'model': body['model'],
+            'content': [{'type': 'text', 'text': 'fix: correct typo'}],
+            'stop_reason': 'end_turn', 'usage': {'input_tokens': 42, 'output_tokens': 7},
+        })
+
+    app = Starlette(routes=[Route('/v1/messages', messages, methods=['POST'])])
+    return app, calls
+
+
+@pytest.fixture
+def coalescing_proxy(tmp_path):
+    upstream_port = free_port()
+    env = {'CLAUDE_PROXY_COALESCE': '1', **{f'DEV{i}_CLAUDE_KEY': key for i, key in enumerate(KEYS.values(), 1)}}
+    with running_proxy(upstream_port, str(tmp_path), env) as url:
+        yield url, upstream_port
+
+
+async def send_all(proxy_url, upstream_port, requests):
+    """POST (api_key, payload) pairs concurrently; returns ([(status, coalesced, body)], upstream keys)"""
+    app, calls = make_upstream()
+    async with serving(app, upstream_port), aiohttp.ClientSession() as session:
+        async def one(api_key, payload):
+            async with session.post(
+                f'{proxy_url}/v1/messages',
+                json=payload,
+                headers={'x-api-key': api_key, 'anthropic-version': '2023-06-01'},
+            ) as response:
+                return response.status, response.headers.get('x-claude-proxy-coalesced'), await response.read()
+
+        results = await asyncio.gather(*(one(api_key, payload) for api_key, payload in requests))
+    return results, calls
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_identical_requests_share_one_upstream_call(coalescing_proxy, stream):
+    proxy_url, upstream_port = coalescing_proxy
+    payload = dict(REQUEST, stream=stream)
+    n = 20
+
+    results, calls = asyncio.run(send_all(proxy_url, upstream_port, [(KEYS['dev1'], payload)] * n))
+
+    assert calls == [KEYS['dev1']]
+    assert [status for status, _, _ in results] == [200] * n
+    assert len({body for _, _, body in results}) == 1
+    assert b'msg_1' in results[0][2]
+    assert sorted(coalesced or 'leader' for _, coalesced, _ in results) == ['follower'] * (n - 1) + ['leader']
+
+
+def test_other_or_invalid_key_is_not_coalesced(coalescing_proxy):
+    proxy_url, upstream_port = coalescing_proxy
+    requests = [(KEYS['dev1'], REQUEST)] * 5 + [(KEYS['dev2'], REQUEST), ('not-a-key', REQUEST)]
+
+    results, calls = asyncio.run(send_all(proxy_url, upstream_port, requests))
+
+    # One call per distinct key, each made with that key
+    assert sorted(calls) == sorted([KEYS['dev1'], KEYS['dev2'], 'not-a-key'])
+    dev1, (dev2_status, dev2_coalesced, dev2_body), (bad_status, bad_coalesced, bad_body) = \
+        results[:5], results[5], results[6]
+    assert len({body for _, _, body in dev1}) == 1
+    assert [coalesced for _, coalesced, _ in dev1].count('follower') == 4
+    assert (dev2_status, dev2_coalesced) == (200, None)
+    assert dev2_body != dev1[0][2]
+    # The invalid key gets the upstream's own rejection, never dev1's answer
+    assert (bad_status, bad_coalesced) == (401, None)
+    assert b'fix: correct typo' not in bad_body
@@ -0,0 +1,208 @@
+"""LogShipper and MetricsAggregator batching against stubbed CloudWatch clients"""
+
+from datetime import datetime, timezone
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+LOG_GROUP = '/test/claude-api'
+STREAM = 'dev1/2026/10/17'
+NOW = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def logs():
+    client = boto3.client('logs', region_name='ap-southeast-7')
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+@pytest.fixture
+def cloudwatch():
+    client = boto3.client('cloudwatch', region_name='ap-southeast-7')
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def expect_stream(stubber, stream=STREAM):
+    stubber.add_response('create_log_stream', {}, {'logGroupName': LOG_GROUP, 'logStreamName': stream})
+
+
+def expect_put(stubber, events, stream=STREAM):
+    stubber.add_response('put_log_events', {}, {
+        'logGroupName': LOG_GROUP,
+        'logStreamName': stream,
+        'logEvents': [{'timestamp': ts, 'message': message} for ts, message in events],
+    })
+
+
+def test_batch_splits_at_event_limit(proxy, logs):
+    client, stubber = logs
+    shipper = proxy.LogShipper(client, LOG_GROUP)
+    events = [(STREAM, 1_000 + i, f'event {i}') for i in range(shipper.MAX_BATCH_EVENTS + 1)]
+    expect_stream(stubber)
+    expect_put(stubber, [(ts, message) for _, ts, message in events[:shipper.MAX_BATCH_EVENTS]])
+    expect_put(stubber, [(ts, message) for _, ts, message in events[shipper.MAX_BATCH_EVENTS:]])
+
+    shipper.ship(events)
+
+    assert shipper.stats == {'batches': 2, 'events_sent': 10_001, 'streams_created': 1, 'errors': 0}
+
+
+def test_batch_splits_at_byte_limit(proxy, logs):
+    client, stubber = logs
+    shipper = proxy.LogShipper(client, LOG_GROUP)
+    # 100,000 bytes + 26 overhead each: ten fit in 1 MiB, the eleventh doesn't
+    message = 'x' * 100_000
+    events = [(STREAM, 1_000 + i, message) for i in range(25)]
+    expect_stream(stubber)
+    for start, end in ((0, 10), (10, 20), (20, 25)):
+        batch = [(ts, m) for _, ts, m in events[start:end]]
+        assert sum(len(m) + shipper.EVENT_OVERHEAD_BYTES for _, m in batch) <= shipper.MAX_BATCH_BYTES
+        expect_put(stubber, batch)
+
+    shipper.ship(events)
+
+    assert shipper.stats == {'batches': 3, 'events_sent': 25, 'streams_created': 1, 'errors': 0}
+
+
+def test_byte_limit_counts_utf8_bytes(proxy, logs):
+    client, stubber = logs
+    shipper = proxy.LogShipper(client, LOG_GROUP)
+    # 3 bytes per character in UTF-8: two of these don't fit in one batch
+    message = '€' * 200_000
+    expect_stream(stubber)
+    expect_put(stubber, [(1, message)])
+    expect_put(stubber, [(2, message)])
+
+    shipper.ship([(STREAM, 1, message), (STREAM, 2, message)])
+
+    assert shipper.stats == {'batches': 2, 'events_sent': 2, 'streams_created': 1, 'errors': 0}
+
+
+def test_events_sent_in_chronological_order(proxy, logs):
+    client, stubber = logs
+    shipper = proxy.LogShipper(client, LOG_GROUP)
+    expect_stream(stubber)
+    expect_put(stubber, [(100, 'a'), (200, 'b'), (300, 'c')])
+
+    shipper.ship([(STREAM, 300, 'c'), (STREAM, 100, 'a'), (STREAM, 200, 'b')])
+
+    assert shipper.stats['errors'] == 0
+
+
+def test_streams_batched_separately_and_created_once(proxy, logs):
+    client, stubber = logs
+    shipper = proxy.LogShipper(client, LOG_GROUP)
+    other = 'dev2/2026/10/17'
+    expect_stream(stubber)
+    expect_put(stubber, [(1, 'a1'), (3, 'a2')])
+    expect_stream(stubber, other)
+    expect_put(stubber, [(2, 'b1')], other)
+    # Already known: no second create_log_stream
+    expect_put(stubber, [(4, 'a3')])
+
+    shipper.ship([(STREAM, 1, 'a1'), (other, 2, 'b1'), (STREAM, 3, 'a2')])
+    shipper.ship([(STREAM, 4, 'a3')])
+
+    assert shipper.stats == {'batches': 3, 'events_sent': 4, 'streams_created': 2, 'errors': 0}
+    assert shipper.known_streams == {STREAM, other}
+
+
+def test_existing_stream_is_not_an_error(proxy, logs):
+    client, stubber = logs
+    shipper = proxy.LogShipper(client, LOG_GROUP)
+    stubber.add_client_error('create_log_stream', 'ResourceAlreadyExistsException')
+    expect_put(stubber, [(1, 'a')])
+
+    shipper.ship([(STREAM, 1, 'a')])
+
+    assert shipper.stats == {'batches': 1, 'events_sent': 1, 'streams_created': 0, 'errors': 0}
+
+
+def test_deleted_stream_is_recreated(proxy, logs):
+    client, stubber = logs
+    shipper = proxy.LogShipper(client, LOG_GROUP)
+    shipper.known_streams.add(STREAM)
+    stubber.add_client_error('put_log_events', 'ResourceNotFoundException')
+    expect_stream(stubber)
+    expect_put(stubber, [(1, 'a')])
+
+    shipper.ship([(STREAM, 1, 'a')])
+
+    assert shipper.stats == {'batches': 1, 'events_sent': 1, 'streams_created': 1, 'errors': 0}
+
+
+def test_metrics_rolled_up_into_statistic_sets(proxy, cloudwatch):
+    client, stubber = cloudwatch
+    aggregator = proxy.MetricsAggregator(client, 'proj')
+    aggregator.record('dev1', 'claude-sonnet', 100, 10, 0.5)
+    aggregator.record('dev1', 'claude-sonnet', 300, 30, 1.5)
+    aggregator.record('dev1', 'claude-haiku', 50, 5, 0.25)
+
+    def datum(metric, model, count, total, minimum, maximum):
+        dimensions = [{'Name': 'Developer', 'Value': 'dev1'}]
+        if model:
+            dimensions.append({'Name': 'Model', 'Value': model})
+        dimensions.append({'Name': 'Project', 'Value': 'proj'})
+        return {
+            'MetricName': metric,
+            'Dimensions': dimensions,
+            'StatisticValues': {'SampleCount': count, 'Sum': total, 'Minimum': minimum, 'Maximum': maximum},
+            'Unit': 'None' if metric == 'TotalCost' else 'Count',
+            'Timestamp': NOW,
+        }
+
+    stubber.add_response('put_metric_data', {}, {'Namespace': aggregator.NAMESPACE, 'MetricData': [
+        datum('InputTokens', 'claude-sonnet', 2, 400, 100, 300),
+        datum('OutputTokens', 'claude-sonnet', 2, 40, 10, 30),
+        datum('TotalCost', 'claude-sonnet', 2, 2.0, 0.5, 1.5),
+        datum('APICall', None, 3, 3, 1, 1),
+        datum('InputTokens', 'claude-haiku', 1, 50, 50, 50),
+        datum('OutputTokens', 'claude-haiku', 1, 5, 5, 5),
+        datum('TotalCost', 'claude-haiku', 1, 0.25, 0.25, 0.25),
+    ]})
+
+    aggregator.flush(NOW)
+
+    assert aggregator.stats == {'recorded': 3, 'flushes': 1, 'api_calls': 1, 'errors': 0}
+    # Nothing left over for the next interval
+    aggregator.flush(NOW)
+    assert aggregator.stats['flushes'] == 1
+
+
+def test_metrics_split_at_datum_limit(proxy, cloudwatch):
+    client, stubber = cloudwatch
+    aggregator = proxy.MetricsAggregator(client, 'proj')
+    # Four series per developer: 251 developers is 1004 datums
+    for i in range(251):
+        aggregator.record(f'dev{i}', 'claude-sonnet', 1, 1, 0.01)
+    datums = aggregator.drain(NOW)
+    assert len(datums) == 1004
+    stubber.add_response('put_metric_data', {}, {'Namespace': aggregator.NAMESPACE, 'MetricData': datums[:1000]})
+    stubber.add_response('put_metric_data', {}, {'Namespace': aggregator.NAMESPACE, 'MetricData': datums[1000:]})
+
+    aggregator.send(datums)
+
+    assert aggregator.stats['api_calls'] == 2
+    assert aggregator.stats['errors'] == 0
+
+
+def test_failed_metrics_retried_next_flush(proxy, cloudwatch):
+    client, stubber = cloudwatch
+    aggregator = proxy.MetricsAggregator(client, 'proj')
+    aggregator.record('dev1', 'claude-sonnet', 100, 10, 0.5)
+    first = aggregator.drain(NOW)
+    stubber.add_client_error('put_metric_data', 'InternalServiceError', http_status_code=500)
+    aggregator.send(first)
+    assert aggregator.stats['errors'] == 1
+
+    # The next flush carries the unsent statistics plus anything recorded since
+    aggregator.record('dev1', 'claude-sonnet', 300, 30, 1.5)
+    retried = aggregator.drain(NOW)
+    values = {datum['MetricName']: datum['StatisticValues'] for datum in retried}
+    assert values['InputTokens'] == {'SampleCount': 2, 'Sum': 400, 'Minimum': 100, 'Maximum': 300}
+    assert values['APICall'] == {'SampleCount': 2, 'Sum': 2, 'Minimum': 1, 'Maximum': 1}